@@ -0,0 +1,28 @@
+"""add host admission limits
+
+Revision ID: a8c3e6f19d25
+Revises: f2b7d05e9a14
+Create Date: 2026-10-19 16:02:44.118906
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a8c3e6f19d25'
+down_revision: Union[str, None] = 'f2b7d05e9a14'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('ha_hosts', sa.Column('max_concurrency', sa.Integer(), nullable=True))
+    op.add_column('ha_hosts', sa.Column('max_queue', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('ha_hosts', 'max_queue')
+    op.drop_column('ha_hosts', 'max_concurrency')
@@ -0,0 +1,43 @@
+"""add security events
+
+Revision ID: b7e2c91f4d10
+Revises: a3a1cd4468f5
+Create Date: 2026-10-19 09:12:41.318204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7e2c91f4d10'
+down_revision: Union[str, None] = 'a3a1cd4468f5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('security_events',
+    sa.Column('id', sa.BigInteger(), autoincrement=True, nullable=False),
+    sa.Column('event_type', sa.String(length=32), nullable=False),
+    sa.Column('email', sa.String(length=255), nullable=True),
+    sa.Column('ip', sa.String(length=64), nullable=True),
+    sa.Column('action', sa.String(length=64), nullable=True),
+    sa.Column('target', sa.String(length=255), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_security_events_event_type_id', 'security_events', ['event_type', 'id'], unique=False)
+    op.create_index('ix_security_events_email_id', 'security_events', ['email', 'id'], unique=False)
+    op.create_index('ix_security_events_ip_id', 'security_events', ['ip', 'id'], unique=False)
+    op.create_index('ix_security_events_created_at', 'security_events', ['created_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_security_events_created_at', table_name='security_events')
+    op.drop_index('ix_security_events_ip_id', table_name='security_events')
+    op.drop_index('ix_security_events_email_id', table_name='security_events')
+    op.drop_index('ix_security_events_event_type_id', table_name='security_events')
+    op.drop_table('security_events')
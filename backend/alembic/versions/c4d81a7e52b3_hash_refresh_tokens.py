@@ -0,0 +1,44 @@
+"""hash refresh tokens and index sessions for sweeping
+
+Revision ID: c4d81a7e52b3
+Revises: b7e2c91f4d10
+Create Date: 2026-10-19 10:03:17.552816
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4d81a7e52b3'
+down_revision: Union[str, None] = 'b7e2c91f4d10'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('sessions', sa.Column('refresh_token_hash', sa.String(length=64), nullable=True))
+    # Le sessioni esistenti restano valide: si calcola l'hash del token già emesso
+    op.execute("UPDATE sessions SET refresh_token_hash = encode(sha256(convert_to(refresh_token, 'UTF8')), 'hex')")
+    op.alter_column('sessions', 'refresh_token_hash', nullable=False)
+    op.create_index(op.f('ix_sessions_refresh_token_hash'), 'sessions', ['refresh_token_hash'], unique=True)
+    op.drop_index(op.f('ix_sessions_refresh_token'), table_name='sessions')
+    op.drop_column('sessions', 'refresh_token')
+    op.create_index(op.f('ix_sessions_user_id'), 'sessions', ['user_id'], unique=False)
+    op.create_index(op.f('ix_sessions_expires_at'), 'sessions', ['expires_at'], unique=False)
+    op.create_index('ix_sessions_revoked', 'sessions', ['id'], unique=False, postgresql_where=sa.text('revoked'))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_sessions_revoked', table_name='sessions', postgresql_where=sa.text('revoked'))
+    op.drop_index(op.f('ix_sessions_expires_at'), table_name='sessions')
+    op.drop_index(op.f('ix_sessions_user_id'), table_name='sessions')
+    # I token in chiaro non sono recuperabili: le sessioni esistenti vengono invalidate
+    op.add_column('sessions', sa.Column('refresh_token', sa.String(length=512), nullable=True))
+    op.execute("UPDATE sessions SET refresh_token = refresh_token_hash, revoked = TRUE")
+    op.alter_column('sessions', 'refresh_token', nullable=False)
+    op.create_index(op.f('ix_sessions_refresh_token'), 'sessions', ['refresh_token'], unique=True)
+    op.drop_index(op.f('ix_sessions_refresh_token_hash'), table_name='sessions')
+    op.drop_column('sessions', 'refresh_token_hash')
@@ -0,0 +1,28 @@
+"""index trusted devices
+
+Revision ID: d9f35b0c1e67
+Revises: c4d81a7e52b3
+Create Date: 2026-10-19 11:40:05.907231
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd9f35b0c1e67'
+down_revision: Union[str, None] = 'c4d81a7e52b3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(op.f('ix_trusted_devices_user_id'), 'trusted_devices', ['user_id'], unique=False)
+    op.create_index(op.f('ix_trusted_devices_expires_at'), 'trusted_devices', ['expires_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_trusted_devices_expires_at'), table_name='trusted_devices')
+    op.drop_index(op.f('ix_trusted_devices_user_id'), table_name='trusted_devices')
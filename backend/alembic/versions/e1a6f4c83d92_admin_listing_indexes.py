@@ -0,0 +1,49 @@
+"""admin listing indexes
+
+Revision ID: e1a6f4c83d92
+Revises: d9f35b0c1e67
+Create Date: 2026-10-19 13:22:48.114570
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e1a6f4c83d92'
+down_revision: Union[str, None] = 'd9f35b0c1e67'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.create_index('ix_users_email_trgm', 'users', ['email'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'email': 'gin_trgm_ops'})
+    op.create_index('ix_users_full_name_trgm', 'users', ['full_name'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'full_name': 'gin_trgm_ops'})
+    op.create_index('ix_users_created_at_id', 'users', ['created_at', 'id'], unique=False)
+    op.create_index(op.f('ix_user_roles_user_id'), 'user_roles', ['user_id'], unique=False)
+    op.create_index(op.f('ix_user_roles_role_id'), 'user_roles', ['role_id'], unique=False)
+    op.create_index(op.f('ix_role_permissions_role_id'), 'role_permissions', ['role_id'], unique=False)
+    op.create_index(op.f('ix_role_permissions_host_id'), 'role_permissions', ['host_id'], unique=False)
+    op.create_index(op.f('ix_custom_views_role_id'), 'custom_views', ['role_id'], unique=False)
+    op.create_index(op.f('ix_custom_views_host_id'), 'custom_views', ['host_id'], unique=False)
+    op.create_index('ix_custom_views_order_id', 'custom_views', ['order', 'id'], unique=False)
+    op.create_index('ix_view_widgets_view_id_order', 'view_widgets', ['view_id', 'order'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_view_widgets_view_id_order', table_name='view_widgets')
+    op.drop_index('ix_custom_views_order_id', table_name='custom_views')
+    op.drop_index(op.f('ix_custom_views_host_id'), table_name='custom_views')
+    op.drop_index(op.f('ix_custom_views_role_id'), table_name='custom_views')
+    op.drop_index(op.f('ix_role_permissions_host_id'), table_name='role_permissions')
+    op.drop_index(op.f('ix_role_permissions_role_id'), table_name='role_permissions')
+    op.drop_index(op.f('ix_user_roles_role_id'), table_name='user_roles')
+    op.drop_index(op.f('ix_user_roles_user_id'), table_name='user_roles')
+    op.drop_index('ix_users_created_at_id', table_name='users')
+    op.drop_index('ix_users_full_name_trgm', table_name='users')
+    op.drop_index('ix_users_email_trgm', table_name='users')
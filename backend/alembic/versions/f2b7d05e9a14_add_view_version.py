@@ -0,0 +1,26 @@
+"""add view version
+
+Revision ID: f2b7d05e9a14
+Revises: e1a6f4c83d92
+Create Date: 2026-10-19 14:51:09.640372
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f2b7d05e9a14'
+down_revision: Union[str, None] = 'e1a6f4c83d92'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('custom_views', sa.Column('version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade() -> None:
+    op.drop_column('custom_views', 'version')
@@ -1,16 +1,28 @@
 from datetime import datetime
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from pydantic import BaseModel, EmailStr
+from sqlalchemy import select, tuple_, update, insert, delete
+from sqlalchemy.orm import selectinload
+from pydantic import BaseModel, EmailStr, Field
 from typing import Optional
 import json
+import uuid
 from app.db import get_db
-from app.models import User, UserStatus, HAHost, Role, UserRole, RolePermission
+from app.models import User, UserStatus, HAHost, Role, UserRole, RolePermission, SecurityEvent
 from app.auth.router import require_admin
-from app.auth.service import hash_password
+from app.auth.service import hash_password, forget_user_tokens
+from app.cache import cache_stats
+from app.deadline import deadline_stats
+from app.hosts.admission import admission_stats
+from app.hosts import ha_config, registry, resilience, snapshots
+from app.hosts.history import history_stats
+from app.hosts.camera import camera_stats
+from app.views.definitions import invalidate_view_definitions
 from app.crypto import encrypt, decrypt
-from app.security_log import log_admin_action
+from app.security_log import log_admin_action, security_events_stats
+from app.auth import session_store
+from app.auth.devices import forget_user
+from app.pagination import DEFAULT_LIMIT, MAX_LIMIT, decode_cursor, paginate, search_pattern
 
 router = APIRouter()
 
@@ -28,15 +40,36 @@ class ResetPasswordRequest(BaseModel):
     new_password: str
 
 @router.get("/users")
-async def list_users(db: AsyncSession = Depends(get_db),
+async def list_users(response: Response,
+                     q: Optional[str] = None,
+                     role: Optional[str] = None,
+                     status: Optional[UserStatus] = None,
+                     cursor: Optional[str] = None,
+                     limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+                     db: AsyncSession = Depends(get_db),
                      admin: User = Depends(require_admin)):
-    result = await db.execute(select(User).order_by(User.created_at.desc()))
-    users = result.scalars().all()
+    """Utenti dal più recente, con ruoli. Ricerca su email/nome, filtro per nome ruolo e stato."""
+    query = select(User).options(selectinload(User.roles).selectinload(UserRole.role))
+    if q:
+        pattern = search_pattern(q)
+        query = query.where(User.email.ilike(pattern, escape="\\") | User.full_name.ilike(pattern, escape="\\"))
+    if role:
+        query = query.where(User.id.in_(
+            select(UserRole.user_id).join(Role, Role.id == UserRole.role_id).where(Role.name == role)))
+    if status:
+        query = query.where(User.status == status)
+    if cursor:
+        created_at, last_id = decode_cursor(cursor, datetime.fromisoformat, uuid.UUID)
+        query = query.where(tuple_(User.created_at, User.id) < (created_at, last_id))
+    result = await db.execute(query.order_by(User.created_at.desc(), User.id.desc()).limit(limit + 1))
+    users = paginate(result.scalars().all(), limit, lambda u: [u.created_at.isoformat(), str(u.id)], response)
     return [{"id": str(u.id), "email": u.email, "full_name": u.full_name,
              "status": u.status, "is_admin": u.is_admin,
              "require_2fa": u.require_2fa,
              "request_reason": u.request_reason,
-             "created_at": u.created_at} for u in users]
+             "created_at": u.created_at,
+             "roles": [{"assignment_id": str(ur.id), "role_id": str(ur.role_id), "role_name": ur.role.name}
+                       for ur in u.roles]} for u in users]
 
 @router.get("/users/pending")
 async def list_pending(db: AsyncSession = Depends(get_db),
@@ -84,6 +117,8 @@ async def revoke_user(user_id: str, db: AsyncSession = Depends(get_db),
         raise HTTPException(404, "Utente non trovato")
     user.status = UserStatus.revoked
     await db.commit()
+    await session_store.revoke_user(user.id)
+    forget_user_tokens(user.id)
     log_admin_action(admin.email, "REVOKE_USER", user.email)
     return {"message": f"Utente {user.email} revocato"}
 
@@ -103,6 +138,8 @@ async def reset_password(user_id: str, data: ResetPasswordRequest,
     for s in sessions_result.scalars().all():
         s.revoked = True
     await db.commit()
+    await session_store.revoke_user(user.id)
+    forget_user_tokens(user.id)
     return {"message": f"Password di {user.email} aggiornata, sessioni revocate"}
 
 @router.post("/users/{user_id}/make-admin")
@@ -113,20 +150,16 @@ async def make_admin(user_id: str, db: AsyncSession = Depends(get_db),
         raise HTTPException(404, "Utente non trovato")
     user.is_admin = True
     await db.commit()
+    await session_store.set_admin(user.id, True)
     return {"message": f"{user.email} è ora amministratore"}
 
 @router.get("/users/{user_id}/roles")
 async def get_user_roles(user_id: str, db: AsyncSession = Depends(get_db),
                          admin: User = Depends(require_admin)):
     result = await db.execute(
-        select(UserRole).where(UserRole.user_id == user_id))
-    user_roles = result.scalars().all()
-    out = []
-    for ur in user_roles:
-        role = await db.get(Role, ur.role_id)
-        if role:
-            out.append({"assignment_id": str(ur.id), "role_id": str(role.id), "role_name": role.name})
-    return out
+        select(UserRole).options(selectinload(UserRole.role)).where(UserRole.user_id == user_id))
+    return [{"assignment_id": str(ur.id), "role_id": str(ur.role_id), "role_name": ur.role.name}
+            for ur in result.scalars().all()]
 
 
 @router.delete("/users/{user_id}")
@@ -143,6 +176,9 @@ async def delete_user(user_id: str, current: User = Depends(require_admin), db:
     await db.execute(text("DELETE FROM user_roles WHERE user_id = :uid"), {"uid": user_id})
     await db.delete(user)
     await db.commit()
+    await session_store.revoke_user(user_id)
+    forget_user_tokens(user_id)
+    forget_user(user_id)
     return {"message": "Utente eliminato"}
 
 @router.delete("/users/{user_id}/roles/{role_id}")
@@ -168,6 +204,8 @@ class HAHostCreate(BaseModel):
     base_url: str
     token: str
     description: Optional[str] = None
+    max_concurrency: Optional[int] = Field(None, ge=1, le=100)
+    max_queue: Optional[int] = Field(None, ge=0, le=1000)
 
 @router.get("/hosts")
 async def list_hosts(db: AsyncSession = Depends(get_db),
@@ -177,6 +215,7 @@ async def list_hosts(db: AsyncSession = Depends(get_db),
     # token NON incluso nella risposta
     return [{"id": str(h.id), "name": h.name, "base_url": h.base_url,
              "description": h.description, "active": h.active,
+             "max_concurrency": h.max_concurrency, "max_queue": h.max_queue,
              "created_at": h.created_at} for h in hosts]
 
 @router.post("/hosts", status_code=201)
@@ -186,7 +225,9 @@ async def create_host(data: HAHostCreate, db: AsyncSession = Depends(get_db),
         name=data.name,
         base_url=data.base_url.rstrip("/"),
         token=encrypt(data.token),  # cifrato
-        description=data.description
+        description=data.description,
+        max_concurrency=data.max_concurrency,
+        max_queue=data.max_queue
     )
     db.add(host)
     await db.commit()
@@ -199,6 +240,8 @@ class HAHostUpdate(BaseModel):
     token: Optional[str] = None
     description: Optional[str] = None
     active: Optional[bool] = None
+    max_concurrency: Optional[int] = Field(None, ge=1, le=100)
+    max_queue: Optional[int] = Field(None, ge=0, le=1000)
 
 @router.patch("/hosts/{host_id}")
 async def update_host(host_id: str, data: HAHostUpdate,
@@ -212,7 +255,10 @@ async def update_host(host_id: str, data: HAHostUpdate,
     if data.token is not None: host.token = encrypt(data.token)
     if data.description is not None: host.description = data.description
     if data.active is not None: host.active = data.active
+    if "max_concurrency" in data.model_fields_set: host.max_concurrency = data.max_concurrency
+    if "max_queue" in data.model_fields_set: host.max_queue = data.max_queue
     await db.commit()
+    invalidate_view_definitions()
     log_admin_action(admin.email, "UPDATE_HOST", host.name)
     return {"message": f"Host '{host.name}' aggiornato"}
 
@@ -224,6 +270,11 @@ async def delete_host(host_id: str, db: AsyncSession = Depends(get_db),
         raise HTTPException(404, "Host non trovato")
     await db.delete(host)
     await db.commit()
+    invalidate_view_definitions()
+    snapshots.forget(host_id)
+    registry.forget(host_id)
+    ha_config.forget(host_id)
+    resilience.forget(host_id)
     return {"message": f"Host '{host.name}' eliminato"}
 
 @router.patch("/hosts/{host_id}/toggle")
@@ -234,6 +285,7 @@ async def toggle_host(host_id: str, db: AsyncSession = Depends(get_db),
         raise HTTPException(404, "Host non trovato")
     host.active = not host.active
     await db.commit()
+    invalidate_view_definitions()
     return {"message": f"Host '{host.name}' {'attivato' if host.active else 'disattivato'}"}
 
 # ══════════════════════════════════════════
@@ -251,26 +303,31 @@ class PermissionCreate(BaseModel):
     allowed_entities: Optional[list[str]] = None
 
 @router.get("/roles")
-async def list_roles(db: AsyncSession = Depends(get_db),
+async def list_roles(response: Response,
+                     q: Optional[str] = None,
+                     cursor: Optional[str] = None,
+                     limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+                     db: AsyncSession = Depends(get_db),
                      admin: User = Depends(require_admin)):
-    result = await db.execute(select(Role))
-    roles = result.scalars().all()
-    out = []
-    for r in roles:
-        perms_result = await db.execute(
-            select(RolePermission).where(RolePermission.role_id == r.id))
-        perms = perms_result.scalars().all()
-        out.append({
-            "id": str(r.id), "name": r.name, "description": r.description,
-            "require_2fa": r.require_2fa, "created_at": r.created_at,
-            "permissions": [{
-                "id": str(p.id),
-                "host_id": str(p.host_id),
-                "allowed_domains": json.loads(p.allowed_domains) if p.allowed_domains else None,
-                "allowed_entities": json.loads(p.allowed_entities) if p.allowed_entities else None,
-            } for p in perms]
-        })
-    return out
+    """Ruoli in ordine alfabetico con i loro permessi (caricati in un'unica query)."""
+    query = select(Role).options(selectinload(Role.permissions))
+    if q:
+        query = query.where(Role.name.ilike(search_pattern(q), escape="\\"))
+    if cursor:
+        last_name, last_id = decode_cursor(cursor, str, uuid.UUID)
+        query = query.where(tuple_(Role.name, Role.id) > (last_name, last_id))
+    result = await db.execute(query.order_by(Role.name, Role.id).limit(limit + 1))
+    roles = paginate(result.scalars().all(), limit, lambda r: [r.name, str(r.id)], response)
+    return [{
+        "id": str(r.id), "name": r.name, "description": r.description,
+        "require_2fa": r.require_2fa, "created_at": r.created_at,
+        "permissions": [{
+            "id": str(p.id),
+            "host_id": str(p.host_id),
+            "allowed_domains": json.loads(p.allowed_domains) if p.allowed_domains else None,
+            "allowed_entities": json.loads(p.allowed_entities) if p.allowed_entities else None,
+        } for p in r.permissions]
+    } for r in roles]
 
 @router.post("/roles", status_code=201)
 async def create_role(data: RoleCreate, db: AsyncSession = Depends(get_db),
@@ -295,6 +352,7 @@ async def add_permission(role_id: str, data: PermissionCreate,
     )
     db.add(perm)
     await db.commit()
+    invalidate_view_definitions()
     return {"message": "Permesso aggiunto"}
 
 @router.delete("/roles/{role_id}/permissions/{perm_id}")
@@ -306,6 +364,7 @@ async def delete_permission(role_id: str, perm_id: str,
         raise HTTPException(404, "Permesso non trovato")
     await db.delete(perm)
     await db.commit()
+    invalidate_view_definitions()
     return {"message": "Permesso rimosso"}
 
 @router.post("/roles/{role_id}/assign/{user_id}")
@@ -358,6 +417,7 @@ async def delete_role(role_id: str, db: AsyncSession = Depends(get_db),
     await db.execute(sql_text("UPDATE custom_views SET role_id = NULL WHERE role_id = :rid"), {"rid": role_id})
     await db.delete(role)
     await db.commit()
+    invalidate_view_definitions()
     return {"message": "Ruolo eliminato"}
 
 @router.patch("/roles/{role_id}/require-2fa")
@@ -381,6 +441,8 @@ async def remove_admin(user_id: str, db: AsyncSession = Depends(get_db),
         raise HTTPException(400, "Non puoi revocare i tuoi stessi privilegi admin")
     user.is_admin = False
     await db.commit()
+    await session_store.set_admin(user.id, False)
+    forget_user_tokens(user.id)
     log_admin_action(admin.email, "REMOVE_ADMIN", user.email)
     return {"message": f"{user.email} non è più amministratore"}
 
@@ -394,3 +456,152 @@ async def set_require_2fa(user_id: str, db: AsyncSession = Depends(get_db),
     await db.commit()
     log_admin_action(admin.email, "TOGGLE_USER_2FA", f"{user.email}={user.require_2fa}")
     return {"message": f"2FA obbligatorio per {user.email}: {user.require_2fa}", "require_2fa": user.require_2fa}
+
+# ══════════════════════════════════════════
+# OPERAZIONI MASSIVE — una transazione, SQL set-based, esito per elemento
+# ══════════════════════════════════════════
+
+class BulkUsersRequest(BaseModel):
+    user_ids: list[uuid.UUID] = Field(..., min_length=1, max_length=5000)
+
+class BulkPermission(BaseModel):
+    host_id: uuid.UUID
+    allowed_domains: Optional[list[str]] = None
+    allowed_entities: Optional[list[str]] = None
+
+class BulkPermissionsRequest(BaseModel):
+    permissions: list[BulkPermission] = Field(..., min_length=1, max_length=1000)
+
+async def _bulk_set_status(user_ids: list[uuid.UUID], status: UserStatus, admin: User,
+                           db: AsyncSession) -> dict:
+    ids = [i for i in dict.fromkeys(user_ids) if i != admin.id]
+    values = {"status": status}
+    if status == UserStatus.active:
+        values["approved_at"] = datetime.utcnow()
+    result = await db.execute(
+        update(User).where(User.id.in_(ids)).values(**values)
+        .returning(User.id, User.email)
+        .execution_options(synchronize_session=False))
+    changed = {row.id: row.email for row in result}
+    await db.commit()
+    outcomes = {str(i): ("ok" if i in changed else "not_found") for i in ids}
+    if admin.id in user_ids:
+        outcomes[str(admin.id)] = "self"
+    return {"changed": changed, "results": outcomes}
+
+@router.post("/users/bulk-approve")
+async def bulk_approve_users(data: BulkUsersRequest, db: AsyncSession = Depends(get_db),
+                             admin: User = Depends(require_admin)):
+    out = await _bulk_set_status(data.user_ids, UserStatus.active, admin, db)
+    for email in out["changed"].values():
+        log_admin_action(admin.email, "APPROVE_USER", email)
+    return {"results": out["results"]}
+
+@router.post("/users/bulk-revoke")
+async def bulk_revoke_users(data: BulkUsersRequest, db: AsyncSession = Depends(get_db),
+                            admin: User = Depends(require_admin)):
+    out = await _bulk_set_status(data.user_ids, UserStatus.revoked, admin, db)
+    for user_id, email in out["changed"].items():
+        await session_store.revoke_user(user_id)
+        forget_user_tokens(user_id)
+        log_admin_action(admin.email, "REVOKE_USER", email)
+    return {"results": out["results"]}
+
+@router.post("/roles/{role_id}/assign")
+async def bulk_assign_role(role_id: uuid.UUID, data: BulkUsersRequest,
+                           db: AsyncSession = Depends(get_db),
+                           admin: User = Depends(require_admin)):
+    role = await db.get(Role, role_id)
+    if not role:
+        raise HTTPException(404, "Ruolo non trovato")
+    ids = list(dict.fromkeys(data.user_ids))
+    found = set((await db.execute(select(User.id).where(User.id.in_(ids)))).scalars())
+    assigned = set((await db.execute(
+        select(UserRole.user_id).where(UserRole.role_id == role_id, UserRole.user_id.in_(ids)))).scalars())
+    to_assign = [i for i in ids if i in found and i not in assigned]
+    if to_assign:
+        await db.execute(insert(UserRole), [{"user_id": i, "role_id": role_id} for i in to_assign])
+    await db.commit()
+    log_admin_action(admin.email, "ASSIGN_ROLE_BULK", f"{role.name} x{len(to_assign)}")
+    return {"results": {str(i): ("not_found" if i not in found else
+                                 "already_assigned" if i in assigned else "assigned") for i in ids}}
+
+@router.put("/roles/{role_id}/permissions")
+async def bulk_set_permissions(role_id: uuid.UUID, data: BulkPermissionsRequest,
+                               db: AsyncSession = Depends(get_db),
+                               admin: User = Depends(require_admin)):
+    """Imposta i permessi del ruolo per più host: per ogni host sostituisce quelli esistenti."""
+    role = await db.get(Role, role_id)
+    if not role:
+        raise HTTPException(404, "Ruolo non trovato")
+    perms = {p.host_id: p for p in data.permissions}  # a parità di host vale l'ultimo
+    found = set((await db.execute(select(HAHost.id).where(HAHost.id.in_(perms)))).scalars())
+    replaced = set()
+    if found:
+        result = await db.execute(
+            delete(RolePermission)
+            .where(RolePermission.role_id == role_id, RolePermission.host_id.in_(found))
+            .returning(RolePermission.host_id)
+            .execution_options(synchronize_session=False))
+        replaced = set(result.scalars())
+        await db.execute(insert(RolePermission), [{
+            "role_id": role_id,
+            "host_id": host_id,
+            "allowed_domains": json.dumps(perms[host_id].allowed_domains) if perms[host_id].allowed_domains else None,
+            "allowed_entities": json.dumps(perms[host_id].allowed_entities) if perms[host_id].allowed_entities else None,
+        } for host_id in found])
+    await db.commit()
+    invalidate_view_definitions()
+    log_admin_action(admin.email, "SET_PERMISSIONS_BULK", f"{role.name} x{len(found)}")
+    return {"results": {str(h): ("host_not_found" if h not in found else
+                                 "replaced" if h in replaced else "created") for h in perms}}
+
+# ══════════════════════════════════════════
+# EVENTI DI SICUREZZA
+# ══════════════════════════════════════════
+
+@router.get("/security-events")
+async def list_security_events(response: Response,
+                               email: Optional[str] = None,
+                               ip: Optional[str] = None,
+                               event_type: Optional[str] = Query(None, alias="type"),
+                               since: Optional[datetime] = None,
+                               until: Optional[datetime] = None,
+                               cursor: Optional[str] = None,
+                               limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+                               db: AsyncSession = Depends(get_db),
+                               admin: User = Depends(require_admin)):
+    """Ricerca eventi di sicurezza, dal più recente. Pagina successiva via header X-Next-Cursor."""
+    query = select(SecurityEvent)
+    if email:
+        query = query.where(SecurityEvent.email == email)
+    if ip:
+        query = query.where(SecurityEvent.ip == ip)
+    if event_type:
+        query = query.where(SecurityEvent.event_type == event_type.upper())
+    if since:
+        query = query.where(SecurityEvent.created_at >= since)
+    if until:
+        query = query.where(SecurityEvent.created_at < until)
+    if cursor:
+        last_id, = decode_cursor(cursor, int)
+        query = query.where(SecurityEvent.id < last_id)
+    result = await db.execute(query.order_by(SecurityEvent.id.desc()).limit(limit + 1))
+    events = paginate(result.scalars().all(), limit, lambda e: [e.id], response)
+    return [{"id": e.id, "type": e.event_type, "email": e.email, "ip": e.ip,
+             "action": e.action, "target": e.target, "created_at": e.created_at} for e in events]
+
+# ══════════════════════════════════════════
+# METRICHE
+# ══════════════════════════════════════════
+
+@router.get("/metrics")
+async def get_metrics(admin: User = Depends(require_admin)):
+    """Statistiche delle cache, delle code verso gli host (con retry e hedging), delle richieste
+    scadute o abbandonate, degli snapshot, dei registri, degli stream delle telecamere e del
+    buffer degli eventi di sicurezza del worker che risponde."""
+    return {"caches": cache_stats(), "hosts": admission_stats(), "upstream": resilience.resilience_stats(),
+            "requests": deadline_stats(),
+            "snapshots": snapshots.snapshot_stats(), "history": history_stats(),
+            "registries": registry.registry_stats(), "cameras": camera_stats(),
+            "security_events": security_events_stats()}
@@ -0,0 +1,61 @@
+"""Verifica dei dispositivi di fiducia senza transazioni di scrittura.
+
+Il lookup è servito da una cache indicizzata per hash del device token; gli
+aggiornamenti di last_seen si accumulano in memoria e `flush_last_seen` li
+scrive su DB in batch."""
+import uuid
+from datetime import datetime
+from typing import Optional
+from sqlalchemy import select, update, bindparam
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.auth.service import hash_token
+from app.cache import TTLCache
+from app.config import settings
+from app.db import AsyncSessionLocal
+from app.models import TrustedDevice
+
+# hash token -> (device_id, user_id, expires_at), oppure False se il token non esiste
+_devices = TTLCache("trusted_devices", maxsize=10000, ttl=settings.TRUSTED_DEVICE_CACHE_SECONDS)
+_last_seen: dict[uuid.UUID, datetime] = {}
+
+async def find_trusted_device(db: AsyncSession, user_id: uuid.UUID, device_token: str) -> Optional[uuid.UUID]:
+    """Restituisce l'id del dispositivo se il token è valido per l'utente, altrimenti None."""
+    key = hash_token(device_token)
+    entry = _devices.get(key)
+    if entry is None:
+        result = await db.execute(
+            select(TrustedDevice.id, TrustedDevice.user_id, TrustedDevice.expires_at)
+            .where(TrustedDevice.device_token == device_token))
+        row = result.one_or_none()
+        entry = (row.id, row.user_id, row.expires_at) if row else False
+        _devices.set(key, entry)
+    if not entry:
+        return None
+    device_id, owner_id, expires_at = entry
+    if owner_id != user_id or expires_at <= datetime.utcnow():
+        return None
+    return device_id
+
+def record_seen(device_id: uuid.UUID) -> None:
+    _last_seen[device_id] = datetime.utcnow()
+
+def forget_user(user_id) -> None:
+    """Invalida in cache i dispositivi dell'utente (es. utente eliminato)."""
+    _devices.purge(lambda _, entry: bool(entry) and str(entry[1]) == str(user_id))
+
+async def flush_last_seen() -> None:
+    """Scrive i last_seen accumulati con un unico UPDATE executemany."""
+    global _last_seen
+    if not _last_seen:
+        return
+    pending, _last_seen = _last_seen, {}
+    table = TrustedDevice.__table__
+    stmt = update(table).where(table.c.id == bindparam("device_id")).values(last_seen=bindparam("seen"))
+    try:
+        async with AsyncSessionLocal() as db:
+            await db.execute(stmt, [{"device_id": k, "seen": v} for k, v in pending.items()])
+            await db.commit()
+    except Exception:
+        for k, v in pending.items():
+            _last_seen.setdefault(k, v)
+        raise
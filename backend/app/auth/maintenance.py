@@ -0,0 +1,42 @@
+"""Manutenzione periodica delle tabelle di autenticazione."""
+import asyncio
+import logging
+from datetime import datetime
+from sqlalchemy import select, delete, or_
+from app.config import settings
+from app.db import AsyncSessionLocal
+from app.models import Session, TrustedDevice
+
+logger = logging.getLogger("homematrix.maintenance")
+
+async def _delete_in_batches(model, condition) -> int:
+    """Elimina le righe che soddisfano `condition` a blocchi limitati.
+
+    Ogni blocco è una transazione breve; SKIP LOCKED evita che più worker
+    si contendano le stesse righe."""
+    deleted = 0
+    for _ in range(settings.SESSION_SWEEP_MAX_BATCHES):
+        stale = (select(model.id).where(condition)
+                 .limit(settings.SESSION_SWEEP_BATCH_SIZE)
+                 .with_for_update(skip_locked=True))
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(delete(model).where(model.id.in_(stale.scalar_subquery())))
+            await db.commit()
+        deleted += result.rowcount
+        if result.rowcount < settings.SESSION_SWEEP_BATCH_SIZE:
+            break
+        await asyncio.sleep(0.1)
+    return deleted
+
+async def sweep_sessions():
+    """Elimina le sessioni scadute o revocate."""
+    deleted = await _delete_in_batches(
+        Session, or_(Session.revoked == True, Session.expires_at < datetime.utcnow()))
+    if deleted:
+        logger.info("Sweeper sessioni: eliminate %d sessioni scadute o revocate", deleted)
+
+async def purge_trusted_devices():
+    """Elimina i dispositivi di fiducia scaduti."""
+    deleted = await _delete_in_batches(TrustedDevice, TrustedDevice.expires_at < datetime.utcnow())
+    if deleted:
+        logger.info("Pulizia dispositivi: eliminati %d dispositivi di fiducia scaduti", deleted)
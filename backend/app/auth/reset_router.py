@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from pydantic import BaseModel
@@ -11,6 +11,7 @@ from app.db import get_db
 from app.models import User
 from app.auth.service import hash_password, validate_password
 from app.config import settings
+from app.security_log import log_password_change
 
 router = APIRouter()
 
@@ -74,7 +75,7 @@ async def forgot_password(data: ForgotRequest, db: AsyncSession = Depends(get_db
     return {"message": "Se l'email è registrata, riceverai le istruzioni."}
 
 @router.post("/reset-password")
-async def reset_password(data: ResetRequest, db: AsyncSession = Depends(get_db)):
+async def reset_password(data: ResetRequest, request: Request, db: AsyncSession = Depends(get_db)):
     if data.new_password != data.confirm_password:
         raise HTTPException(400, "Le password non coincidono")
 
@@ -94,6 +95,7 @@ async def reset_password(data: ResetRequest, db: AsyncSession = Depends(get_db))
     user.hashed_password = hash_password(data.new_password)
     await db.commit()
     redis_client.delete(f"reset:{data.token}")
+    log_password_change(user.email, request.client.host)
     return {"message": "Password reimpostata con successo"}
 
 @router.get("/reset-password/validate")
@@ -9,10 +9,13 @@ from app.db import get_db
 from app.models import User, Session, UserStatus
 from app.auth.service import (hash_password, verify_password,
                                create_access_token, create_refresh_token,
-                               decode_access_token, validate_password)
+                               decode_access_token, validate_password, hash_token,
+                               forget_access_token, forget_user_tokens)
 from app.config import settings
+from app import deadline
 from app.limiter import limiter
 from app.security_log import log_login_ok, log_login_fail, log_register, log_password_change
+from app.auth import session_store
 from fastapi import Request
 
 router = APIRouter()
@@ -66,14 +69,12 @@ async def login(request: Request, data: LoginRequest, response: Response, db: As
         raise HTTPException(403, "Account non ancora approvato o revocato")
     refresh_token = create_refresh_token()
     expires = datetime.utcnow() + timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS)
-    session = Session(user_id=user.id, refresh_token=refresh_token, expires_at=expires)
+    session = Session(user_id=user.id, refresh_token_hash=hash_token(refresh_token), expires_at=expires)
     db.add(session)
     await db.commit()
-    response.set_cookie(
-        key="refresh_token", value=refresh_token,
-        httponly=True, secure=True, samesite="lax",
-        max_age=settings.REFRESH_TOKEN_EXPIRE_DAYS * 86400
-    )
+    if session_store.enabled():
+        await session_store.put(session.refresh_token_hash, session.id, user.id, user.is_admin, expires)
+    _set_refresh_cookie(response, refresh_token)
     # Controlla se 2FA è richiesto per il ruolo
     from app.models import UserRole, Role
     role_result = await db.execute(select(UserRole).where(UserRole.user_id == user.id))
@@ -117,34 +118,56 @@ async def refresh(response: Response, refresh_token: Optional[str] = Cookie(None
                   db: AsyncSession = Depends(get_db)):
     if not refresh_token:
         raise HTTPException(401, "Nessun refresh token")
+    # Rolling session: rinnova il refresh token ad ogni utilizzo
+    new_refresh_token = create_refresh_token()
+    new_expires = datetime.utcnow() + timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS)
+    if session_store.enabled():
+        # Percorso veloce: rotazione atomica in Redis, nessuna query su Postgres
+        cached = await session_store.rotate(hash_token(refresh_token), hash_token(new_refresh_token), new_expires)
+        if cached:
+            _set_refresh_cookie(response, new_refresh_token)
+            return {"access_token": create_access_token(cached["uid"], cached["adm"] == "1")}
     result = await db.execute(
-        select(Session).where(Session.refresh_token == refresh_token,
+        select(Session).where(Session.refresh_token_hash == hash_token(refresh_token),
                               Session.revoked == False))
     session = result.scalar_one_or_none()
     if not session or session.expires_at < datetime.utcnow():
         raise HTTPException(401, "Sessione scaduta o non valida")
+    if session_store.enabled() and await session_store.is_live(session.id):
+        # Token già ruotato in Redis ma non ancora riscritto su DB: riuso di un token vecchio
+        raise HTTPException(401, "Sessione scaduta o non valida")
     user = await db.get(User, session.user_id)
     if not user or user.status != UserStatus.active:
         raise HTTPException(403, "Utente non attivo")
-    # Rolling session: rinnova il refresh token ad ogni utilizzo
-    new_refresh_token = create_refresh_token()
-    new_expires = datetime.utcnow() + timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS)
-    session.refresh_token = new_refresh_token
+    session.refresh_token_hash = hash_token(new_refresh_token)
     session.expires_at = new_expires
     await db.commit()
+    if session_store.enabled():
+        await session_store.put(session.refresh_token_hash, session.id, user.id, user.is_admin, new_expires)
+    _set_refresh_cookie(response, new_refresh_token)
+    return {"access_token": create_access_token(str(user.id), user.is_admin)}
+
+def _set_refresh_cookie(response: Response, refresh_token: str):
     response.set_cookie(
-        key="refresh_token", value=new_refresh_token,
+        key="refresh_token", value=refresh_token,
         httponly=True, secure=True, samesite="lax",
         max_age=settings.REFRESH_TOKEN_EXPIRE_DAYS * 86400
     )
-    return {"access_token": create_access_token(str(user.id), user.is_admin)}
 
 @router.post("/logout")
 async def logout(response: Response, refresh_token: Optional[str] = Cookie(None),
+                 credentials: HTTPAuthorizationCredentials = Depends(bearer),
                  db: AsyncSession = Depends(get_db)):
+    if credentials:
+        forget_access_token(credentials.credentials)
     if refresh_token:
-        result = await db.execute(select(Session).where(Session.refresh_token == refresh_token))
-        session = result.scalar_one_or_none()
+        cached = await session_store.pop(hash_token(refresh_token)) if session_store.enabled() else None
+        if cached:
+            # In Redis l'hash può essere più recente di quello su DB: si revoca per id
+            session = await db.get(Session, cached["sid"])
+        else:
+            result = await db.execute(select(Session).where(Session.refresh_token_hash == hash_token(refresh_token)))
+            session = result.scalar_one_or_none()
         if session:
             session.revoked = True
             await db.commit()
@@ -158,7 +181,7 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(b
     payload = decode_access_token(credentials.credentials)
     if not payload:
         raise HTTPException(401, "Token non valido o scaduto")
-    user = await db.get(User, payload["sub"])
+    user = await deadline.bound(db.get(User, payload["sub"]))
     if not user or user.status != UserStatus.active:
         raise HTTPException(403, "Utente non attivo")
     return user
@@ -173,7 +196,7 @@ class ChangePasswordRequest(BaseModel):
     new_password: str
 
 @router.post("/change-password")
-async def change_password(data: ChangePasswordRequest,
+async def change_password(data: ChangePasswordRequest, request: Request,
                           credentials: HTTPAuthorizationCredentials = Depends(bearer),
                           db: AsyncSession = Depends(get_db)):
     if not credentials:
@@ -197,4 +220,7 @@ async def change_password(data: ChangePasswordRequest,
     for s in sessions_result.scalars().all():
         s.revoked = True
     await db.commit()
+    await session_store.revoke_user(user.id)
+    forget_user_tokens(user.id)
+    log_password_change(user.email, request.client.host)
     return {"message": "Password aggiornata, tutte le sessioni revocate"}
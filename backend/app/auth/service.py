@@ -1,8 +1,11 @@
+import hashlib
+import time
 from datetime import datetime, timedelta
 from uuid import uuid4
 from jose import jwt, JWTError
 from passlib.context import CryptContext
 from app.config import settings
+from app.cache import TTLCache
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -22,11 +25,34 @@ def create_access_token(user_id: str, is_admin: bool, expires_minutes: int = Non
 def create_refresh_token() -> str:
     return str(uuid4())
 
+def hash_token(token: str) -> str:
+    """SHA-256 esadecimale: a DB si salva e si cerca solo l'hash a lunghezza fissa del token."""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+# Token già verificati (chiave: hash del token), ognuno valido fino al proprio exp
+_verified_tokens = TTLCache("access_tokens", maxsize=settings.ACCESS_TOKEN_CACHE_SIZE,
+                            ttl=settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+
 def decode_access_token(token: str) -> dict:
+    key = hash_token(token)
+    payload = _verified_tokens.get(key)
+    if payload is not None:
+        return payload
     try:
-        return jwt.decode(token, settings.JWT_SECRET, algorithms=[settings.JWT_ALGORITHM])
+        payload = jwt.decode(token, settings.JWT_SECRET, algorithms=[settings.JWT_ALGORITHM])
     except JWTError:
         return None
+    ttl = payload.get("exp", 0) - time.time()
+    if ttl > 0:
+        _verified_tokens.set(key, payload, ttl=ttl)
+    return payload
+
+def forget_access_token(token: str) -> None:
+    _verified_tokens.pop(hash_token(token))
+
+def forget_user_tokens(user_id) -> None:
+    """Rimuove dalla cache i token verificati dell'utente (logout, revoca, cambio password)."""
+    _verified_tokens.purge(lambda _, payload: payload.get("sub") == str(user_id))
 
 def validate_password(password: str) -> str:
     """Valida la password e restituisce un messaggio di errore o stringa vuota."""
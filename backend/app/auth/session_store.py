@@ -0,0 +1,168 @@
+"""Sessioni refresh su Redis (SESSION_STORE=redis).
+
+Postgres resta il registro durevole: login e logout scrivono su DB, mentre le
+rotazioni di /refresh avvengono solo in Redis (TTL nativo, rotazione atomica
+via Lua) e vengono riscritte su DB in batch da `write_back_sessions`."""
+import logging
+import uuid
+from datetime import datetime
+from typing import Optional
+from redis.exceptions import RedisError
+from sqlalchemy import update, bindparam
+from app.config import settings
+from app.db import AsyncSessionLocal
+from app.models import Session
+from app.redis_client import get_redis
+
+logger = logging.getLogger("homematrix.sessions")
+
+SESSION_KEY = "sess:{}"        # hash token -> {sid, uid, adm}
+SID_KEY = "sess:sid:{}"        # id sessione -> hash token corrente
+USER_KEY = "sess:user:{}"      # id utente -> set di hash token attivi
+DIRTY_KEY = "sess:dirty"       # id sessione -> "hash|scadenza" da riscrivere su DB
+
+# KEYS: vecchia sessione, nuova sessione, dirty
+# ARGV: ttl, "hash|scadenza", vecchio hash, nuovo hash
+_ROTATE_LUA = """
+local data = redis.call('HGETALL', KEYS[1])
+if #data == 0 then return nil end
+local sid, uid
+for i = 1, #data, 2 do
+  if data[i] == 'sid' then sid = data[i + 1] end
+  if data[i] == 'uid' then uid = data[i + 1] end
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[2], unpack(data))
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+redis.call('SET', 'sess:sid:' .. sid, ARGV[4], 'EX', ARGV[1])
+redis.call('SREM', 'sess:user:' .. uid, ARGV[3])
+redis.call('SADD', 'sess:user:' .. uid, ARGV[4])
+redis.call('EXPIRE', 'sess:user:' .. uid, ARGV[1])
+redis.call('HSET', KEYS[3], sid, ARGV[2])
+return data
+"""
+
+# Aggiorna il flag solo se la sessione esiste ancora, per non ricreare chiavi senza TTL
+_SET_ADMIN_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then redis.call('HSET', KEYS[1], 'adm', ARGV[1]) end
+"""
+
+def enabled() -> bool:
+    return settings.SESSION_STORE == "redis"
+
+def _ttl(expires_at: datetime) -> int:
+    return max(1, int((expires_at - datetime.utcnow()).total_seconds()))
+
+async def put(token_hash: str, session_id, user_id, is_admin: bool, expires_at: datetime) -> None:
+    """Registra in Redis una sessione appena creata o letta da DB."""
+    ttl = _ttl(expires_at)
+    try:
+        async with get_redis().pipeline(transaction=True) as pipe:
+            pipe.hset(SESSION_KEY.format(token_hash),
+                      mapping={"sid": str(session_id), "uid": str(user_id), "adm": int(is_admin)})
+            pipe.expire(SESSION_KEY.format(token_hash), ttl)
+            pipe.set(SID_KEY.format(session_id), token_hash, ex=ttl)
+            pipe.sadd(USER_KEY.format(user_id), token_hash)
+            pipe.expire(USER_KEY.format(user_id), ttl)
+            await pipe.execute()
+    except RedisError:
+        logger.exception("Registrazione sessione su Redis fallita")
+
+async def rotate(old_hash: str, new_hash: str, expires_at: datetime) -> Optional[dict]:
+    """Sostituisce atomicamente il token di una sessione. None se la sessione non è in Redis."""
+    try:
+        data = await get_redis().eval(
+            _ROTATE_LUA, 3, SESSION_KEY.format(old_hash), SESSION_KEY.format(new_hash), DIRTY_KEY,
+            _ttl(expires_at), f"{new_hash}|{expires_at.isoformat()}", old_hash, new_hash)
+    except RedisError:
+        logger.exception("Rotazione sessione su Redis fallita, uso il DB")
+        return None
+    if not data:
+        return None
+    return dict(zip(data[::2], data[1::2]))
+
+async def is_live(session_id) -> bool:
+    """True se la sessione è attiva in Redis con un token diverso (il DB può essere indietro)."""
+    try:
+        return bool(await get_redis().exists(SID_KEY.format(session_id)))
+    except RedisError:
+        return False
+
+async def pop(token_hash: str) -> Optional[dict]:
+    """Rimuove la sessione da Redis e ne restituisce i dati."""
+    r = get_redis()
+    try:
+        data = await r.hgetall(SESSION_KEY.format(token_hash))
+        if not data:
+            return None
+        async with r.pipeline(transaction=True) as pipe:
+            pipe.delete(SESSION_KEY.format(token_hash), SID_KEY.format(data["sid"]))
+            pipe.srem(USER_KEY.format(data["uid"]), token_hash)
+            await pipe.execute()
+        return data
+    except RedisError:
+        logger.exception("Rimozione sessione da Redis fallita")
+        return None
+
+async def revoke_user(user_id) -> None:
+    """Elimina da Redis tutte le sessioni dell'utente (cambio password, revoca, eliminazione)."""
+    if not enabled():
+        return
+    r = get_redis()
+    try:
+        hashes = await r.smembers(USER_KEY.format(user_id))
+        if hashes:
+            async with r.pipeline(transaction=False) as pipe:
+                for h in hashes:
+                    pipe.hget(SESSION_KEY.format(h), "sid")
+                sids = await pipe.execute()
+        else:
+            sids = []
+        keys = [SESSION_KEY.format(h) for h in hashes] + [SID_KEY.format(s) for s in sids if s]
+        await r.delete(USER_KEY.format(user_id), *keys)
+    except RedisError:
+        logger.exception("Revoca sessioni Redis dell'utente %s fallita", user_id)
+
+async def set_admin(user_id, is_admin: bool) -> None:
+    """Aggiorna il flag admin nelle sessioni attive, usato per i nuovi access token."""
+    if not enabled():
+        return
+    r = get_redis()
+    try:
+        hashes = await r.smembers(USER_KEY.format(user_id))
+        async with r.pipeline(transaction=False) as pipe:
+            for h in hashes:
+                pipe.eval(_SET_ADMIN_LUA, 1, SESSION_KEY.format(h), int(is_admin))
+            await pipe.execute()
+    except RedisError:
+        logger.exception("Aggiornamento flag admin nelle sessioni Redis fallito")
+
+async def write_back_sessions() -> None:
+    """Riscrive su DB, in un unico UPDATE per batch, le rotazioni avvenute in Redis."""
+    r = get_redis()
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.hgetall(DIRTY_KEY)
+        pipe.delete(DIRTY_KEY)
+        dirty, _ = await pipe.execute()
+    if not dirty:
+        return
+    rows = []
+    for sid, value in dirty.items():
+        token_hash, expires = value.split("|", 1)
+        rows.append({"sid": uuid.UUID(sid), "token_hash": token_hash,
+                     "expires": datetime.fromisoformat(expires)})
+    # UPDATE executemany a livello Core: le sessioni già eliminate dallo sweeper vengono ignorate
+    table = Session.__table__
+    stmt = (update(table).where(table.c.id == bindparam("sid"))
+            .values(refresh_token_hash=bindparam("token_hash"), expires_at=bindparam("expires")))
+    try:
+        async with AsyncSessionLocal() as db:
+            await db.execute(stmt, rows)
+            await db.commit()
+    except Exception:
+        # Rimette in coda senza sovrascrivere rotazioni più recenti
+        async with r.pipeline(transaction=False) as pipe:
+            for sid, value in dirty.items():
+                pipe.hsetnx(DIRTY_KEY, sid, value)
+            await pipe.execute()
+        raise
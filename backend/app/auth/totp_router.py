@@ -8,6 +8,7 @@ from app.models import User, UserRole, Role, TrustedDevice
 from app.auth.router import get_current_user
 from app.totp import generate_totp_secret, get_totp_uri, verify_totp, generate_qr_base64, generate_device_token
 from app.auth.service import create_access_token
+from app.auth.devices import find_trusted_device, record_seen
 
 router = APIRouter()
 
@@ -136,19 +137,12 @@ async def check_device(request: Request,
     if not device_token:
         return {"trusted": False}
 
-    result = await db.execute(
-        select(TrustedDevice).where(
-            TrustedDevice.user_id == user.id,
-            TrustedDevice.device_token == device_token,
-            TrustedDevice.expires_at > datetime.utcnow()
-        ))
-    device = result.scalar_one_or_none()
-    if not device:
+    device_id = await find_trusted_device(db, user.id, device_token)
+    if not device_id:
         return {"trusted": False}
 
-    # Aggiorna last_seen
-    device.last_seen = datetime.utcnow()
-    await db.commit()
+    # last_seen viene scritto in batch dal job periodico, nessuna transazione qui
+    record_seen(device_id)
     return {
         "trusted": True,
         "access_token": create_access_token(str(user.id), user.is_admin)
@@ -0,0 +1,55 @@
+"""Job periodici in background, avviati e fermati dal ciclo di vita dell'app."""
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+logger = logging.getLogger("homematrix.background")
+
+Job = Callable[[], Awaitable[None]]
+
+_jobs: list[tuple[str, float, Job]] = []
+_startup_hooks: list[Job] = []
+_shutdown_hooks: list[Job] = []
+_tasks: list[asyncio.Task] = []
+
+def periodic(name: str, interval: float, job: Job) -> None:
+    """Registra un job da eseguire ogni `interval` secondi."""
+    _jobs.append((name, interval, job))
+
+def on_startup(hook: Job) -> None:
+    """Registra una coroutine da eseguire all'avvio, prima dei job periodici."""
+    _startup_hooks.append(hook)
+
+def on_shutdown(hook: Job) -> None:
+    """Registra una coroutine da eseguire allo spegnimento (es. flush finale dei buffer)."""
+    _shutdown_hooks.append(hook)
+
+async def _run(name: str, interval: float, job: Job) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await job()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Job in background '%s' fallito", name)
+
+async def start() -> None:
+    for hook in _startup_hooks:
+        try:
+            await hook()
+        except Exception:
+            logger.exception("Hook di avvio fallito")
+    for name, interval, job in _jobs:
+        _tasks.append(asyncio.create_task(_run(name, interval, job), name=name))
+
+async def stop() -> None:
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+    for hook in _shutdown_hooks:
+        try:
+            await hook()
+        except Exception:
+            logger.exception("Hook di shutdown fallito")
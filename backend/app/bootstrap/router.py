@@ -0,0 +1,57 @@
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+from app.db import get_db
+from app.models import User, Role, UserRole, CustomView
+from app.auth.router import get_current_user
+from app.hosts.service import get_host_access, filter_states
+from app.hosts import snapshots
+from app.hosts.state_store import to_dicts
+
+router = APIRouter()
+
+@router.get("/bootstrap")
+async def bootstrap(with_states: bool = False, host_id: Optional[str] = None,
+                    db: AsyncSession = Depends(get_db),
+                    user: User = Depends(get_current_user)):
+    """Tutto ciò che serve alla SPA dopo il login in un'unica richiesta: profilo,
+    host accessibili, viste, stato 2FA e, con with_states, gli stati (filtrati)
+    del primo host o di `host_id`. I ruoli dell'utente vengono risolti una volta sola."""
+    role_result = await db.execute(
+        select(Role.id, Role.require_2fa).join(UserRole, UserRole.role_id == Role.id)
+        .where(UserRole.user_id == user.id))
+    roles = role_result.all()
+    role_ids = [r.id for r in roles]
+
+    access = await get_host_access(user, db)
+
+    view_query = select(CustomView.id, CustomView.title, CustomView.slug, CustomView.order)
+    if not user.is_admin:
+        view_query = view_query.where(CustomView.role_id.in_(role_ids))
+    view_result = await db.execute(view_query.order_by(CustomView.order))
+
+    out = {
+        "user": {"id": str(user.id), "email": user.email, "full_name": user.full_name,
+                 "is_admin": user.is_admin},
+        "hosts": [{"id": hid, "name": a.host.name, "description": a.host.description}
+                  for hid, a in access.items()],
+        "views": [{"id": str(v.id), "title": v.title, "slug": v.slug, "order": v.order}
+                  for v in view_result.all()],
+        "2fa": {"enabled": user.totp_enabled,
+                "required": any(r.require_2fa for r in roles) or user.require_2fa or user.is_admin},
+    }
+    if with_states and access:
+        hid = host_id or next(iter(access))
+        if hid not in access:
+            raise HTTPException(403, "Accesso a questo host non autorizzato")
+        host, allowed_domains, allowed_entities = access[hid]
+        try:
+            states, age = await snapshots.get_states(host)
+            states = to_dicts(filter_states(states, allowed_domains, allowed_entities))
+            out["states"] = {"host_id": hid, "states": states, "stale": age is not None}
+            if age is not None: out["states"]["age"] = int(age)
+        except Exception:
+            # Il bootstrap non fallisce se HA è irraggiungibile: la SPA ripiega sul polling
+            out["states"] = {"host_id": hid, "error": "Errore comunicazione con HA"}
+    return out
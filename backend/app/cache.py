@@ -0,0 +1,63 @@
+"""Cache in memoria (per worker): LRU limitata con scadenza per voce e statistiche hit/miss."""
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+_registry: dict[str, "TTLCache"] = {}
+
+class TTLCache:
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        _registry[name] = self
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expires, value = item
+        if expires <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float = None) -> None:
+        """Inserisce una voce; `ttl` sostituisce la durata di default (es. scadenza del token)."""
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def purge(self, predicate: Callable[[Hashable, Any], bool]) -> int:
+        """Rimuove le voci per cui predicate(chiave, valore) è vero."""
+        keys = [k for k, (_, v) in self._data.items() if predicate(k, v)]
+        for k in keys:
+            del self._data[k]
+        return len(keys)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"size": len(self._data), "maxsize": self.maxsize,
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None}
+
+def cache_stats() -> dict:
+    return {name: c.stats() for name, c in _registry.items()}
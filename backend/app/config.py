@@ -8,6 +8,7 @@ class Settings(BaseSettings):
     JWT_ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 15
     REFRESH_TOKEN_EXPIRE_DAYS: int = 30
+    ACCESS_TOKEN_CACHE_SIZE: int = 10000
     ENVIRONMENT: str = "production"
     ALLOWED_ORIGINS: str = "https://homematrix.iotzator.com"
     SMTP_HOST: Optional[str] = None
@@ -18,6 +19,64 @@ class Settings(BaseSettings):
     GOOGLE_CLIENT_SECRET: Optional[str] = None
     GOOGLE_REDIRECT_URI: Optional[str] = None
     ENCRYPTION_KEY: str = ""
+    # Eventi di sicurezza: buffer write-behind verso la tabella security_events
+    SECURITY_EVENTS_FLUSH_SECONDS: float = 2.0
+    SECURITY_EVENTS_BATCH_SIZE: int = 500
+    SECURITY_EVENTS_MAX_PENDING: int = 10000
+    # Pulizia periodica delle sessioni scadute/revocate
+    SESSION_SWEEP_INTERVAL_SECONDS: float = 600
+    SESSION_SWEEP_BATCH_SIZE: int = 1000
+    SESSION_SWEEP_MAX_BATCHES: int = 50
+    # "db" = sessioni refresh solo su Postgres; "redis" = rotazione su Redis con write-back su DB
+    SESSION_STORE: str = "db"
+    SESSION_WRITE_BACK_SECONDS: float = 30
+    # Dispositivi di fiducia 2FA: cache dei lookup, flush di last_seen, pulizia scaduti
+    TRUSTED_DEVICE_CACHE_SECONDS: float = 300
+    TRUSTED_DEVICE_FLUSH_SECONDS: float = 60
+    TRUSTED_DEVICE_PURGE_SECONDS: float = 3600
+    # Definizioni delle viste in cache: limite alla staleness tra worker per modifiche a host/permessi
+    VIEW_DEFINITION_TTL_SECONDS: float = 60
+    # Ammissione verso gli host HA: richieste in volo, coda e attesa massima (default per host)
+    HOST_MAX_CONCURRENCY: int = 4
+    HOST_MAX_QUEUE: int = 32
+    HOST_QUEUE_WAIT_SECONDS: float = 5
+    # Oltre questo tempo gli stati vengono serviti dall'ultimo snapshot (stale) mentre il refresh prosegue
+    STATES_LATENCY_BUDGET_SECONDS: float = 2
+    # Cartella per salvare gli snapshot degli stati tra i riavvii ("" = disattivato)
+    SNAPSHOT_DIR: str = ""
+    SNAPSHOT_PERSIST_SECONDS: float = 30
+    # Campioni di storico in memoria per entità numerica (sparkline)
+    HISTORY_POINTS: int = 120
+    # Canale WebSocket persistente verso HA per le chiamate di servizio (fallback REST)
+    HA_WEBSOCKET_ENABLED: bool = True
+    HA_WS_CONNECT_TIMEOUT: float = 5
+    HA_WS_COMMAND_TIMEOUT: float = 10
+    HA_WS_RETRY_SECONDS: float = 30
+    # Raggruppamento degli eventi state_changed prima di applicarli agli snapshot
+    STATE_EVENTS_APPLY_SECONDS: float = 0.25
+    # Idempotency-Key: durata del risultato memorizzato e della prenotazione di una chiamata in corso
+    IDEMPOTENCY_TTL_SECONDS: float = 60
+    IDEMPOTENCY_PENDING_SECONDS: float = 30
+    # Registri HA (aree, dispositivi, entità): invalidati dagli eventi, il TTL è solo una rete di sicurezza
+    REGISTRY_TTL_SECONDS: float = 3600
+    # Configurazione, servizi e componenti degli host: validità della cache e max-age verso i client
+    HA_CONFIG_TTL_SECONDS: float = 3600
+    HA_CONFIG_MAX_AGE_SECONDS: float = 300
+    # Retry delle chiamate REST verso HA (backoff esponenziale con jitter) e hedging delle letture
+    UPSTREAM_RETRY_ATTEMPTS: int = 3
+    UPSTREAM_RETRY_BASE_SECONDS: float = 0.2
+    UPSTREAM_RETRY_MAX_BACKOFF_SECONDS: float = 2
+    UPSTREAM_HEDGE_ENABLED: bool = False
+    UPSTREAM_HEDGE_MIN_DELAY_SECONDS: float = 0.1
+    # Scadenza di default di ogni richiesta e massimo richiedibile con X-Request-Timeout
+    REQUEST_TIMEOUT_SECONDS: float = 30
+    REQUEST_TIMEOUT_MAX_SECONDS: float = 60
+    # Telecamere: durata in cache degli snapshot, stream condivisi per host, coda per spettatore
+    # (blocchi) e attesa prima di chiudere uno stream rimasto senza spettatori
+    CAMERA_SNAPSHOT_TTL_SECONDS: float = 2
+    CAMERA_MAX_STREAMS_PER_HOST: int = 8
+    CAMERA_STREAM_QUEUE_CHUNKS: int = 64
+    CAMERA_STREAM_LINGER_SECONDS: float = 5
 
     class Config:
         env_file = ".env"
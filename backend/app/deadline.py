@@ -0,0 +1,151 @@
+"""Scadenza per richiesta, propagata lungo tutta la pipeline.
+
+Ogni richiesta HTTP ha una scadenza: dall'header X-Request-Timeout (secondi, al
+più REQUEST_TIMEOUT_MAX_SECONDS) o dal default della rotta (ROUTE_TIMEOUTS,
+altrimenti REQUEST_TIMEOUT_SECONDS; None = nessuna scadenza, es. gli stream). La
+scadenza vive in un contextvar: ogni passo (query, risoluzione dei permessi,
+chiamate a HA) usa come timeout il tempo rimanente tramite timeout()/bound() e
+alla scadenza la richiesta termina con 504. Il middleware annulla la richiesta
+anche quando il client si disconnette, così il lavoro verso HA di chi ha già
+rinunciato non si accumula sotto carico. Fanno eccezione le chiamate con
+Idempotency-Key già avviate, che arrivano fino in fondo (vedi idempotency).
+
+I task condivisi tra più richieste (refresh degli snapshot, dei registri...)
+chiamano detach(): non ereditano la scadenza di chi li ha avviati."""
+import asyncio
+import json
+import re
+import time
+from contextvars import ContextVar
+from typing import Awaitable, Optional, TypeVar
+from fastapi import HTTPException
+from app.config import settings
+
+REQUEST_TIMEOUT_HEADER = "X-Request-Timeout"
+HARD_STOP_GRACE_SECONDS = 0.5  # margine perché i passi scadano da soli (es. risposte stale)
+
+# Default per rotta (percorso completo); None = nessuna scadenza
+ROUTE_TIMEOUTS: list[tuple[re.Pattern, Optional[float]]] = [
+    (re.compile(r"^/api/hosts/[^/]+/camera/[^/]+/stream$"), None),
+]
+
+T = TypeVar("T")
+
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+_stats = {"expired": 0, "disconnected": 0}
+
+def remaining() -> Optional[float]:
+    """Secondi alla scadenza della richiesta corrente (None = nessuna scadenza)."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+def expired() -> HTTPException:
+    _stats["expired"] += 1
+    return HTTPException(504, "Tempo massimo della richiesta superato")
+
+def timeout(default: float) -> float:
+    """Il minore tra `default` e il tempo rimanente; 504 se la scadenza è già passata."""
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise expired()
+    return min(default, left)
+
+async def bound(aw: Awaitable[T]) -> T:
+    """Attende `aw` entro il tempo rimanente della richiesta (504 alla scadenza)."""
+    left = remaining()
+    if left is None:
+        return await aw
+    try:
+        return await asyncio.wait_for(aw, timeout(left))
+    except asyncio.TimeoutError:
+        raise expired()
+
+def detach() -> None:
+    """Il task corrente (condiviso tra richieste) non ha scadenza."""
+    _deadline.set(None)
+
+def _request_timeout(scope) -> Optional[float]:
+    seconds = settings.REQUEST_TIMEOUT_SECONDS
+    for pattern, route_seconds in ROUTE_TIMEOUTS:
+        if pattern.match(scope["path"]):
+            seconds = route_seconds
+            break
+    header = dict(scope["headers"]).get(REQUEST_TIMEOUT_HEADER.lower().encode())
+    if header is not None:
+        try:
+            requested = float(header)
+        except ValueError:
+            requested = 0
+        if requested > 0:
+            seconds = min(requested, settings.REQUEST_TIMEOUT_MAX_SECONDS)
+    return seconds
+
+class DeadlineMiddleware:
+    """Imposta la scadenza della richiesta e annulla l'handler alla scadenza o alla
+    disconnessione del client. Il corpo della richiesta viene letto in anticipo
+    (le API sono JSON piccoli) per poter poi restare in ascolto della disconnessione."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        seconds = _request_timeout(scope)
+        token = _deadline.set(None if seconds is None else time.monotonic() + seconds)
+        messages: asyncio.Queue = asyncio.Queue()
+        disconnected = asyncio.Event()
+        state = {"started": False, "complete": False}
+
+        async def relay_receive():
+            if disconnected.is_set() and messages.empty():
+                return {"type": "http.disconnect"}
+            return await messages.get()
+
+        async def relay_send(message):
+            if message["type"] == "http.response.start":
+                state["started"] = True
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                state["complete"] = True
+            await send(message)
+
+        try:
+            handler = asyncio.create_task(self.app(scope, relay_receive, relay_send))
+        finally:
+            _deadline.reset(token)
+
+        async def watch():
+            while True:
+                message = await receive()
+                await messages.put(message)
+                if message["type"] == "http.disconnect":
+                    disconnected.set()
+                    if not state["complete"] and not handler.done():
+                        _stats["disconnected"] += 1
+                        handler.cancel()
+                    return
+
+        watcher = asyncio.create_task(watch())
+        try:
+            hard_stop = None if seconds is None else seconds + HARD_STOP_GRACE_SECONDS
+            done, _ = await asyncio.wait({handler}, timeout=hard_stop)
+            if not done:
+                handler.cancel()
+                await asyncio.gather(handler, return_exceptions=True)
+                if not state["started"]:
+                    error = expired()
+                    await send({"type": "http.response.start", "status": error.status_code,
+                                "headers": [(b"content-type", b"application/json")]})
+                    await send({"type": "http.response.body",
+                                "body": json.dumps({"detail": error.detail}).encode()})
+                return
+            if handler.cancelled():
+                return  # client disconnesso: nessuno a cui rispondere
+            handler.result()
+        finally:
+            watcher.cancel()
+
+def deadline_stats() -> dict:
+    return dict(_stats)
@@ -0,0 +1,82 @@
+"""Controllo di ammissione per host: al più N richieste in volo verso ogni istanza HA.
+
+Le richieste oltre il limite attendono in una coda limitata; se la coda è piena
+vengono rifiutate subito (429), se l'attesa supera HOST_QUEUE_WAIT_SECONDS
+ricevono 503 con Retry-After. I limiti sono per worker e si leggono dall'host
+(max_concurrency/max_queue), con i default di configurazione se non impostati."""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from fastapi import HTTPException
+from app.config import settings
+
+class HostGate:
+    def __init__(self, limit: int, max_queue: int):
+        self.limit = limit
+        self.max_queue = max_queue
+        self._sem = asyncio.Semaphore(limit)
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "max_queue": self.max_queue,
+                "in_flight": self.in_flight, "waiting": self.waiting,
+                "admitted": self.admitted, "rejected": self.rejected, "timed_out": self.timed_out,
+                "wait_avg_ms": round(self.wait_total / self.admitted * 1000, 1) if self.admitted else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 1)}
+
+_gates: dict[str, HostGate] = {}
+
+def _limits(host) -> tuple[int, int]:
+    limit = getattr(host, "max_concurrency", None) or settings.HOST_MAX_CONCURRENCY
+    max_queue = getattr(host, "max_queue", None)
+    return limit, settings.HOST_MAX_QUEUE if max_queue is None else max_queue
+
+def _gate(host) -> HostGate:
+    """Gate dell'host; se l'admin ha cambiato i limiti ne crea uno nuovo (le richieste in volo
+    finiscono sul vecchio semaforo, le nuove usano il nuovo)."""
+    key = str(host.id)
+    limit, max_queue = _limits(host)
+    gate = _gates.get(key)
+    if gate is None or gate.limit != limit or gate.max_queue != max_queue:
+        gate = _gates[key] = HostGate(limit, max_queue)
+    return gate
+
+@asynccontextmanager
+async def admit(host):
+    gate = _gate(host)
+    if gate._sem.locked() and gate.waiting >= gate.max_queue:
+        gate.rejected += 1
+        raise HTTPException(429, "Troppe richieste verso questo host, riprovare più tardi",
+                            headers={"Retry-After": "1"})
+    started = time.monotonic()
+    if not gate._sem.locked():
+        await gate._sem.acquire()  # posto libero: nessuna attesa
+    else:
+        gate.waiting += 1
+        try:
+            await asyncio.wait_for(gate._sem.acquire(), settings.HOST_QUEUE_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            gate.timed_out += 1
+            raise HTTPException(503, "Host sovraccarico, riprovare più tardi",
+                                headers={"Retry-After": str(max(1, round(settings.HOST_QUEUE_WAIT_SECONDS)))})
+        finally:
+            gate.waiting -= 1
+    waited = time.monotonic() - started
+    gate.admitted += 1
+    gate.wait_total += waited
+    gate.wait_max = max(gate.wait_max, waited)
+    gate.in_flight += 1
+    try:
+        yield
+    finally:
+        gate.in_flight -= 1
+        gate._sem.release()
+
+def admission_stats() -> dict:
+    return {host_id: gate.stats() for host_id, gate in _gates.items()}
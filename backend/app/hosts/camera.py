@@ -0,0 +1,209 @@
+"""Telecamere: snapshot in cache e stream MJPEG condivisi tra gli spettatori.
+
+Snapshot: GET /api/camera_proxy/<entità> di HA, con `width`/`height` opzionali
+(il ridimensionamento lo fa HA: miniature leggere per le griglie). Ogni immagine
+resta in cache CAMERA_SNAPSHOT_TTL_SECONDS per (host, entità, dimensioni) e le
+richieste concorrenti per la stessa chiave condividono un solo fetch.
+
+Stream: un solo collegamento a /api/camera_proxy_stream/<entità> per telecamera
+e per worker, qualunque sia il numero di spettatori. I blocchi letti da HA sono
+inoltrati così come arrivano (nessun frame viene ricomposto in memoria) alle code
+degli spettatori; un nuovo spettatore viene agganciato al primo boundary
+multipart, così riceve solo frame interi. Uno spettatore troppo lento (coda
+piena) viene disconnesso invece di rallentare gli altri. Senza spettatori il
+collegamento a HA viene chiuso dopo CAMERA_STREAM_LINGER_SECONDS.
+
+Gli stream non passano dal controllo di ammissione (occuperebbero un posto per
+tutta la loro durata): il loro numero per host è limitato a parte."""
+import asyncio
+import logging
+import re
+from typing import AsyncIterator, Optional
+import httpx
+from fastapi import HTTPException
+from app.cache import TTLCache
+from app.config import settings
+from app import deadline
+from app.hosts.upstream import auth_headers, get_client, request
+
+logger = logging.getLogger("homematrix.camera")
+
+STREAM_CONNECT_TIMEOUT = 10
+STREAM_READ_TIMEOUT = 30  # nessun byte per così tanto: telecamera ferma, si chiude
+
+_snapshots = TTLCache("camera_snapshots", maxsize=200, ttl=settings.CAMERA_SNAPSHOT_TTL_SECONDS)
+_fetching: dict[tuple, asyncio.Task] = {}
+
+def _check_status(resp: httpx.Response, entity_id: str) -> None:
+    if resp.status_code == 404:
+        raise HTTPException(404, f"Telecamera '{entity_id}' non trovata")
+    if resp.status_code != 200:
+        raise HTTPException(resp.status_code, "Errore comunicazione con HA")
+
+async def _fetch_snapshot(key: tuple, host, entity_id: str, params: dict) -> tuple[str, bytes]:
+    deadline.detach()
+    resp = await request(host, "GET", f"/api/camera_proxy/{entity_id}", params=params)
+    _check_status(resp, entity_id)
+    snapshot = (resp.headers.get("content-type", "image/jpeg"), resp.content)
+    _snapshots.set(key, snapshot)
+    return snapshot
+
+def _fetch_done(key: tuple, task: asyncio.Task) -> None:
+    if _fetching.get(key) is task:
+        del _fetching[key]
+    if not task.cancelled():
+        task.exception()  # recuperata: i chiamanti potrebbero essere già andati via
+
+async def get_snapshot(host, entity_id: str, width: Optional[int] = None,
+                       height: Optional[int] = None) -> tuple[str, bytes]:
+    """(content-type, immagine) dalla cache o da HA, un solo fetch per chiave."""
+    key = (str(host.id), entity_id, width, height)
+    cached = _snapshots.get(key)
+    if cached is not None:
+        return cached
+    task = _fetching.get(key)
+    if task is None:
+        params = {k: v for k, v in (("width", width), ("height", height)) if v}
+        task = _fetching[key] = asyncio.create_task(_fetch_snapshot(key, host, entity_id, params))
+        task.add_done_callback(lambda t: _fetch_done(key, t))
+    return await deadline.bound(asyncio.shield(task))
+
+def _boundary(content_type: str) -> Optional[bytes]:
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    return match.group(1).encode() if match and content_type.startswith("multipart/") else None
+
+class StreamHub:
+    """Collegamento MJPEG verso HA per una telecamera, ripartito tra le code degli spettatori."""
+
+    def __init__(self, key: tuple, host, entity_id: str):
+        self.key = key
+        self.host = host
+        self.entity_id = entity_id
+        self.content_type: Optional[str] = None
+        self.error: Optional[HTTPException] = None
+        self.ready = asyncio.Event()
+        self.bytes_in = 0
+        self.dropped = 0
+        self._viewers: dict[asyncio.Queue, bool] = {}  # coda -> già agganciata a un boundary
+        self._idle: Optional[asyncio.TimerHandle] = None
+        self._task = asyncio.create_task(self._run(), name=f"camera-{key[0]}-{entity_id}")
+
+    @property
+    def viewers(self) -> int:
+        return len(self._viewers)
+
+    def subscribe(self) -> asyncio.Queue:
+        if self._idle is not None:
+            self._idle.cancel()
+            self._idle = None
+        queue = asyncio.Queue(maxsize=settings.CAMERA_STREAM_QUEUE_CHUNKS)
+        self._viewers[queue] = False
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self._viewers.pop(queue, None)
+        if not self._viewers and self._idle is None and not self._task.done():
+            self._idle = asyncio.get_running_loop().call_later(settings.CAMERA_STREAM_LINGER_SECONDS, self._stop)
+
+    def _stop(self) -> None:
+        self._idle = None
+        if not self._viewers:
+            self._task.cancel()
+
+    @staticmethod
+    def _close(queue: asyncio.Queue) -> None:
+        """Fine stream per lo spettatore; se la coda è piena i blocchi ancora da inviare si perdono."""
+        while queue.full():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    def _dispatch(self, chunk: bytes, tail: bytes, marker: bytes) -> None:
+        first = None  # per chi attende: dal primo boundary in poi
+        if not all(self._viewers.values()):
+            window = tail + chunk
+            i = window.find(marker)
+            if i >= 0:
+                first = window[i + 2:]  # senza il CRLF che precede il boundary
+        for queue, joined in list(self._viewers.items()):
+            data = chunk if joined else first
+            if data is None:
+                continue
+            try:
+                queue.put_nowait(data)
+            except asyncio.QueueFull:
+                self.dropped += 1
+                del self._viewers[queue]
+                self._close(queue)
+                continue
+            self._viewers[queue] = True
+
+    async def _run(self) -> None:
+        deadline.detach()
+        url = f"{self.host.base_url}/api/camera_proxy_stream/{self.entity_id}"
+        timeout = httpx.Timeout(STREAM_CONNECT_TIMEOUT, read=STREAM_READ_TIMEOUT)
+        try:
+            async with get_client().stream("GET", url, headers=auth_headers(self.host), timeout=timeout) as resp:
+                _check_status(resp, self.entity_id)
+                content_type = resp.headers.get("content-type", "")
+                boundary = _boundary(content_type)
+                if boundary is None:
+                    raise HTTPException(502, "Stream della telecamera non MJPEG")
+                self.content_type = content_type
+                self.ready.set()
+                marker = b"\r\n--" + boundary
+                keep = len(marker) - 1
+                tail = b"\r\n"  # il primo boundary dello stream non ha il CRLF davanti
+                async for chunk in resp.aiter_bytes():
+                    self.bytes_in += len(chunk)
+                    self._dispatch(chunk, tail, marker)
+                    tail = chunk[-keep:] if len(chunk) >= keep else (tail + chunk)[-keep:]
+        except HTTPException as e:
+            self.error = e
+        except httpx.TimeoutException:
+            self.error = HTTPException(504, "Timeout comunicazione con HA")
+        except httpx.HTTPError as e:
+            logger.info("Stream telecamera %s interrotto: %s", self.entity_id, e)
+            self.error = HTTPException(502, "Errore comunicazione con HA")
+        finally:
+            self.ready.set()
+            if _hubs.get(self.key) is self:
+                del _hubs[self.key]
+            for queue in self._viewers:
+                self._close(queue)
+            self._viewers.clear()
+
+_hubs: dict[tuple, StreamHub] = {}
+
+async def _relay(hub: StreamHub, queue: asyncio.Queue) -> AsyncIterator[bytes]:
+    try:
+        while (chunk := await queue.get()) is not None:
+            yield chunk
+    finally:
+        hub.unsubscribe(queue)
+
+async def open_stream(host, entity_id: str) -> tuple[str, AsyncIterator[bytes]]:
+    """(content-type, blocchi) dello stream MJPEG condiviso della telecamera."""
+    key = (str(host.id), entity_id)
+    hub = _hubs.get(key)
+    if hub is None:
+        if sum(1 for k in _hubs if k[0] == key[0]) >= settings.CAMERA_MAX_STREAMS_PER_HOST:
+            raise HTTPException(429, "Troppi stream attivi verso questo host",
+                                headers={"Retry-After": str(int(settings.CAMERA_STREAM_LINGER_SECONDS) + 1)})
+        hub = _hubs[key] = StreamHub(key, host, entity_id)
+    queue = hub.subscribe()
+    try:
+        await asyncio.wait_for(hub.ready.wait(), deadline.timeout(STREAM_CONNECT_TIMEOUT))
+    except asyncio.TimeoutError:
+        hub.unsubscribe(queue)
+        raise HTTPException(504, "Timeout comunicazione con HA")
+    except BaseException:
+        hub.unsubscribe(queue)
+        raise
+    if hub.error is not None:
+        hub.unsubscribe(queue)
+        raise hub.error
+    return hub.content_type, _relay(hub, queue)
+
+def camera_stats() -> dict:
+    return {f"{host_id}/{entity_id}": {"viewers": hub.viewers, "bytes_in": hub.bytes_in, "dropped": hub.dropped}
+            for (host_id, entity_id), hub in _hubs.items()}
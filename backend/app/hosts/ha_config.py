@@ -0,0 +1,95 @@
+"""Dati di configurazione degli host HA (/api/config, /api/services, /api/components) in cache.
+
+Cambiano solo quando HA viene riconfigurato: restano validi HA_CONFIG_TTL_SECONDS,
+poi si serve la copia in cache mentre un refresh in background la aggiorna; gli
+eventi core_config_updated, component_loaded, service_registered e service_removed
+(sulla connessione WebSocket dell'host) la invalidano subito. Ogni voce ha un ETag
+sul corpo JSON: i client rivalidano con If-None-Match e ricevono 304 senza corpo."""
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from typing import Any
+from fastapi import HTTPException, Request, Response
+from app.config import settings
+from app import deadline
+from app.hosts import ha_ws
+from app.hosts.upstream import request
+
+logger = logging.getLogger("homematrix.ha_config")
+
+PATHS = {"config": "/api/config", "services": "/api/services", "components": "/api/components"}
+EVENTS = {"core_config_updated": ("config",),
+          "component_loaded": ("config", "components", "services"),
+          "service_registered": ("services",),
+          "service_removed": ("services",)}
+
+class Entry:
+    __slots__ = ("data", "body", "etag", "fetched_at")
+
+    def __init__(self, data: Any, body: bytes):
+        self.data = data
+        self.body = body
+        self.etag = make_etag(body)
+        self.fetched_at = time.monotonic()
+
+def make_etag(body: bytes) -> str:
+    return f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+_entries: dict[tuple[str, str], Entry] = {}
+_refreshing: dict[tuple[str, str], asyncio.Task] = {}
+_invalidated: set[tuple[str, str]] = set()
+
+async def _refresh(key: tuple[str, str], host) -> Entry:
+    deadline.detach()
+    _invalidated.discard(key)
+    resp = await request(host, "GET", PATHS[key[1]])
+    if resp.status_code != 200:
+        raise HTTPException(resp.status_code, "Errore comunicazione con HA")
+    entry = _entries[key] = Entry(resp.json(), resp.content)
+    return entry
+
+def _refresh_done(key: tuple[str, str], task: asyncio.Task) -> None:
+    if _refreshing.get(key) is task:
+        del _refreshing[key]
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Refresh %s host %s fallito: %s", key[1], key[0], task.exception())
+
+async def get_entry(host, kind: str) -> Entry:
+    """Voce in cache; se scaduta o invalidata il refresh parte in background e si serve la cache."""
+    key = (str(host.id), kind)
+    entry = _entries.get(key)
+    if (entry is not None and key not in _invalidated
+            and time.monotonic() - entry.fetched_at < settings.HA_CONFIG_TTL_SECONDS):
+        return entry
+    task = _refreshing.get(key)
+    if task is None:
+        task = _refreshing[key] = asyncio.create_task(_refresh(key, host))
+        task.add_done_callback(lambda t: _refresh_done(key, t))
+    if entry is not None:
+        return entry
+    return await deadline.bound(asyncio.shield(task))
+
+def conditional_response(request: Request, body: bytes, etag: str) -> Response:
+    """200 con il corpo JSON, o 304 se il client ha già questa versione (If-None-Match)."""
+    headers = {"ETag": etag, "Cache-Control": f"private, max-age={int(settings.HA_CONFIG_MAX_AGE_SECONDS)}"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or etag in (t.strip().removeprefix("W/") for t in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+def json_body(data: Any) -> bytes:
+    return json.dumps(data, separators=(",", ":")).encode()
+
+def _event(host_key: str, event: dict) -> None:
+    for kind in EVENTS[event.get("event_type")]:
+        _invalidated.add((host_key, kind))
+
+for _event_type in EVENTS:
+    ha_ws.add_event_listener(_event_type, _event)
+
+def forget(host_id) -> None:
+    for kind in PATHS:
+        _entries.pop((str(host_id), kind), None)
+        _invalidated.discard((str(host_id), kind))
@@ -0,0 +1,246 @@
+"""Canale WebSocket persistente verso ogni host HA (API websocket di Home Assistant).
+
+Una connessione autenticata per host e per worker, aperta alla prima richiesta e
+riusata: i comandi viaggiano come messaggi con `id` progressivo e la risposta
+`result` viene correlata per id. Se la connessione non è disponibile (host non
+raggiungibile, autenticazione rifiutata, WebSocket disattivato) il chiamante
+riceve WSUnavailable prima che il comando sia inviato e può ripiegare su REST;
+per qualche secondo i nuovi tentativi di connessione vengono evitati.
+
+Ogni connessione è sottoscritta agli eventi state_changed: i nuovi stati vanno ai
+listener registrati (gli snapshot) e vengono raggruppati per context, così una
+chiamata di servizio può restituire gli stati che ha modificato. Altri tipi di
+evento (es. *_registry_updated) vengono sottoscritti se qualcuno li ascolta."""
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+import websockets
+from fastapi import HTTPException
+from app.config import settings
+from app.crypto import decrypt
+from app import deadline
+from app.hosts.admission import admit
+
+logger = logging.getLogger("homematrix.ha_ws")
+
+RECENT_CONTEXTS = 500
+
+StateListener = Callable[[str, dict], None]
+_state_listeners: list[StateListener] = []
+EventListener = Callable[[str, dict], None]
+_event_listeners: dict[str, list[EventListener]] = {}
+
+def add_state_listener(listener: StateListener) -> None:
+    """listener(host_id, new_state) per ogni state_changed ricevuto da qualunque host."""
+    _state_listeners.append(listener)
+
+def add_event_listener(event_type: str, listener: EventListener) -> None:
+    """listener(host_id, event) per ogni evento `event_type` ricevuto da qualunque host."""
+    _event_listeners.setdefault(event_type, []).append(listener)
+
+class WSUnavailable(Exception):
+    """Il comando non è stato inviato: si può ripiegare su REST senza rischio di doppia esecuzione."""
+
+class HAConnection:
+    def __init__(self, host_key: str, base_url: str, token: str):
+        self.host_key = host_key
+        self.base_url = base_url
+        self.token = token  # cifrato, come a DB
+        self._ws = None
+        self._reader: Optional[asyncio.Task] = None
+        self._connecting = asyncio.Lock()
+        self._next_id = 1
+        self._pending: dict[int, asyncio.Future] = {}
+        self._listeners: dict[int, Callable[[dict], None]] = {}
+        self._retry_at = 0.0
+        self._by_context: OrderedDict[str, list[dict]] = OrderedDict()  # context id -> nuovi stati
+
+    @property
+    def url(self) -> str:
+        scheme, rest = self.base_url.split("://", 1)
+        return f"{'wss' if scheme == 'https' else 'ws'}://{rest}/api/websocket"
+
+    @property
+    def connected(self) -> bool:
+        return self._ws is not None
+
+    async def _connect(self) -> None:
+        async with self._connecting:
+            if self._ws is not None:
+                return
+            if time.monotonic() < self._retry_at:
+                raise WSUnavailable("Riconnessione in attesa")
+            try:
+                ws = await asyncio.wait_for(
+                    websockets.connect(self.url, max_size=None, ping_interval=30, ping_timeout=20),
+                    settings.HA_WS_CONNECT_TIMEOUT)
+                try:
+                    await asyncio.wait_for(self._authenticate(ws), settings.HA_WS_CONNECT_TIMEOUT)
+                except BaseException:
+                    await ws.close()
+                    raise
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException, WSUnavailable) as e:
+                self._retry_at = time.monotonic() + settings.HA_WS_RETRY_SECONDS
+                logger.warning("WebSocket verso host %s non disponibile: %s", self.host_key, e)
+                raise WSUnavailable(str(e)) from e
+            self._ws = ws
+            self._next_id = 1
+            self._reader = asyncio.create_task(self._read_loop(ws), name=f"ha-ws-{self.host_key}")
+            await self._on_connect()
+
+    async def _authenticate(self, ws) -> None:
+        hello = json.loads(await ws.recv())
+        if hello.get("type") != "auth_required":
+            raise WSUnavailable(f"Handshake inatteso: {hello.get('type')}")
+        await ws.send(json.dumps({"type": "auth", "access_token": decrypt(self.token)}))
+        reply = json.loads(await ws.recv())
+        if reply.get("type") != "auth_ok":
+            raise WSUnavailable("Autenticazione WebSocket rifiutata")
+
+    async def _on_connect(self) -> None:
+        """Sottoscrizioni da (ri)stabilire dopo ogni connessione."""
+        subscriptions = [("state_changed", self._state_changed)]
+        subscriptions += [(event_type, self._event) for event_type in _event_listeners]
+        for event_type, listener in subscriptions:
+            try:
+                await self.subscribe({"type": "subscribe_events", "event_type": event_type}, listener)
+            except (WSUnavailable, HTTPException) as e:
+                logger.warning("Sottoscrizione %s fallita (host %s): %s", event_type, self.host_key, e)
+
+    def _event(self, event: dict) -> None:
+        for listener in _event_listeners.get(event.get("event_type"), ()):
+            listener(self.host_key, event)
+
+    def _state_changed(self, event: dict) -> None:
+        new_state = (event.get("data") or {}).get("new_state")
+        if not new_state:
+            return  # entità rimossa: ci penserà il prossimo refresh completo
+        for listener in _state_listeners:
+            listener(self.host_key, new_state)
+        context_id = (new_state.get("context") or event.get("context") or {}).get("id")
+        if context_id:
+            self._by_context.setdefault(context_id, []).append(new_state)
+            self._by_context.move_to_end(context_id)
+            while len(self._by_context) > RECENT_CONTEXTS:
+                self._by_context.popitem(last=False)
+
+    def changed_states(self, context_id: str) -> list[dict]:
+        """Stati modificati da una chiamata (per context id). HA invia gli state_changed scritti
+        durante il servizio prima del `result` sulla stessa connessione e il reader li elabora
+        in ordine: quando il result è arrivato sono già qui, senza attese. Quelli successivi
+        (dispositivi che confermano dopo) aggiornano comunque gli snapshot."""
+        return self._by_context.pop(context_id, [])
+
+    async def _read_loop(self, ws) -> None:
+        try:
+            async for raw in ws:
+                msg = json.loads(raw)
+                if msg.get("type") == "result":
+                    future = self._pending.pop(msg.get("id"), None)
+                    if future is not None and not future.done():
+                        future.set_result(msg)
+                elif msg.get("type") == "event":
+                    listener = self._listeners.get(msg.get("id"))
+                    if listener is not None:
+                        try:
+                            listener(msg.get("event") or {})
+                        except Exception:
+                            logger.exception("Listener evento WebSocket fallito (host %s)", self.host_key)
+        except websockets.WebSocketException as e:
+            logger.info("WebSocket verso host %s chiuso: %s", self.host_key, e)
+        finally:
+            if self._ws is ws:
+                self._ws = None
+                self._listeners.clear()
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("WebSocket chiuso"))
+            self._pending.clear()
+
+    async def send(self, message: dict, timeout: float = None) -> dict:
+        """Invia un comando e attende il relativo `result`. WSUnavailable se non è stato possibile inviarlo."""
+        timeout = deadline.timeout(timeout or settings.HA_WS_COMMAND_TIMEOUT)
+        if self._ws is None:
+            await self._connect()
+        ws = self._ws
+        if ws is None:  # chiusa subito dopo la connessione (reader terminato o close())
+            raise WSUnavailable("Connessione chiusa")
+        msg_id = self._next_id
+        self._next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[msg_id] = future
+        try:
+            await ws.send(json.dumps({**message, "id": msg_id}))
+        except websockets.WebSocketException as e:
+            self._pending.pop(msg_id, None)
+            raise WSUnavailable(str(e)) from e
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self._pending.pop(msg_id, None)
+            raise HTTPException(504, "Timeout comunicazione con HA")
+        except ConnectionError:
+            raise HTTPException(502, "Connessione con HA interrotta")
+
+    async def subscribe(self, message: dict, listener: Callable[[dict], None]) -> int:
+        """Sottoscrizione (es. subscribe_events): gli eventi con lo stesso id vanno a `listener`."""
+        if self._ws is None:
+            await self._connect()
+        msg_id = self._next_id
+        self._listeners[msg_id] = listener
+        result = await self.send(message)
+        if not result.get("success"):
+            self._listeners.pop(msg_id, None)
+            raise WSUnavailable(str(result.get("error")))
+        return msg_id
+
+    async def close(self) -> None:
+        ws, self._ws = self._ws, None
+        if ws is not None:
+            await ws.close()
+        if self._reader is not None:
+            await asyncio.gather(self._reader, return_exceptions=True)
+
+_connections: dict[str, HAConnection] = {}
+_closing: set[asyncio.Task] = set()  # chiusure in corso delle connessioni sostituite
+
+def get_connection(host) -> HAConnection:
+    """Connessione dell'host; se URL o token sono cambiati la vecchia viene chiusa e sostituita."""
+    key = str(host.id)
+    conn = _connections.get(key)
+    if conn is None or conn.base_url != host.base_url or conn.token != host.token:
+        if conn is not None:
+            task = asyncio.create_task(conn.close())
+            _closing.add(task)
+            task.add_done_callback(_closing.discard)
+        conn = _connections[key] = HAConnection(key, host.base_url, host.token)
+    return conn
+
+# Errori HA -> status HTTP verso il client
+_ERROR_STATUS = {"not_found": 400, "invalid_format": 400, "service_validation_error": 400,
+                 "unauthorized": 403}
+
+async def call_service(host, domain: str, service: str, service_data: dict) -> list[dict]:
+    """call_service via WebSocket; restituisce gli stati modificati (come la risposta REST).
+    WSUnavailable se disattivato o non connesso (ripiegare su REST)."""
+    if not settings.HA_WEBSOCKET_ENABLED:
+        raise WSUnavailable("WebSocket disattivato")
+    conn = get_connection(host)
+    async with admit(host):
+        result = await conn.send({"type": "call_service", "domain": domain, "service": service,
+                                  "service_data": service_data})
+    if not result.get("success"):
+        error = result.get("error") or {}
+        raise HTTPException(_ERROR_STATUS.get(error.get("code"), 502),
+                            error.get("message") or "Errore chiamata servizio HA")
+    context_id = ((result.get("result") or {}).get("context") or {}).get("id")
+    if not context_id:
+        return []
+    return conn.changed_states(context_id)
+
+async def close_connections() -> None:
+    await asyncio.gather(*(conn.close() for conn in _connections.values()), *_closing, return_exceptions=True)
+    _connections.clear()
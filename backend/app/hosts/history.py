@@ -0,0 +1,84 @@
+"""Storico recente in memoria delle entità numeriche, per le sparkline dei widget.
+
+Ogni entità con stato numerico ha un ring buffer di dimensione fissa
+(HISTORY_POINTS campioni) su array tipizzati: istante in secondi (uint32) e
+valore (float32), 8 byte per campione. I buffer sono alimentati dai refresh
+degli snapshot che il proxy fa comunque, quindi le sparkline non costano
+richieste in più verso HA. Un campione viene aggiunto solo quando last_updated
+avanza; le entità sparite dall'host vengono rimosse."""
+import math
+import time
+from array import array
+from typing import Iterable
+from app.config import settings
+from app.hosts.state_store import EntityState
+
+class Ring:
+    __slots__ = ("times", "values", "next")
+
+    def __init__(self):
+        self.times = array("I")
+        self.values = array("f")
+        self.next = 0  # posizione del prossimo campione una volta pieno
+
+    def last_time(self) -> int:
+        return self.times[self.next - 1] if self.times else 0
+
+    def append(self, ts: int, value: float) -> None:
+        if len(self.times) < settings.HISTORY_POINTS:
+            self.times.append(ts)
+            self.values.append(value)
+            self.next = len(self.times) % settings.HISTORY_POINTS
+        else:
+            self.times[self.next] = ts
+            self.values[self.next] = value
+            self.next = (self.next + 1) % settings.HISTORY_POINTS
+
+    def last(self, n: int) -> list[list]:
+        """Ultimi n campioni in ordine cronologico, come [[epoch, valore], ...]."""
+        size = len(self.times)
+        n = min(n, size)
+        start = (self.next - n) % size if size else 0
+        return [[self.times[(start + i) % size], round(self.values[(start + i) % size], 4)] for i in range(n)]
+
+_rings: dict[str, dict[str, Ring]] = {}
+
+def _numeric(state) -> float:
+    try:
+        value = float(state)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+def record(host_key: str, states: Iterable[EntityState], partial: bool = False) -> None:
+    """Campiona gli stati numerici; con partial=False `states` è l'elenco completo dell'host
+    e le entità assenti vengono rimosse."""
+    rings = _rings.setdefault(host_key, {})
+    present = set()
+    now = int(time.time())
+    for e in states:
+        value = _numeric(e.state)
+        if value is None:
+            continue
+        present.add(e.entity_id)
+        ts = int(e.last_updated) if isinstance(e.last_updated, float) else now
+        ring = rings.get(e.entity_id)
+        if ring is None:
+            ring = rings[e.entity_id] = Ring()
+        elif ring.last_time() >= ts:
+            continue
+        ring.append(ts, value)
+    if not partial and len(rings) > len(present):
+        for entity_id in [k for k in rings if k not in present]:
+            del rings[entity_id]
+
+def get_history(host_key: str, entity_id: str, n: int) -> list[list]:
+    ring = _rings.get(host_key, {}).get(entity_id)
+    return ring.last(n) if ring else []
+
+def forget(host_key: str) -> None:
+    _rings.pop(host_key, None)
+
+def history_stats() -> dict:
+    return {key: {"entities": len(rings), "samples": sum(len(r.times) for r in rings.values())}
+            for key, rings in _rings.items()}
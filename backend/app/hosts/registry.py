@@ -0,0 +1,135 @@
+"""Registri HA (aree, dispositivi, entità) in cache per host.
+
+Non hanno equivalenti REST: si leggono con i comandi WebSocket
+config/*_registry/list sulla connessione persistente dell'host. Restano validi
+fino a REGISTRY_TTL_SECONDS o fino al primo evento *_registry_updated; nel
+frattempo (anche durante il refresh) si serve la versione in cache. Si conserva
+solo ciò che serve a raggruppare gli stati per stanza: nomi di aree e
+dispositivi e i collegamenti entità -> dispositivo/area."""
+import asyncio
+import logging
+import time
+from typing import Iterable, Optional
+from fastapi import HTTPException
+from app.config import settings
+from app import deadline
+from app.hosts import ha_ws
+from app.hosts.admission import admit
+
+logger = logging.getLogger("homematrix.registry")
+
+REGISTRIES = ("area", "device", "entity")
+REGISTRY_FIELDS = ("area", "device")
+
+class Registry:
+    __slots__ = ("areas", "devices", "entities", "fetched_at")
+
+    def __init__(self, areas: dict, devices: dict, entities: dict):
+        self.areas = areas        # area_id -> nome
+        self.devices = devices    # device_id -> (nome, area_id)
+        self.entities = entities  # entity_id -> (area_id, device_id)
+        self.fetched_at = time.monotonic()
+
+    def area_of(self, entity_id: str) -> Optional[str]:
+        """Area dell'entità; se non ne ha una propria, quella del suo dispositivo."""
+        area_id, device_id = self.entities.get(entity_id, (None, None))
+        if area_id is None and device_id in self.devices:
+            area_id = self.devices[device_id][1]
+        return area_id
+
+    def visible_areas(self, entity_ids: Iterable[str]) -> dict:
+        """Aree (id -> nome) delle entità indicate o dei loro dispositivi."""
+        area_ids = set()
+        for entity_id in entity_ids:
+            area_ids.add(self.area_of(entity_id))
+            device = self.devices.get(self.entities.get(entity_id, (None, None))[1])
+            if device is not None:
+                area_ids.add(device[1])
+        return {area_id: name for area_id, name in self.areas.items() if area_id in area_ids}
+
+    def describe(self, entity_id: str, fields: Iterable[str] = REGISTRY_FIELDS) -> dict:
+        out = {}
+        if "area" in fields:
+            area_id = self.area_of(entity_id)
+            out["area"] = {"id": area_id, "name": self.areas.get(area_id, area_id)} if area_id else None
+        if "device" in fields:
+            device_id = self.entities.get(entity_id, (None, None))[1]
+            device = self.devices.get(device_id)
+            out["device"] = {"id": device_id, "name": device[0]} if device else None
+        return out
+
+_registries: dict[str, Registry] = {}
+_refreshing: dict[str, asyncio.Task] = {}
+_invalidated: set[str] = set()
+
+def _parse(areas: list, devices: list, entities: list) -> Registry:
+    return Registry(
+        {a["area_id"]: a.get("name") or a["area_id"] for a in areas if a.get("area_id")},
+        {d["id"]: (d.get("name_by_user") or d.get("name"), d.get("area_id")) for d in devices if d.get("id")},
+        {e["entity_id"]: (e.get("area_id"), e.get("device_id")) for e in entities
+         if e.get("entity_id") and (e.get("area_id") or e.get("device_id"))})
+
+async def _fetch(host) -> Registry:
+    if not settings.HA_WEBSOCKET_ENABLED:
+        raise HTTPException(503, "Registri HA non disponibili: WebSocket disattivato")
+    conn = ha_ws.get_connection(host)
+    try:
+        async with admit(host):
+            results = await asyncio.gather(*(conn.send({"type": f"config/{name}_registry/list"})
+                                             for name in REGISTRIES))
+    except ha_ws.WSUnavailable:
+        raise HTTPException(503, "Registri HA non disponibili: WebSocket non raggiungibile")
+    if not all(r.get("success") for r in results):
+        raise HTTPException(502, "Errore lettura registri HA")
+    return _parse(*(r.get("result") or [] for r in results))
+
+async def _refresh(key: str, host) -> Registry:
+    deadline.detach()
+    _invalidated.discard(key)  # eventi durante il fetch -> un altro refresh al prossimo accesso
+    registry = _registries[key] = await _fetch(host)
+    return registry
+
+def _refresh_done(key: str, task: asyncio.Task) -> None:
+    if _refreshing.get(key) is task:
+        del _refreshing[key]
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Refresh registri host %s fallito: %s", key, task.exception())
+
+async def get_registry(host) -> Registry:
+    """Registri dell'host; se scaduti o invalidati il refresh parte in background e si serve la cache."""
+    key = str(host.id)
+    registry = _registries.get(key)
+    if (registry is not None and key not in _invalidated
+            and time.monotonic() - registry.fetched_at < settings.REGISTRY_TTL_SECONDS):
+        return registry
+    task = _refreshing.get(key)
+    if task is None:
+        task = _refreshing[key] = asyncio.create_task(_refresh(key, host))
+        task.add_done_callback(lambda t: _refresh_done(key, t))
+    if registry is not None:
+        return registry
+    return await deadline.bound(asyncio.shield(task))
+
+async def try_registry(host) -> Optional[Registry]:
+    """Come get_registry, ma None se i registri non sono disponibili (campi opzionali)."""
+    try:
+        return await get_registry(host)
+    except HTTPException:
+        return None
+
+def _registry_updated(host_key: str, event: dict) -> None:
+    _invalidated.add(host_key)
+
+for _name in REGISTRIES:
+    ha_ws.add_event_listener(f"{_name}_registry_updated", _registry_updated)
+
+def forget(host_id) -> None:
+    key = str(host_id)
+    _registries.pop(key, None)
+    _invalidated.discard(key)
+
+def registry_stats() -> dict:
+    now = time.monotonic()
+    return {key: {"areas": len(r.areas), "devices": len(r.devices), "entities": len(r.entities),
+                  "age": round(now - r.fetched_at, 1), "invalidated": key in _invalidated}
+            for key, r in _registries.items()}
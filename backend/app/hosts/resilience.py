@@ -0,0 +1,131 @@
+"""Politica di resilienza per le chiamate REST verso gli host HA.
+
+- Retry: gli errori di trasporto (Wi-Fi che perde un colpo, connessione chiusa
+  da HA) e i 502/503/504 di un proxy davanti ad HA vengono ritentati con backoff
+  esponenziale con jitter ("full jitter"), al più UPSTREAM_RETRY_ATTEMPTS tentativi
+  ed entro la scadenza complessiva della chiamata: il timeout del chiamante resta
+  il tempo massimo totale, non quello di ogni tentativo.
+- Hedging (UPSTREAM_HEDGE_ENABLED): se il primo tentativo non risponde entro il
+  p95 delle latenze recenti dell'host parte una seconda richiesta identica; vince
+  la prima risposta, l'altra viene annullata.
+
+Solo le chiamate idempotenti (letture) hanno retry completo e hedging. Le altre
+(chiamate di servizio) vengono ritentate solo se la richiesta non è certamente
+partita (connessione non stabilita): un secondo invio potrebbe eseguire due volte
+un toggle. Ogni tentativo passa dal controllo di ammissione dell'host."""
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional
+import httpx
+from app.config import settings
+
+LATENCY_SAMPLES = 200
+HEDGE_MIN_SAMPLES = 20
+MIN_ATTEMPT_SECONDS = 0.1  # sotto questo margine un nuovo tentativo non ha senso
+RETRY_STATUSES = frozenset({502, 503, 504})
+NOT_SENT = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+Attempt = Callable[[float], Awaitable[httpx.Response]]  # timeout del tentativo -> risposta
+
+class HostPolicy:
+    __slots__ = ("latencies", "retries", "hedges", "hedge_wins")
+
+    def __init__(self):
+        self.latencies: deque[float] = deque(maxlen=LATENCY_SAMPLES)
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def p95(self) -> Optional[float]:
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    def stats(self) -> dict:
+        p95 = self.p95()
+        return {"retries": self.retries, "hedges": self.hedges, "hedge_wins": self.hedge_wins,
+                "p95_ms": round(p95 * 1000, 1) if p95 is not None else None}
+
+_policies: dict[str, HostPolicy] = {}
+
+def _policy(key: str) -> HostPolicy:
+    policy = _policies.get(key)
+    if policy is None:
+        policy = _policies[key] = HostPolicy()
+    return policy
+
+def backoff(retry: int) -> float:
+    """Attesa prima del retry n (da 1): uniforme in [0, min(max, base * 2^(n-1))]."""
+    return random.uniform(0, min(settings.UPSTREAM_RETRY_MAX_BACKOFF_SECONDS,
+                                 settings.UPSTREAM_RETRY_BASE_SECONDS * 2 ** (retry - 1)))
+
+async def _timed(policy: HostPolicy, attempt: Attempt, timeout: float) -> httpx.Response:
+    started = time.monotonic()
+    resp = await attempt(timeout)
+    policy.latencies.append(time.monotonic() - started)
+    return resp
+
+async def _hedged(policy: HostPolicy, attempt: Attempt, timeout: float) -> httpx.Response:
+    delay = policy.p95()
+    if delay is not None:
+        delay = max(delay, settings.UPSTREAM_HEDGE_MIN_DELAY_SECONDS)
+    if delay is None or delay + MIN_ATTEMPT_SECONDS >= timeout:
+        return await _timed(policy, attempt, timeout)
+    first = asyncio.create_task(_timed(policy, attempt, timeout))
+    tasks = {first}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done:
+            return first.result()
+        policy.hedges += 1
+        second = asyncio.create_task(_timed(policy, attempt, timeout - delay))
+        tasks.add(second)
+        error = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is second:
+                        policy.hedge_wins += 1
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def call(key: str, attempt: Attempt, timeout: float, idempotent: bool) -> httpx.Response:
+    """Esegue `attempt` con la politica dell'host `key` entro `timeout` secondi complessivi."""
+    policy = _policy(key)
+    hedge = idempotent and settings.UPSTREAM_HEDGE_ENABLED
+    deadline = time.monotonic() + timeout
+    retry = 0
+    while True:
+        remaining = deadline - time.monotonic()
+        error = None
+        try:
+            resp = await (_hedged if hedge else _timed)(policy, attempt, remaining)
+            if not idempotent or resp.status_code not in RETRY_STATUSES:
+                return resp
+        except httpx.TransportError as e:
+            if not idempotent and not isinstance(e, NOT_SENT):
+                raise
+            error = e
+        retry += 1
+        delay = backoff(retry)
+        if retry >= settings.UPSTREAM_RETRY_ATTEMPTS or \
+                time.monotonic() + delay + MIN_ATTEMPT_SECONDS >= deadline:
+            if error is not None:
+                raise error
+            return resp
+        policy.retries += 1
+        await asyncio.sleep(delay)
+
+def forget(host_id) -> None:
+    _policies.pop(str(host_id), None)
+
+def resilience_stats() -> dict:
+    return {key: policy.stats() for key, policy in _policies.items()}
@@ -1,96 +1,147 @@
-from fastapi import APIRouter, Depends, HTTPException, Request
+import asyncio, logging, uuid
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
 from app.db import get_db
-from app.models import User, HAHost, UserRole, RolePermission
+from app.models import User
 from app.auth.router import get_current_user
-import httpx, json
-from app.crypto import decrypt
+import httpx
+from app.hosts.service import (get_active_host, get_entity_host, get_user_permissions, get_host_access,
+                               filter_states, select_states, is_entity_allowed)
+from app.hosts.state_store import to_dicts
+from app.pagination import DEFAULT_LIMIT, MAX_LIMIT, decode_cursor, paginate
+from app.hosts.upstream import request as upstream_request, call_service as upstream_call_service
+from app.hosts import camera, ha_config, registry, snapshots
+from app.config import settings
+from app import deadline
+from app.idempotency import idempotent, fingerprint
+
+logger = logging.getLogger("homematrix.hosts")
 
 router = APIRouter()
 
-async def get_active_host(host_id: str, db: AsyncSession) -> HAHost:
-    host = await db.get(HAHost, host_id)
-    if not host or not host.active:
-        raise HTTPException(404, "Host non trovato o non attivo")
-    return host
-
-async def get_user_permissions(user: User, host_id: str, db: AsyncSession):
-    """Restituisce (allowed_domains, allowed_entities) per l'utente su questo host.
-       None = nessun filtro (accesso totale). Admin = sempre accesso totale."""
-    if user.is_admin:
-        return None, None
-    result = await db.execute(
-        select(UserRole).where(UserRole.user_id == user.id))
-    user_roles = result.scalars().all()
-    if not user_roles:
-        raise HTTPException(403, "Nessun ruolo assegnato")
-    domains, entities = set(), set()
-    has_host = False
-    for ur in user_roles:
-        perm_result = await db.execute(
-            select(RolePermission).where(
-                RolePermission.role_id == ur.role_id,
-                RolePermission.host_id == host_id))
-        perms = perm_result.scalars().all()
-        for p in perms:
-            has_host = True
-            if p.allowed_domains:
-                domains.update(json.loads(p.allowed_domains))
-            if p.allowed_entities:
-                entities.update(json.loads(p.allowed_entities))
-    if not has_host:
-        raise HTTPException(403, "Accesso a questo host non autorizzato")
-    return list(domains) if domains else None, list(entities) if entities else None
-
-def filter_states(states: list, allowed_domains, allowed_entities) -> list:
-    if allowed_domains is None and allowed_entities is None:
-        return states
-    result = []
-    for s in states:
-        domain = s.get("entity_id", "").split(".")[0]
-        entity_id = s.get("entity_id", "")
-        if allowed_entities and entity_id in allowed_entities:
-            result.append(s)
-        elif allowed_domains and domain in allowed_domains:
-            result.append(s)
-    return result
+MAX_HOSTS_PER_REQUEST = 20
+
+@router.get("/states")
+async def get_multi_states(ids: str, timeout: float = Query(5, gt=0, le=30),
+                           db: AsyncSession = Depends(get_db),
+                           user: User = Depends(get_current_user)):
+    """Stati di più host in parallelo (`ids=a,b,c`), ciascuno con il proprio timeout.
+    Un host lento o irraggiungibile non blocca gli altri: il suo esito riporta l'ultimo
+    snapshot (stale/age) se disponibile, altrimenti l'errore. Il timeout non supera la
+    scadenza della richiesta."""
+    timeout = deadline.timeout(timeout)
+    host_ids = list(dict.fromkeys(i.strip() for i in ids.split(",") if i.strip()))
+    if not host_ids or len(host_ids) > MAX_HOSTS_PER_REQUEST:
+        raise HTTPException(400, f"Specificare da 1 a {MAX_HOSTS_PER_REQUEST} host")
+    normalized = {}  # id richiesto -> forma canonica
+    for hid in host_ids:
+        try: normalized[hid] = str(uuid.UUID(hid))
+        except ValueError: pass
+    access = await get_host_access(user, db, list(normalized.values()))
+
+    async def fetch_one(hid: str):
+        host, allowed_domains, allowed_entities = access[hid]
+        try:
+            states, age = await asyncio.wait_for(
+                snapshots.get_states(host, budget=min(timeout, settings.STATES_LATENCY_BUDGET_SECONDS)), timeout)
+            result = {"ok": True, "states": to_dicts(filter_states(states, allowed_domains, allowed_entities)),
+                      "stale": age is not None}
+            if age is not None: result["age"] = int(age)
+            return hid, result
+        except (asyncio.TimeoutError, httpx.TimeoutException):
+            return hid, {"ok": False, "status": 504, "error": "Timeout comunicazione con HA"}
+        except HTTPException as e:
+            return hid, {"ok": False, "status": e.status_code, "error": e.detail}
+        except httpx.HTTPError:
+            return hid, {"ok": False, "status": 502, "error": "Errore comunicazione con HA"}
+        except Exception:  # un errore imprevisto su un host non deve far fallire gli altri
+            logger.exception("Stati host %s non disponibili", hid)
+            return hid, {"ok": False, "status": 502, "error": "Errore comunicazione con HA"}
+
+    results = dict(await asyncio.gather(*(fetch_one(hid) for hid in access)))
+    missing = {"ok": False, "status": 404, "error": "Host non trovato, non attivo o non autorizzato"}
+    return {"hosts": {hid: results.get(normalized.get(hid), missing) for hid in host_ids}}
 
 @router.get("/{host_id}/states")
-async def get_states(host_id: str, db: AsyncSession = Depends(get_db),
+async def get_states(host_id: str, response: Response,
+                     domain: Optional[str] = None, q: Optional[str] = None,
+                     fields: Optional[str] = None,
+                     cursor: Optional[str] = None,
+                     limit: Optional[int] = Query(None, ge=1, le=MAX_LIMIT),
+                     db: AsyncSession = Depends(get_db),
                      user: User = Depends(get_current_user)):
+    """Stati autorizzati dell'host (dallo snapshot, con X-Stale/X-Snapshot-Age, se HA è lento o giù).
+    Filtri opzionali: `domain=light,switch`, `q=` su entity_id/friendly_name,
+    `fields=state,friendly_name` per proiettare gli attributi (`area`/`device` aggiungono
+    stanza e dispositivo dai registri HA in cache); con `limit=` la lista è paginata
+    per entity_id e il cursore della pagina successiva è nell'header X-Next-Cursor."""
     host = await get_active_host(host_id, db)
     allowed_domains, allowed_entities = await get_user_permissions(user, host_id, db)
-    async with httpx.AsyncClient(verify=True, timeout=10) as client:
-        resp = await client.get(f"{host.base_url}/api/states",
-                                headers={"Authorization": f"Bearer {decrypt(host.token)}"})
-    if resp.status_code != 200:
-        raise HTTPException(resp.status_code, "Errore comunicazione con HA")
-    states = resp.json()
-    return filter_states(states, allowed_domains, allowed_entities)
+    states, age = await snapshots.get_states(host)
+    snapshots.mark_stale(response, age)
+    states = filter_states(states, allowed_domains, allowed_entities)
+    domains = {d.strip() for d in domain.split(",") if d.strip()} if domain else None
+    states = select_states(states, domains, q)
+    if limit is not None or cursor:
+        states = sorted(states, key=lambda s: s.entity_id)
+        if cursor:
+            (after,) = decode_cursor(cursor, str)
+            states = [s for s in states if s.entity_id > after]
+        limit = limit or DEFAULT_LIMIT
+        states = paginate(states[:limit + 1], limit, lambda s: [s.entity_id], response)
+    if fields:
+        wanted = [f.strip() for f in fields.split(",") if f.strip()]
+        projected = [s.project(wanted) for s in states]
+        extra = [f for f in registry.REGISTRY_FIELDS if f in wanted]
+        if extra:
+            reg = await registry.try_registry(host)
+            for d in projected:
+                d.update(reg.describe(d["entity_id"], extra) if reg else dict.fromkeys(extra))
+        return projected
+    return to_dicts(states)
 
 @router.get("/{host_id}/states/{entity_id:path}")
 async def get_state(host_id: str, entity_id: str,
                     db: AsyncSession = Depends(get_db),
                     user: User = Depends(get_current_user)):
-    host = await get_active_host(host_id, db)
-    allowed_domains, allowed_entities = await get_user_permissions(user, host_id, db)
-    domain = entity_id.split(".")[0]
-    if allowed_entities and entity_id not in allowed_entities:
-        if not allowed_domains or domain not in allowed_domains:
-            raise HTTPException(403, "Entità non autorizzata")
-    async with httpx.AsyncClient(verify=True, timeout=10) as client:
-        resp = await client.get(f"{host.base_url}/api/states/{entity_id}",
-                                headers={"Authorization": f"Bearer {decrypt(host.token)}"})
+    host = await get_entity_host(host_id, entity_id, user, db)
+    resp = await upstream_request(host, "GET", f"/api/states/{entity_id}")
     if resp.status_code == 404:
         raise HTTPException(404, f"Entità '{entity_id}' non trovata")
     return resp.json()
 
+@router.get("/{host_id}/camera/{entity_id}/snapshot")
+async def get_camera_snapshot(host_id: str, entity_id: str,
+                              width: Optional[int] = Query(None, ge=16, le=3840),
+                              height: Optional[int] = Query(None, ge=16, le=2160),
+                              db: AsyncSession = Depends(get_db),
+                              user: User = Depends(get_current_user)):
+    """Immagine corrente della telecamera (in cache per pochi secondi); con `width`/`height`
+    HA la ridimensiona, per le miniature."""
+    host = await get_entity_host(host_id, entity_id, user, db)
+    content_type, image = await camera.get_snapshot(host, entity_id, width, height)
+    return Response(image, media_type=content_type,
+                    headers={"Cache-Control": f"private, max-age={int(settings.CAMERA_SNAPSHOT_TTL_SECONDS)}"})
+
+@router.get("/{host_id}/camera/{entity_id}/stream")
+async def get_camera_stream(host_id: str, entity_id: str,
+                            db: AsyncSession = Depends(get_db),
+                            user: User = Depends(get_current_user)):
+    """Stream MJPEG della telecamera, condiviso con gli altri spettatori della stessa telecamera."""
+    host = await get_entity_host(host_id, entity_id, user, db)
+    await db.close()  # la sessione resterebbe aperta (e la connessione occupata) per tutto lo stream
+    content_type, chunks = await camera.open_stream(host, entity_id)
+    return StreamingResponse(chunks, media_type=content_type, headers={"Cache-Control": "no-store"})
+
 @router.post("/{host_id}/services/{domain}/{service}")
 async def call_service(host_id: str, domain: str, service: str,
-                       request: Request,
+                       request: Request, response: Response,
                        db: AsyncSession = Depends(get_db),
                        user: User = Depends(get_current_user)):
+    """Chiamata di servizio; con l'header Idempotency-Key i duplicati (doppio tap, retry)
+    ricevono il risultato della prima chiamata senza raggiungere HA."""
     host = await get_active_host(host_id, db)
     allowed_domains, allowed_entities = await get_user_permissions(user, host_id, db)
     if allowed_domains and domain not in allowed_domains:
@@ -102,60 +153,78 @@ async def call_service(host_id: str, domain: str, service: str,
         if body["entity_id"] not in allowed_entities:
             if not allowed_domains or entity_domain not in allowed_domains:
                 raise HTTPException(403, "Entità non autorizzata")
-    async with httpx.AsyncClient(verify=True, timeout=10) as client:
-        resp = await client.post(
-            f"{host.base_url}/api/services/{domain}/{service}",
-            headers={"Authorization": f"Bearer {decrypt(host.token)}",
-                     "Content-Type": "application/json"},
-            json=body)
-    if resp.status_code not in (200, 201):
-        raise HTTPException(resp.status_code, "Errore chiamata servizio HA")
-    return resp.json()
+    async def call():
+        # Gli stati modificati aggiornano subito lo snapshot; al client solo quelli che può vedere
+        changed = snapshots.apply_states(host.id, await upstream_call_service(host, domain, service, body))
+        return to_dicts(filter_states(changed, allowed_domains, allowed_entities))
+    return await idempotent(request, response, user.id, fingerprint(body), call)
 
 @router.get("/{host_id}/config")
-async def get_ha_config(host_id: str, db: AsyncSession = Depends(get_db),
+async def get_ha_config(host_id: str, request: Request, db: AsyncSession = Depends(get_db),
                         user: User = Depends(get_current_user)):
+    """Configurazione dell'host (/api/config di HA), dalla cache, con ETag e Cache-Control."""
     host = await get_active_host(host_id, db)
-    async with httpx.AsyncClient(verify=True, timeout=10) as client:
-        resp = await client.get(f"{host.base_url}/api/config",
-                                headers={"Authorization": f"Bearer {decrypt(host.token)}"})
-    return resp.json()
+    await get_user_permissions(user, host_id, db)
+    entry = await ha_config.get_entry(host, "config")
+    return ha_config.conditional_response(request, entry.body, entry.etag)
+
+@router.get("/{host_id}/services")
+async def get_ha_services(host_id: str, request: Request, db: AsyncSession = Depends(get_db),
+                          user: User = Depends(get_current_user)):
+    """Servizi disponibili sull'host, limitati ai domini che l'utente può controllare."""
+    host = await get_active_host(host_id, db)
+    allowed_domains, allowed_entities = await get_user_permissions(user, host_id, db)
+    entry = await ha_config.get_entry(host, "services")
+    if allowed_domains is None and allowed_entities is None:
+        return ha_config.conditional_response(request, entry.body, entry.etag)
+    domains = set(allowed_domains or ()) | {e.split(".")[0] for e in allowed_entities or ()}
+    body = ha_config.json_body([s for s in entry.data if s.get("domain") in domains])
+    return ha_config.conditional_response(request, body, ha_config.make_etag(body))
+
+@router.get("/{host_id}/components")
+async def get_ha_components(host_id: str, request: Request, db: AsyncSession = Depends(get_db),
+                            user: User = Depends(get_current_user)):
+    """Integrazioni caricate sull'host (/api/components di HA), dalla cache, con ETag e Cache-Control."""
+    host = await get_active_host(host_id, db)
+    await get_user_permissions(user, host_id, db)
+    entry = await ha_config.get_entry(host, "components")
+    return ha_config.conditional_response(request, entry.body, entry.etag)
 
 @router.get("/{host_id}/domains")
 async def get_domains(host_id: str, db: AsyncSession = Depends(get_db),
                       user: User = Depends(get_current_user)):
+    """Domini, entità e aree dell'host visibili all'utente (tutti per gli admin)."""
     host = await get_active_host(host_id, db)
-    async with httpx.AsyncClient(verify=True, timeout=15) as client:
-        resp = await client.get(f"{host.base_url}/api/states",
-                                headers={"Authorization": f"Bearer {decrypt(host.token)}"})
-    if resp.status_code != 200:
-        raise HTTPException(resp.status_code, "Errore comunicazione con HA")
-    states = resp.json()
-    domains = sorted(set(s["entity_id"].split(".")[0] for s in states))
-    entities = sorted(s["entity_id"] for s in states)
-    return {"domains": domains, "entities": entities}
+    allowed_domains, allowed_entities = await get_user_permissions(user, host_id, db)
+    states, _ = await snapshots.get_states(host)
+    states = filter_states(states, allowed_domains, allowed_entities)
+    domains = sorted(set(s.domain for s in states))
+    entities = sorted(s.entity_id for s in states)
+    reg = await registry.try_registry(host)
+    areas = sorted(reg.visible_areas(entities).values()) if reg else []
+    return {"domains": domains, "entities": entities, "areas": areas}
+
+@router.get("/{host_id}/registry")
+async def get_registry(host_id: str, db: AsyncSession = Depends(get_db),
+                       user: User = Depends(get_current_user)):
+    """Aree, dispositivi e collegamenti delle entità autorizzate, dai registri HA in cache."""
+    host = await get_active_host(host_id, db)
+    allowed_domains, allowed_entities = await get_user_permissions(user, host_id, db)
+    reg = await registry.get_registry(host)
+    entities = {entity_id: {"area_id": reg.area_of(entity_id), "device_id": device_id}
+                for entity_id, (_, device_id) in reg.entities.items()
+                if is_entity_allowed(entity_id, allowed_domains, allowed_entities)}
+    device_ids = {e["device_id"] for e in entities.values() if e["device_id"]}
+    areas = reg.areas if allowed_domains is None and allowed_entities is None else reg.visible_areas(entities)
+    return {"areas": [{"id": area_id, "name": name}
+                      for area_id, name in sorted(areas.items(), key=lambda a: a[1].lower())],
+            "devices": {device_id: {"name": name, "area_id": area_id}
+                        for device_id, (name, area_id) in reg.devices.items() if device_id in device_ids},
+            "entities": entities}
 
 @router.get("/")
 async def get_my_hosts(db: AsyncSession = Depends(get_db),
                        user: User = Depends(get_current_user)):
     """Restituisce gli host accessibili all'utente corrente."""
-    if user.is_admin:
-        result = await db.execute(select(HAHost).where(HAHost.active == True))
-        hosts = result.scalars().all()
-    else:
-        result = await db.execute(
-            select(UserRole).where(UserRole.user_id == user.id))
-        user_roles = result.scalars().all()
-        host_ids = set()
-        for ur in user_roles:
-            perm_result = await db.execute(
-                select(RolePermission).where(RolePermission.role_id == ur.role_id))
-            perms = perm_result.scalars().all()
-            for p in perms:
-                host_ids.add(str(p.host_id))
-        if not host_ids:
-            return []
-        result = await db.execute(
-            select(HAHost).where(HAHost.active == True))
-        hosts = [h for h in result.scalars().all() if str(h.id) in host_ids]
-    return [{"id": str(h.id), "name": h.name, "description": h.description} for h in hosts]
+    access = await get_host_access(user, db)
+    return [{"id": hid, "name": a.host.name, "description": a.host.description} for hid, a in access.items()]
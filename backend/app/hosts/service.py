@@ -0,0 +1,96 @@
+"""Risoluzione dei permessi utente sugli host HA e filtro degli stati."""
+import json
+from typing import Iterable, NamedTuple, Optional
+from fastapi import HTTPException
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.models import User, HAHost, UserRole, RolePermission
+from app.hosts.state_store import EntityState
+from app import deadline
+
+class HostAccess(NamedTuple):
+    host: HAHost
+    allowed_domains: Optional[list]   # None = nessun filtro
+    allowed_entities: Optional[list]  # None = nessun filtro
+
+async def get_active_host(host_id: str, db: AsyncSession) -> HAHost:
+    host = await deadline.bound(db.get(HAHost, host_id))
+    if not host or not host.active:
+        raise HTTPException(404, "Host non trovato o non attivo")
+    return host
+
+def _merge(perms) -> tuple:
+    domains, entities = set(), set()
+    for allowed_domains, allowed_entities in perms:
+        if allowed_domains:
+            domains.update(json.loads(allowed_domains))
+        if allowed_entities:
+            entities.update(json.loads(allowed_entities))
+    return list(domains) if domains else None, list(entities) if entities else None
+
+async def get_user_permissions(user: User, host_id: str, db: AsyncSession):
+    """Restituisce (allowed_domains, allowed_entities) per l'utente su questo host.
+       None = nessun filtro (accesso totale). Admin = sempre accesso totale."""
+    if user.is_admin:
+        return None, None
+    result = await deadline.bound(db.execute(
+        select(RolePermission.allowed_domains, RolePermission.allowed_entities)
+        .join(UserRole, UserRole.role_id == RolePermission.role_id)
+        .where(UserRole.user_id == user.id, RolePermission.host_id == host_id)))
+    perms = result.all()
+    if not perms:
+        raise HTTPException(403, "Accesso a questo host non autorizzato")
+    return _merge(perms)
+
+async def get_entity_host(host_id: str, entity_id: str, user: User, db: AsyncSession) -> HAHost:
+    """Host attivo dopo il controllo dei permessi sulla singola entità (403 se non autorizzata)."""
+    host = await get_active_host(host_id, db)
+    allowed_domains, allowed_entities = await get_user_permissions(user, host_id, db)
+    if not is_entity_allowed(entity_id, allowed_domains, allowed_entities):
+        raise HTTPException(403, "Entità non autorizzata")
+    return host
+
+async def get_host_access(user: User, db: AsyncSession, host_ids: list = None) -> dict[str, HostAccess]:
+    """Host attivi accessibili all'utente con i rispettivi filtri, in un'unica query.
+       `host_ids` limita la risoluzione a quegli host."""
+    if user.is_admin:
+        query = select(HAHost).where(HAHost.active == True)
+        if host_ids is not None:
+            query = query.where(HAHost.id.in_(host_ids))
+        result = await deadline.bound(db.execute(query.order_by(HAHost.name)))
+        return {str(h.id): HostAccess(h, None, None) for h in result.scalars().all()}
+    query = (select(HAHost, RolePermission.allowed_domains, RolePermission.allowed_entities)
+             .join(RolePermission, RolePermission.host_id == HAHost.id)
+             .join(UserRole, UserRole.role_id == RolePermission.role_id)
+             .where(UserRole.user_id == user.id, HAHost.active == True))
+    if host_ids is not None:
+        query = query.where(HAHost.id.in_(host_ids))
+    result = await deadline.bound(db.execute(query.order_by(HAHost.name)))
+    hosts, perms = {}, {}
+    for host, allowed_domains, allowed_entities in result.all():
+        hid = str(host.id)
+        hosts[hid] = host
+        perms.setdefault(hid, []).append((allowed_domains, allowed_entities))
+    return {hid: HostAccess(hosts[hid], *_merge(perms[hid])) for hid in hosts}
+
+def is_entity_allowed(entity_id: str, allowed_domains, allowed_entities) -> bool:
+    if allowed_domains is None and allowed_entities is None:
+        return True
+    if allowed_entities and entity_id in allowed_entities:
+        return True
+    return bool(allowed_domains) and entity_id.split(".")[0] in allowed_domains
+
+def filter_states(states: Iterable[EntityState], allowed_domains, allowed_entities) -> list:
+    if allowed_domains is None and allowed_entities is None:
+        return list(states)
+    return [s for s in states if is_entity_allowed(s.entity_id, allowed_domains, allowed_entities)]
+
+def select_states(states: list, domains=None, q: str = None) -> list:
+    """Filtra per dominio (insieme) e per testo su entity_id/friendly_name, senza distinzione di maiuscole."""
+    if domains:
+        states = [s for s in states if s.domain in domains]
+    if q:
+        q = q.lower()
+        states = [s for s in states
+                  if q in s.entity_id.lower() or q in str(s.attribute("friendly_name", "")).lower()]
+    return states
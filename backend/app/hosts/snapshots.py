@@ -0,0 +1,212 @@
+"""Ultimo stato valido per host (stale-while-revalidate).
+
+Ogni lettura degli stati avvia (o riusa) un unico refresh per host. Se entro il
+budget di latenza il refresh non termina, o fallisce, si risponde subito con lo
+snapshot precedente marcato come stale; il refresh prosegue in background e
+aggiorna lo snapshot per le richieste successive.
+
+Con SNAPSHOT_DIR impostato gli snapshot vengono salvati periodicamente su disco
+(un file JSON gzip per host, sostituito atomicamente) e ricaricati all'avvio:
+dopo un riavvio le prime richieste sono servite subito, come stale, mentre
+arrivano i dati live."""
+import asyncio
+import gzip
+import itertools
+import json
+import logging
+import os
+import time
+import uuid
+from typing import NamedTuple, Optional
+import httpx
+from fastapi import HTTPException, Response
+from app.config import settings
+from app import deadline
+from app.hosts.upstream import fetch_states
+from app.hosts import ha_ws
+from app.hosts.state_store import EntityState, compact, to_dicts, memory_report
+from app.hosts import history
+
+logger = logging.getLogger("homematrix.snapshots")
+
+STALE_HEADER = "X-Stale"
+SNAPSHOT_AGE_HEADER = "X-Snapshot-Age"
+
+class Snapshot(NamedTuple):
+    states: tuple[EntityState, ...]
+    fetched_at: float  # epoch, per poterlo persistere
+
+_snapshots: dict[str, Snapshot] = {}
+_refreshing: dict[str, asyncio.Task] = {}
+# Versione di ogni snapshot, incrementata a ogni modifica (refresh completo o stati puntuali,
+# che non cambiano fetched_at): la persistenza scrive gli host con versione diversa da quella salvata
+_version = itertools.count(1)
+_versions: dict[str, int] = {}
+_persisted: dict[str, int] = {}  # host -> versione dell'ultimo snapshot scritto su disco
+_touched: dict[str, dict[str, float]] = {}  # host -> entità aggiornate puntualmente -> istante (monotonic)
+_pending_events: dict[str, dict[str, dict]] = {}
+
+def _store(key: str, snapshot: Snapshot) -> None:
+    _snapshots[key] = snapshot
+    _versions[key] = next(_version)
+
+async def _refresh(key: str, host) -> tuple[EntityState, ...]:
+    deadline.detach()  # refresh condiviso: prosegue anche oltre la scadenza di chi l'ha avviato
+    started = time.monotonic()
+    raw = await fetch_states(host)
+    previous = _snapshots.get(key)
+    states = compact(raw, previous.states if previous else ())
+    # Aggiornamenti puntuali arrivati durante la GET sono più recenti della risposta: prevalgono
+    touched = _touched.pop(key, {})
+    newer = {eid for eid, at in touched.items() if at >= started}
+    if newer and previous is not None:
+        kept = {e.entity_id: e for e in previous.states if e.entity_id in newer}
+        states = tuple(kept.get(e.entity_id, e) for e in states)
+        _touched[key] = {eid: touched[eid] for eid in newer}
+    _store(key, Snapshot(states, time.time()))
+    history.record(key, states)
+    return states
+
+def apply_states(host_id: str, raw_states: list) -> tuple[EntityState, ...]:
+    """Aggiorna subito lo snapshot con stati puntuali (risposta di una chiamata di servizio o
+    eventi state_changed) e restituisce i record aggiornati; l'età dello snapshot non cambia."""
+    key = str(host_id)
+    snapshot = _snapshots.get(key)
+    updated = compact(raw_states, snapshot.states if snapshot else ())
+    if snapshot is not None and updated:
+        by_id = {e.entity_id: e for e in updated}
+        merged = tuple(by_id.pop(e.entity_id, e) for e in snapshot.states) + tuple(by_id.values())
+        _store(key, Snapshot(merged, snapshot.fetched_at))
+        now = time.monotonic()
+        _touched.setdefault(key, {}).update((e.entity_id, now) for e in updated)
+        history.record(key, updated, partial=True)
+    return updated
+
+def _on_state_changed(host_id: str, new_state: dict) -> None:
+    """Eventi state_changed dal WebSocket: applicati a blocchi per non ricostruire lo snapshot a ogni evento."""
+    pending = _pending_events.get(host_id)
+    if pending is None:
+        pending = _pending_events[host_id] = {}
+        asyncio.get_running_loop().call_later(settings.STATE_EVENTS_APPLY_SECONDS, _apply_pending, host_id)
+    pending[new_state.get("entity_id")] = new_state
+
+def _apply_pending(host_id: str) -> None:
+    pending = _pending_events.pop(host_id, None)
+    if pending:
+        apply_states(host_id, list(pending.values()))
+
+ha_ws.add_state_listener(_on_state_changed)
+
+def _done(key: str, task: asyncio.Task) -> None:
+    _refreshing.pop(key, None)
+    if not task.cancelled():
+        task.exception()  # l'errore è già gestito da chi attende: evita il warning
+
+def _refresh_task(host) -> asyncio.Task:
+    """Un solo refresh in corso per host, condiviso da tutte le richieste concorrenti."""
+    key = str(host.id)
+    task = _refreshing.get(key)
+    if task is None:
+        task = _refreshing[key] = asyncio.create_task(_refresh(key, host))
+        task.add_done_callback(lambda t: _done(key, t))
+    return task
+
+async def get_states(host, budget: float = None) -> tuple[tuple[EntityState, ...], Optional[float]]:
+    """Stati dell'host e, se serviti dallo snapshot, la sua età in secondi (None = dati freschi).
+    Senza snapshot si attende il refresh e gli errori di HA si propagano."""
+    task = _refresh_task(host)
+    snapshot = _snapshots.get(str(host.id))
+    if snapshot is None:
+        return await deadline.bound(asyncio.shield(task)), None
+    try:
+        return await asyncio.wait_for(asyncio.shield(task),
+                                      deadline.timeout(settings.STATES_LATENCY_BUDGET_SECONDS
+                                                       if budget is None else budget)), None
+    except (asyncio.TimeoutError, HTTPException, httpx.HTTPError):
+        return snapshot.states, max(0.0, time.time() - snapshot.fetched_at)
+
+def has_snapshot(host_id: str) -> bool:
+    return str(host_id) in _snapshots
+
+def find_entity(host_id: str, entity_id: str) -> Optional[EntityState]:
+    """Entità nello snapshot corrente dell'host, senza refresh."""
+    snapshot = _snapshots.get(str(host_id))
+    if snapshot is None:
+        return None
+    return next((e for e in snapshot.states if e.entity_id == entity_id), None)
+
+def mark_stale(response: Response, age: Optional[float]) -> None:
+    if age is not None:
+        response.headers[STALE_HEADER] = "1"
+        response.headers[SNAPSHOT_AGE_HEADER] = str(int(age))
+
+def forget(host_id: str) -> None:
+    _snapshots.pop(str(host_id), None)
+    _versions.pop(str(host_id), None)
+    _persisted.pop(str(host_id), None)
+    history.forget(str(host_id))
+    _touched.pop(str(host_id), None)
+    if settings.SNAPSHOT_DIR:
+        try: os.remove(_path(str(host_id)))
+        except (OSError, ValueError): pass
+
+def snapshot_stats() -> dict:
+    """Memoria ed età degli snapshot per host, per le metriche admin."""
+    now = time.time()
+    return {key: {**memory_report(snap.states), "age": int(now - snap.fetched_at)}
+            for key, snap in _snapshots.items()}
+
+# ── Persistenza su disco ──
+
+def _path(key: str) -> str:
+    return os.path.join(settings.SNAPSHOT_DIR, f"{uuid.UUID(key)}.json.gz")  # ValueError se non è un id
+
+def _write(key: str, snapshot: Snapshot) -> None:
+    path = _path(key)
+    tmp = f"{path}.{os.getpid()}.tmp"  # più worker possono scrivere lo stesso host
+    with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=5) as f:
+        json.dump({"fetched_at": snapshot.fetched_at, "states": to_dicts(snapshot.states)}, f, separators=(",", ":"))
+    os.replace(tmp, path)
+
+def _read_all() -> dict[str, Snapshot]:
+    loaded = {}
+    for name in os.listdir(settings.SNAPSHOT_DIR):
+        if not name.endswith(".json.gz"):
+            continue
+        key = name[:-len(".json.gz")]
+        try:
+            with gzip.open(os.path.join(settings.SNAPSHOT_DIR, name), "rt", encoding="utf-8") as f:
+                data = json.load(f)
+            loaded[str(uuid.UUID(key))] = Snapshot(compact(data["states"]), float(data["fetched_at"]))
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.warning("Snapshot non leggibile ignorato: %s", name)
+    return loaded
+
+async def persist_snapshots() -> None:
+    """Scrive su disco gli snapshot cambiati dall'ultimo salvataggio."""
+    if not settings.SNAPSHOT_DIR:
+        return
+    changed = {k: (snap, _versions.get(k)) for k, snap in _snapshots.items()
+               if _persisted.get(k) != _versions.get(k)}
+    if not changed:
+        return
+    def write_all():
+        os.makedirs(settings.SNAPSHOT_DIR, exist_ok=True)
+        for key, (snap, version) in changed.items():
+            try:
+                _write(key, snap)
+                _persisted[key] = version
+            except (OSError, ValueError):
+                logger.exception("Salvataggio snapshot fallito per host %s", key)
+    await asyncio.to_thread(write_all)
+
+async def load_snapshots() -> None:
+    """All'avvio: carica gli snapshot salvati senza sovrascrivere quelli già presenti in memoria."""
+    if not settings.SNAPSHOT_DIR or not os.path.isdir(settings.SNAPSHOT_DIR):
+        return
+    loaded = await asyncio.to_thread(_read_all)
+    for key, snap in loaded.items():
+        if key not in _snapshots:
+            _store(key, snap)
+            _persisted[key] = _versions[key]
+    logger.info("Caricati %d snapshot da %s", len(loaded), settings.SNAPSHOT_DIR)
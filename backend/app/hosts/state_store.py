@@ -0,0 +1,199 @@
+"""Rappresentazione compatta degli stati HA tenuti in memoria.
+
+Con decine di host da migliaia di entità i dict JSON "grezzi" ripetono ovunque
+le stesse chiavi e gli stessi valori. Qui:
+- ogni entità è un record con __slots__;
+- entity_id, domini, stati, chiavi e valori testuali brevi sono internati;
+- i dict (attributi e dict annidati, es. le previsioni meteo) diventano tuple di
+  valori con la tupla delle chiavi ("forma") condivisa; le liste diventano tuple;
+- i timestamp ISO, anche annidati, sono tenuti come epoch float (riformattati
+  identici in uscita, altrimenti restano stringhe);
+- gli attributi invariati rispetto allo snapshot precedente riusano lo stesso
+  oggetto e quelli piccoli e identici tra entità sono condivisi.
+`context` (id interni di HA, unici per entità e non usati dai client) non viene
+conservato. to_dict()/project() ricostruiscono la forma JSON di HA solo al
+momento della risposta, dopo i filtri."""
+import sys
+from datetime import datetime, timezone
+from typing import Any, Iterable, Optional, Union
+
+INTERN_MAX_LEN = 100     # stringhe più lunghe (es. testi, URL firmati) non vengono internate
+SHARED_ATTRS_MAX_KEYS = 4
+SHARED_ATTRS_MAX = 20000
+SHAPES_MAX = 20000
+
+STATE_FIELDS = ("entity_id", "state", "last_changed", "last_updated")
+
+_shapes: dict[tuple, tuple] = {}
+_shared_attrs: dict["Packed", "Packed"] = {}
+
+class Packed(tuple):
+    """Dict compattato: (forma, valore1, valore2, ...), con la forma condivisa tra dict con le stesse chiavi."""
+    __slots__ = ()
+
+    def unpack(self) -> dict:
+        return dict(zip(self[0], map(_unpack, self[1:])))
+
+class Timestamp(float):
+    """Timestamp ISO annidato negli attributi (es. previsioni), tenuto come epoch."""
+    __slots__ = ()
+
+class EntityState:
+    __slots__ = ("entity_id", "domain", "state", "attributes", "last_changed", "last_updated")
+
+    def __init__(self, entity_id: str, domain: str, state: Any, attributes: Packed,
+                 last_changed: Union[float, str, None], last_updated: Union[float, str, None]):
+        self.entity_id = entity_id
+        self.domain = domain
+        self.state = state
+        self.attributes = attributes
+        self.last_changed = last_changed
+        self.last_updated = last_updated
+
+    def attribute(self, name: str, default: Any = None) -> Any:
+        shape = self.attributes[0]
+        return _unpack(self.attributes[shape.index(name) + 1]) if name in shape else default
+
+    def to_dict(self) -> dict:
+        return {"entity_id": self.entity_id, "state": self.state, "attributes": self.attributes.unpack(),
+                "last_changed": _format_time(self.last_changed), "last_updated": _format_time(self.last_updated)}
+
+    def project(self, fields: Iterable[str]) -> dict:
+        """Solo i campi richiesti: quelli di primo livello restano tali, gli altri sono
+        attributi e finiscono in `attributes`. entity_id è sempre incluso; gli attributi
+        non richiesti non vengono nemmeno ricostruiti."""
+        out = {"entity_id": self.entity_id}
+        attributes = {}
+        for f in fields:
+            if f in STATE_FIELDS:
+                out[f] = _format_time(getattr(self, f))
+            elif f in self.attributes[0]:
+                attributes[f] = self.attribute(f)
+        out["attributes"] = attributes
+        return out
+
+def _shape(keys: tuple) -> tuple:
+    shape = _shapes.get(keys)
+    if shape is None:
+        if len(_shapes) >= SHAPES_MAX:
+            _shapes.clear()
+        shape = _shapes[keys] = tuple(sys.intern(str(k)) for k in keys)
+    return shape
+
+def _pack(value: Any) -> Any:
+    if isinstance(value, str):
+        if _looks_like_time(value):
+            ts = _parse_time(value)
+            if isinstance(ts, float):
+                return Timestamp(ts)
+        return sys.intern(value) if len(value) <= INTERN_MAX_LEN else value
+    if isinstance(value, dict):
+        return Packed((_shape(tuple(value)), *map(_pack, value.values())))
+    if isinstance(value, list):
+        return tuple(map(_pack, value))
+    return value
+
+def _unpack(value: Any) -> Any:
+    if type(value) is Packed:
+        return value.unpack()
+    if type(value) is tuple:
+        return list(map(_unpack, value))
+    if type(value) is Timestamp:
+        return _format_time(value)
+    return value
+
+def _looks_like_time(value: str) -> bool:
+    return 25 <= len(value) <= 32 and value[4] == "-" and value[10] == "T"
+
+def _parse_time(value: Optional[str]) -> Union[float, str, None]:
+    """Epoch float se la riformattazione restituisce esattamente la stringa di HA, altrimenti la stringa."""
+    if not isinstance(value, str):
+        return value
+    try:
+        ts = datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return sys.intern(value) if len(value) <= INTERN_MAX_LEN else value
+    return ts if _format_time(ts) == value else sys.intern(value)
+
+def _format_time(value: Union[float, str, None]) -> Optional[str]:
+    if isinstance(value, float):
+        return datetime.fromtimestamp(value, timezone.utc).isoformat()
+    return value
+
+def _same(a: Any, b: Any) -> bool:
+    """Uguaglianza che distingue i tipi, anche nei valori annidati: per le tuple
+    True == 1 == 1.0, per gli attributi HA no."""
+    if a is b:
+        return True
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, tuple):
+        return len(a) == len(b) and all(map(_same, a, b))
+    return a == b
+
+def _shared(attributes: Packed) -> Packed:
+    """Attributi piccoli con soli valori hashabili: una sola istanza per contenuto."""
+    if len(attributes) > SHARED_ATTRS_MAX_KEYS + 1:
+        return attributes
+    try:
+        shared = _shared_attrs.get(attributes)
+    except TypeError:  # valori non hashabili
+        return attributes
+    if shared is None:
+        if len(_shared_attrs) >= SHARED_ATTRS_MAX:
+            _shared_attrs.clear()
+        shared = _shared_attrs[attributes] = attributes
+    elif not _same(shared, attributes):
+        return attributes  # uguali per == ma con tipi diversi (es. 1 e True): niente condivisione
+    return shared
+
+def compact(states: Iterable[dict], previous: Iterable[EntityState] = ()) -> tuple[EntityState, ...]:
+    """Converte la risposta di /api/states in record compatti, riusando ciò che non è cambiato."""
+    before = {e.entity_id: e for e in previous}
+    out = []
+    for s in states:
+        entity_id = s.get("entity_id")
+        if not isinstance(entity_id, str):
+            continue
+        attributes = _pack(s.get("attributes") or {})
+        state = s.get("state")  # mai convertito in epoch: i sensori timestamp restano stringhe ISO
+        if isinstance(state, str) and len(state) <= INTERN_MAX_LEN:
+            state = sys.intern(state)
+        last_changed = _parse_time(s.get("last_changed"))
+        last_updated = s.get("last_updated")
+        last_updated = last_changed if last_updated == s.get("last_changed") else _parse_time(last_updated)
+        old = before.get(entity_id)
+        if old is not None and _same(old.attributes, attributes):
+            if _same(old.state, state) and old.last_changed == last_changed and old.last_updated == last_updated:
+                out.append(old)
+                continue
+            attributes = old.attributes
+        else:
+            attributes = _shared(attributes)
+        entity_id = sys.intern(entity_id)
+        out.append(EntityState(entity_id, sys.intern(entity_id.split(".")[0]),
+                               state, attributes, last_changed, last_updated))
+    return tuple(out)
+
+def to_dicts(entities: Iterable[EntityState]) -> list[dict]:
+    return [e.to_dict() for e in entities]
+
+def memory_report(entities: tuple[EntityState, ...]) -> dict:
+    """Stima della memoria occupata dallo snapshot; gli oggetti condivisi sono contati una volta."""
+    seen: set[int] = set()
+
+    def size(obj: Any) -> int:
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+        total = sys.getsizeof(obj)
+        if isinstance(obj, tuple):
+            total += sum(size(v) for v in obj)
+        return total
+
+    total = sys.getsizeof(entities)
+    for e in entities:
+        total += size(e) + sum(size(getattr(e, slot)) for slot in EntityState.__slots__)
+    return {"entities": len(entities),
+            "attribute_sets": len({id(e.attributes) for e in entities}),
+            "bytes": total}
@@ -0,0 +1,64 @@
+"""Chiamate verso le istanze Home Assistant con un client HTTP condiviso.
+
+Un solo httpx.AsyncClient per worker: le connessioni (e gli handshake TLS)
+verso ogni host vengono riutilizzate tra le richieste."""
+import httpx
+from fastapi import HTTPException
+from app.crypto import decrypt
+from app import deadline
+from app.hosts.admission import admit
+from app.hosts import ha_ws, resilience
+
+SAFE_METHODS = ("GET", "HEAD")
+
+_client: httpx.AsyncClient = None
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(verify=True, timeout=10,
+                                    limits=httpx.Limits(max_connections=200, max_keepalive_connections=50))
+    return _client
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+def auth_headers(host) -> dict:
+    return {"Authorization": f"Bearer {decrypt(host.token)}"}
+
+async def request(host, method: str, path: str, timeout: float = 10, **kwargs) -> httpx.Response:
+    """Richiesta verso l'host passando dal controllo di ammissione (429/503 se sovraccarico)
+    e dalla politica di retry/hedging (vedi resilience): GET e HEAD sono idempotenti, le
+    altre vengono ritentate solo se non sono partite. `timeout` è il tempo totale, limitato
+    dalla scadenza della richiesta in corso."""
+    timeout = deadline.timeout(timeout)
+    url = f"{host.base_url}{path}"
+
+    async def attempt(attempt_timeout: float) -> httpx.Response:
+        async with admit(host):
+            return await get_client().request(method, url, headers=auth_headers(host),
+                                              timeout=attempt_timeout, **kwargs)
+    return await resilience.call(str(host.id), attempt, timeout, idempotent=method in SAFE_METHODS)
+
+async def fetch_states(host, timeout: float = 10) -> list:
+    """GET /api/states dell'host; 5xx/4xx di HA diventano HTTPException."""
+    resp = await request(host, "GET", "/api/states", timeout=timeout)
+    if resp.status_code != 200:
+        raise HTTPException(resp.status_code, "Errore comunicazione con HA")
+    return resp.json()
+
+async def call_service(host, domain: str, service: str, body: dict) -> list:
+    """Chiamata di servizio sul WebSocket persistente dell'host; REST se il canale non è disponibile.
+    In entrambi i casi restituisce gli stati (grezzi) modificati dalla chiamata."""
+    try:
+        return await ha_ws.call_service(host, domain, service, body)
+    except ha_ws.WSUnavailable:
+        pass
+    resp = await request(host, "POST", f"/api/services/{domain}/{service}", json=body)
+    if resp.status_code not in (200, 201):
+        raise HTTPException(resp.status_code, "Errore chiamata servizio HA")
+    changed = resp.json()
+    return changed if isinstance(changed, list) else []
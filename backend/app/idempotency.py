@@ -0,0 +1,162 @@
+"""Chiavi di idempotenza (header Idempotency-Key) per le richieste di controllo.
+
+Il primo arrivo di una chiave la prenota su Redis (SET NX, stato "pending"),
+esegue la chiamata e salva il risultato per IDEMPOTENCY_TTL_SECONDS. Un duplicato
+nella finestra riceve il risultato salvato senza toccare HA (header
+Idempotent-Replayed). I duplicati concorrenti nello stesso worker attendono la
+stessa future; quelli su altri worker attendono su Redis che la prima chiamata
+finisca. Gli errori non vengono memorizzati: se la chiamata certamente non ha
+eseguito nulla su HA (rifiutata dal controllo di ammissione, connessione mai
+stabilita, errore 4xx di HA) la chiave viene liberata e il client può riprovare;
+se l'esito è ignoto (timeout, connessione interrotta a metà) la prenotazione
+resta fino a IDEMPOTENCY_PENDING_SECONDS, così un retry non ripete il comando.
+La chiamata gira in un task a sé: se il client si disconnette (il middleware
+delle scadenze annulla l'handler) arriva comunque fino in fondo e il retry con la
+stessa chiave riceve il suo risultato. Se Redis non è raggiungibile resta la
+deduplica locale."""
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from typing import Any, Awaitable, Callable
+from fastapi import HTTPException, Request, Response
+from redis.exceptions import RedisError
+from app.config import settings
+from app.redis_client import get_redis
+from app.hosts.resilience import NOT_SENT
+
+logger = logging.getLogger("homematrix.idempotency")
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+KEY = "idem:{}"
+MAX_KEY_LENGTH = 255
+POLL_SECONDS = 0.05
+
+_inflight: dict[str, asyncio.Future] = {}
+_running: set[asyncio.Task] = set()
+
+def fingerprint(body: Any) -> str:
+    """Impronta del contenuto della richiesta (dict JSON o bytes)."""
+    raw = body if isinstance(body, bytes) else json.dumps(body, sort_keys=True, default=str).encode()
+    return hashlib.sha256(raw).hexdigest()
+
+def _redis_key(user_id, scope: str, key: str) -> str:
+    return KEY.format(hashlib.sha256(f"{user_id}\x00{scope}\x00{key}".encode()).hexdigest())
+
+def _not_applied(error: BaseException) -> bool:
+    """True se la chiamata fallita certamente non ha eseguito nulla su HA."""
+    if isinstance(error, NOT_SENT):
+        return True
+    # 429/503: ammissione rifiutata prima dell'invio; 4xx: HA ha rifiutato la chiamata
+    return isinstance(error, HTTPException) and (error.status_code < 500 or error.status_code == 503)
+
+def _replay(record: dict, fp: str, response: Response) -> Any:
+    if record.get("fp") != fp:
+        raise HTTPException(422, "Idempotency-Key già usata per una richiesta diversa")
+    response.headers[REPLAYED_HEADER] = "true"
+    return record["body"]
+
+async def _wait_remote(rkey: str, fp: str, response: Response) -> Any:
+    """La chiave è prenotata da un altro worker: attende il risultato fino alla scadenza della prenotazione."""
+    deadline = time.monotonic() + settings.IDEMPOTENCY_PENDING_SECONDS
+    while time.monotonic() < deadline:
+        raw = await get_redis().get(rkey)
+        if raw is None:
+            return None  # la prima chiamata è fallita: si può eseguire
+        record = json.loads(raw)
+        if record.get("status") == "done":
+            return _replay(record, fp, response)
+        await asyncio.sleep(POLL_SECONDS)
+    raise HTTPException(409, "Richiesta con la stessa Idempotency-Key ancora in corso")
+
+def _fail(future: asyncio.Future, error: BaseException) -> None:
+    if not future.done():
+        future.set_exception(error if isinstance(error, Exception) else HTTPException(499, "Richiesta annullata"))
+        future.exception()  # recuperata: nessun warning se non ci sono duplicati in attesa
+
+async def _execute(rkey: str, fp: str, owned: bool, call: Callable[[], Awaitable[Any]]) -> Any:
+    """Esegue `call` e ne salva il risultato su Redis; con esito ignoto la prenotazione resta."""
+    try:
+        result = await call()
+    except BaseException as e:
+        if owned and _not_applied(e):
+            try: await get_redis().delete(rkey)
+            except RedisError: pass
+        raise
+    if owned:
+        try:
+            await get_redis().set(rkey, json.dumps({"status": "done", "fp": fp, "body": result},
+                                                   default=str),
+                                  ex=int(settings.IDEMPOTENCY_TTL_SECONDS))
+        except RedisError:
+            logger.warning("Redis non disponibile: risultato Idempotency-Key non salvato")
+    return result
+
+def _finish(rkey: str, fp: str, future: asyncio.Future, task: asyncio.Task) -> None:
+    _running.discard(task)
+    if _inflight.get(rkey) is future:
+        del _inflight[rkey]
+    if task.cancelled():
+        _fail(future, asyncio.CancelledError())
+    elif task.exception() is not None:
+        _fail(future, task.exception())
+    else:
+        future.set_result((task.result(), fp))
+
+async def idempotent(request: Request, response: Response, user_id, fp: str,
+                     call: Callable[[], Awaitable[Any]]) -> Any:
+    """Esegue `call` al più una volta per (utente, percorso, Idempotency-Key) nella finestra di TTL.
+    `fp` (vedi fingerprint()) identifica il contenuto della richiesta: stessa chiave con corpo diverso = 422."""
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    if not key:
+        return await call()
+    if len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(400, "Idempotency-Key troppo lunga")
+    rkey = _redis_key(user_id, request.url.path, key)
+
+    inflight = _inflight.get(rkey)
+    if inflight is not None:
+        body, first_fp = await asyncio.shield(inflight)
+        return _replay({"fp": first_fp, "body": body}, fp, response)
+
+    future = _inflight[rkey] = asyncio.get_running_loop().create_future()
+    task = None
+    try:
+        owned = True
+        try:
+            owned = await get_redis().set(rkey, json.dumps({"status": "pending", "fp": fp}),
+                                          nx=True, ex=int(settings.IDEMPOTENCY_PENDING_SECONDS))
+            if not owned:
+                raw = await get_redis().get(rkey)
+                record = json.loads(raw) if raw else None
+                if record and record.get("status") == "done":
+                    result = _replay(record, fp, response)
+                    future.set_result((result, fp))
+                    return result
+                result = await _wait_remote(rkey, fp, response) if record else None
+                if result is not None:
+                    future.set_result((result, fp))
+                    return result
+                owned = await get_redis().set(rkey, json.dumps({"status": "pending", "fp": fp}),
+                                              nx=True, ex=int(settings.IDEMPOTENCY_PENDING_SECONDS))
+                if not owned:
+                    raise HTTPException(409, "Richiesta con la stessa Idempotency-Key ancora in corso")
+        except RedisError:
+            logger.warning("Redis non disponibile: deduplica Idempotency-Key solo locale")
+            owned = False
+
+        # Da qui la chiamata prosegue anche se questa richiesta viene annullata
+        task = asyncio.create_task(_execute(rkey, fp, owned, call))
+        _running.add(task)
+        task.add_done_callback(lambda t: _finish(rkey, fp, future, t))
+        result, _ = await asyncio.shield(future)
+        return result
+    except BaseException as e:
+        if task is None:
+            _fail(future, e)
+        raise
+    finally:
+        if task is None and _inflight.get(rkey) is future:
+            del _inflight[rkey]
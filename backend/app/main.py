@@ -5,6 +5,16 @@ from slowapi import _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
 from app.limiter import limiter
 from app.config import settings
+from app import background
+from app.pagination import NEXT_CURSOR_HEADER
+from app.hosts.snapshots import STALE_HEADER, SNAPSHOT_AGE_HEADER, load_snapshots, persist_snapshots
+from app.idempotency import REPLAYED_HEADER
+from app.deadline import DeadlineMiddleware
+from app.security_log import flush_security_events
+from app.auth.maintenance import sweep_sessions, purge_trusted_devices
+from app.auth.devices import flush_last_seen
+from app.auth import session_store
+from app.redis_client import close_redis
 from app.auth.router import router as auth_router
 from app.auth.reset_router import router as reset_router
 from app.auth.google_router import router as google_router
@@ -12,6 +22,9 @@ from app.auth.totp_router import router as totp_router
 from app.admin.router import router as admin_router
 from app.hosts.router import router as hosts_router
 from app.views.router import router as views_router
+from app.bootstrap.router import router as bootstrap_router
+from app.hosts.upstream import close_client
+from app.hosts.ha_ws import close_connections
 
 app = FastAPI(
     title="HomeMatrix API",
@@ -24,14 +37,35 @@ app = FastAPI(
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
+app.add_middleware(DeadlineMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=settings.ALLOWED_ORIGINS.split(","),
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, STALE_HEADER, SNAPSHOT_AGE_HEADER, REPLAYED_HEADER, "ETag"],
 )
 
+background.periodic("security-events-flush", settings.SECURITY_EVENTS_FLUSH_SECONDS, flush_security_events)
+background.periodic("session-sweep", settings.SESSION_SWEEP_INTERVAL_SECONDS, sweep_sessions)
+background.periodic("trusted-device-last-seen", settings.TRUSTED_DEVICE_FLUSH_SECONDS, flush_last_seen)
+background.periodic("trusted-device-purge", settings.TRUSTED_DEVICE_PURGE_SECONDS, purge_trusted_devices)
+background.on_startup(load_snapshots)
+if settings.SNAPSHOT_DIR:
+    background.periodic("snapshot-persist", settings.SNAPSHOT_PERSIST_SECONDS, persist_snapshots)
+    background.on_shutdown(persist_snapshots)
+background.on_shutdown(flush_security_events)
+background.on_shutdown(flush_last_seen)
+if session_store.enabled():
+    background.periodic("session-write-back", settings.SESSION_WRITE_BACK_SECONDS, session_store.write_back_sessions)
+    background.on_shutdown(session_store.write_back_sessions)
+background.on_shutdown(close_redis)
+background.on_shutdown(close_client)
+background.on_shutdown(close_connections)
+app.add_event_handler("startup", background.start)
+app.add_event_handler("shutdown", background.stop)
+
 app.include_router(auth_router, prefix="/api/auth", tags=["auth"])
 app.include_router(reset_router, prefix="/api/auth", tags=["reset"])
 app.include_router(google_router, prefix="/api/auth", tags=["google"])
@@ -39,6 +73,7 @@ app.include_router(totp_router, prefix="/api/auth/2fa", tags=["2fa"])
 app.include_router(admin_router, prefix="/api/admin", tags=["admin"])
 app.include_router(hosts_router, prefix="/api/hosts", tags=["hosts"])
 app.include_router(views_router, prefix="/api", tags=["views"])
+app.include_router(bootstrap_router, prefix="/api", tags=["bootstrap"])
 
 @app.get("/api/health")
 async def health():
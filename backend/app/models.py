@@ -1,7 +1,7 @@
 from typing import Optional, List
 import uuid
 from datetime import datetime
-from sqlalchemy import String, Boolean, DateTime, ForeignKey, Text, Enum, Integer
+from sqlalchemy import String, Boolean, DateTime, ForeignKey, Text, Enum, Integer, BigInteger, Index, text
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from sqlalchemy.dialects.postgresql import UUID
 from app.db import Base
@@ -14,6 +14,12 @@ class UserStatus(str, enum.Enum):
 
 class User(Base):
     __tablename__ = "users"
+    # Trigrammi (pg_trgm) per la ricerca ILIKE '%q%' nella lista admin; created_at,id per la paginazione
+    __table_args__ = (
+        Index("ix_users_email_trgm", "email", postgresql_using="gin", postgresql_ops={"email": "gin_trgm_ops"}),
+        Index("ix_users_full_name_trgm", "full_name", postgresql_using="gin", postgresql_ops={"full_name": "gin_trgm_ops"}),
+        Index("ix_users_created_at_id", "created_at", "id"),
+    )
 
     id: Mapped[uuid.UUID]       = mapped_column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     email: Mapped[str]          = mapped_column(String(255), unique=True, nullable=False, index=True)
@@ -30,14 +36,20 @@ class User(Base):
     approved_at: Mapped[datetime]= mapped_column(DateTime, nullable=True)
 
     sessions: Mapped[list["Session"]] = relationship(back_populates="user", cascade="all, delete")
+    roles: Mapped[list["UserRole"]] = relationship(viewonly=True)
 
 class Session(Base):
     __tablename__ = "sessions"
+    # Indice parziale per lo sweeper delle sessioni revocate
+    __table_args__ = (
+        Index("ix_sessions_revoked", "id", postgresql_where=text("revoked")),
+    )
 
     id: Mapped[uuid.UUID]        = mapped_column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    user_id: Mapped[uuid.UUID]   = mapped_column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False)
-    refresh_token: Mapped[str]   = mapped_column(String(512), unique=True, nullable=False, index=True)
-    expires_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    user_id: Mapped[uuid.UUID]   = mapped_column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False, index=True)
+    # SHA-256 esadecimale del refresh token (il token in chiaro sta solo nel cookie)
+    refresh_token_hash: Mapped[str] = mapped_column(String(64), unique=True, nullable=False, index=True)
+    expires_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, index=True)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     revoked: Mapped[bool]        = mapped_column(Boolean, default=False)
 
@@ -53,6 +65,9 @@ class HAHost(Base):
     description: Mapped[str]   = mapped_column(Text, nullable=True)
     active: Mapped[bool]       = mapped_column(Boolean, default=True)
     created_at: Mapped[datetime]= mapped_column(DateTime, default=datetime.utcnow)
+    # Limiti di ammissione (None = default da configurazione)
+    max_concurrency: Mapped[int] = mapped_column(Integer, nullable=True)
+    max_queue: Mapped[int]       = mapped_column(Integer, nullable=True)
 
 import json
 
@@ -72,19 +87,19 @@ class UserRole(Base):
     __tablename__ = "user_roles"
 
     id: Mapped[uuid.UUID]      = mapped_column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    user_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False)
-    role_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), ForeignKey("roles.id"), nullable=False)
+    user_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False, index=True)
+    role_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), ForeignKey("roles.id"), nullable=False, index=True)
     created_at: Mapped[datetime]= mapped_column(DateTime, default=datetime.utcnow)
 
-    user: Mapped["User"] = relationship()
+    user: Mapped["User"] = relationship(overlaps="roles")
     role: Mapped["Role"] = relationship(back_populates="users")
 
 class RolePermission(Base):
     __tablename__ = "role_permissions"
 
     id: Mapped[uuid.UUID]       = mapped_column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    role_id: Mapped[uuid.UUID]  = mapped_column(UUID(as_uuid=True), ForeignKey("roles.id"), nullable=False)
-    host_id: Mapped[uuid.UUID]  = mapped_column(UUID(as_uuid=True), ForeignKey("ha_hosts.id"), nullable=False)
+    role_id: Mapped[uuid.UUID]  = mapped_column(UUID(as_uuid=True), ForeignKey("roles.id"), nullable=False, index=True)
+    host_id: Mapped[uuid.UUID]  = mapped_column(UUID(as_uuid=True), ForeignKey("ha_hosts.id"), nullable=False, index=True)
     # Domini consentiti: JSON array es. ["switch","light","sensor"] — null = tutti
     allowed_domains: Mapped[str]= mapped_column(Text, nullable=True)
     # Entità specifiche: JSON array es. ["switch.luce_sala"] — null = tutte
@@ -97,30 +112,38 @@ class TrustedDevice(Base):
     __tablename__ = "trusted_devices"
 
     id: Mapped[uuid.UUID]       = mapped_column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    user_id: Mapped[uuid.UUID]  = mapped_column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False)
+    user_id: Mapped[uuid.UUID]  = mapped_column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False, index=True)
     device_token: Mapped[str]   = mapped_column(String(128), unique=True, nullable=False)
     device_name: Mapped[str]    = mapped_column(String(200), nullable=True)
     created_at: Mapped[datetime]= mapped_column(DateTime, default=datetime.utcnow)
     last_seen: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
-    expires_at: Mapped[datetime]= mapped_column(DateTime, nullable=False)
+    expires_at: Mapped[datetime]= mapped_column(DateTime, nullable=False, index=True)
 
     user: Mapped["User"] = relationship()
 
 class CustomView(Base):
     __tablename__ = "custom_views"
+    __table_args__ = (
+        Index("ix_custom_views_order_id", "order", "id"),
+    )
 
     id: Mapped[uuid.UUID]        = mapped_column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    role_id: Mapped[uuid.UUID]   = mapped_column(UUID(as_uuid=True), ForeignKey("roles.id", ondelete="CASCADE"), nullable=False)
-    host_id: Mapped[Optional[uuid.UUID]] = mapped_column(UUID(as_uuid=True), ForeignKey("ha_hosts.id", ondelete="SET NULL"), nullable=True)
+    role_id: Mapped[uuid.UUID]   = mapped_column(UUID(as_uuid=True), ForeignKey("roles.id", ondelete="CASCADE"), nullable=False, index=True)
+    host_id: Mapped[Optional[uuid.UUID]] = mapped_column(UUID(as_uuid=True), ForeignKey("ha_hosts.id", ondelete="SET NULL"), nullable=True, index=True)
     title: Mapped[str]           = mapped_column(String(200), nullable=False)
     slug: Mapped[str]            = mapped_column(String(200), unique=True, nullable=False)
     order: Mapped[int]           = mapped_column(Integer, default=0)
+    # Incrementata ad ogni modifica della vista o dei widget (concorrenza ottimistica)
+    version: Mapped[int]         = mapped_column(Integer, default=0, server_default="0", nullable=False)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
     widgets: Mapped[list["ViewWidget"]] = relationship(back_populates="view", cascade="all, delete", order_by="ViewWidget.order")
 
 class ViewWidget(Base):
     __tablename__ = "view_widgets"
+    __table_args__ = (
+        Index("ix_view_widgets_view_id_order", "view_id", "order"),
+    )
 
     id: Mapped[uuid.UUID]        = mapped_column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     view_id: Mapped[uuid.UUID]   = mapped_column(UUID(as_uuid=True), ForeignKey("custom_views.id", ondelete="CASCADE"), nullable=False)
@@ -133,3 +156,21 @@ class ViewWidget(Base):
     order: Mapped[int]           = mapped_column(Integer, default=0)
 
     view: Mapped["CustomView"] = relationship(back_populates="widgets")
+
+class SecurityEvent(Base):
+    __tablename__ = "security_events"
+    # Indici composti con id: servono sia il filtro sia l'ordinamento della paginazione keyset
+    __table_args__ = (
+        Index("ix_security_events_event_type_id", "event_type", "id"),
+        Index("ix_security_events_email_id", "email", "id"),
+        Index("ix_security_events_ip_id", "ip", "id"),
+        Index("ix_security_events_created_at", "created_at"),
+    )
+
+    id: Mapped[int]              = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    event_type: Mapped[str]      = mapped_column(String(32), nullable=False)  # LOGIN_OK, LOGIN_FAIL, REGISTER, ADMIN_ACTION, PASSWORD_CHANGE
+    email: Mapped[str]           = mapped_column(String(255), nullable=True)
+    ip: Mapped[str]              = mapped_column(String(64), nullable=True)
+    action: Mapped[str]          = mapped_column(String(64), nullable=True)   # solo ADMIN_ACTION
+    target: Mapped[str]          = mapped_column(String(255), nullable=True)  # solo ADMIN_ACTION
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
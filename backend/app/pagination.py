@@ -0,0 +1,35 @@
+"""Paginazione keyset condivisa: cursore opaco restituito nell'header X-Next-Cursor."""
+import base64
+import json
+from typing import Any, Callable
+from fastapi import HTTPException, Response
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+
+def encode_cursor(values: list) -> str:
+    raw = json.dumps(values, default=str, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str, *parsers: Callable[[Any], Any]) -> list:
+    """Decodifica un cursore applicando un parser per valore (es. int, uuid.UUID); 400 se malformato."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not isinstance(values, list) or len(values) != len(parsers):
+            raise ValueError(cursor)
+        return [parse(v) for parse, v in zip(parsers, values)]
+    except (ValueError, TypeError):
+        raise HTTPException(400, "Cursore non valido")
+
+def paginate(rows: list, limit: int, key: Callable[[Any], list], response: Response) -> list:
+    """Riceve fino a limit+1 righe: se ce n'è una in più imposta il cursore della pagina successiva."""
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(key(rows[-1]))
+    return rows
+
+def search_pattern(q: str) -> str:
+    """Pattern ILIKE '%q%' con i caratteri jolly dell'utente neutralizzati (escape '\\')."""
+    escaped = q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
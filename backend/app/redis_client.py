@@ -0,0 +1,17 @@
+"""Client Redis asincrono condiviso (pool di connessioni su REDIS_URL)."""
+import redis.asyncio as aioredis
+from app.config import settings
+
+_client: aioredis.Redis = None
+
+def get_redis() -> aioredis.Redis:
+    global _client
+    if _client is None:
+        _client = aioredis.from_url(settings.REDIS_URL, decode_responses=True)
+    return _client
+
+async def close_redis() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -1,5 +1,10 @@
+import asyncio
 import logging
 from datetime import datetime
+from sqlalchemy import insert
+from app.config import settings
+from app.db import AsyncSessionLocal
+from app.models import SecurityEvent
 
 security_logger = logging.getLogger("homematrix.security")
 security_logger.setLevel(logging.INFO)
@@ -8,17 +13,72 @@ handler = logging.FileHandler("/var/log/homematrix_security.log")
 handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
 security_logger.addHandler(handler)
 
+# Buffer write-behind: gli eventi finiscono in security_events con un INSERT multiplo
+# per batch, invece di un round trip a DB per ogni login fallito.
+_pending: list[dict] = []
+_flush_task: asyncio.Task = None
+_dropped = 0  # eventi scartati dal buffer pieno: restano solo nel file di log
+
+def _record(event_type: str, email: str = None, ip: str = None,
+            action: str = None, target: str = None):
+    global _dropped
+    overflow = len(_pending) - settings.SECURITY_EVENTS_MAX_PENDING + 1
+    if overflow > 0:  # DB irraggiungibile a lungo: si scartano i più vecchi
+        del _pending[:overflow]
+        _dropped += overflow
+    _pending.append({"event_type": event_type, "email": email, "ip": ip,
+                     "action": action, "target": target, "created_at": datetime.utcnow()})
+    if len(_pending) >= settings.SECURITY_EVENTS_BATCH_SIZE:
+        _schedule_flush()
+
+def _schedule_flush():
+    """Anticipa il flush quando il buffer ha raggiunto un batch pieno."""
+    global _flush_task
+    if _flush_task and not _flush_task.done():
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    _flush_task = loop.create_task(flush_security_events())
+
+async def flush_security_events():
+    """Scrive su DB gli eventi in coda, un batch alla volta."""
+    global _pending, _dropped
+    while _pending:
+        batch, _pending = _pending[:settings.SECURITY_EVENTS_BATCH_SIZE], _pending[settings.SECURITY_EVENTS_BATCH_SIZE:]
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(insert(SecurityEvent), batch)
+                await db.commit()
+        except Exception:
+            security_logger.exception("Scrittura di %d eventi di sicurezza su DB fallita", len(batch))
+            # Rimette in coda per il prossimo giro; oltre il limite gli eventi restano solo nel file di log
+            if len(_pending) + len(batch) <= settings.SECURITY_EVENTS_MAX_PENDING:
+                _pending = batch + _pending
+            else:
+                _dropped += len(batch)
+            return
+
+def security_events_stats() -> dict:
+    return {"pending": len(_pending), "dropped": _dropped}
+
 def log_login_ok(email: str, ip: str):
     security_logger.info(f"LOGIN_OK email={email} ip={ip}")
+    _record("LOGIN_OK", email=email, ip=ip)
 
 def log_login_fail(email: str, ip: str):
     security_logger.warning(f"LOGIN_FAIL email={email} ip={ip}")
+    _record("LOGIN_FAIL", email=email, ip=ip)
 
 def log_register(email: str, ip: str):
     security_logger.info(f"REGISTER email={email} ip={ip}")
+    _record("REGISTER", email=email, ip=ip)
 
 def log_admin_action(admin_email: str, action: str, target: str):
     security_logger.info(f"ADMIN_ACTION admin={admin_email} action={action} target={target}")
+    _record("ADMIN_ACTION", email=admin_email, action=action[:64], target=str(target)[:255])
 
 def log_password_change(email: str, ip: str):
     security_logger.info(f"PASSWORD_CHANGE email={email} ip={ip}")
+    _record("PASSWORD_CHANGE", email=email, ip=ip)
@@ -0,0 +1,64 @@
+"""Definizioni delle viste compilate una volta e tenute in cache per slug e versione.
+
+Ad ogni poll basta una lettura indicizzata di (id, version) per slug; widget,
+permessi del ruolo e host vengono ricaricati solo quando la versione cambia,
+alla scadenza del TTL o su invalidazione esplicita dagli endpoint admin."""
+from dataclasses import dataclass
+from typing import NamedTuple
+from fastapi import HTTPException
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from app.cache import TTLCache
+from app.config import settings
+from app import deadline
+from app.models import CustomView, HAHost, RolePermission
+
+class HostRef(NamedTuple):
+    id: str
+    base_url: str
+    token: str  # cifrato, come a DB
+    max_concurrency: int = None
+    max_queue: int = None
+
+@dataclass(frozen=True)
+class ViewDefinition:
+    id: str
+    slug: str
+    version: int
+    role_id: str
+    hosts: tuple[HostRef, ...]
+    document: dict  # parte "view" della risposta, da non modificare
+    etag: str
+
+_definitions = TTLCache("view_definitions", maxsize=1000, ttl=settings.VIEW_DEFINITION_TTL_SECONDS)
+
+async def get_view_definition(db: AsyncSession, slug: str) -> ViewDefinition:
+    row = (await deadline.bound(db.execute(
+        select(CustomView.id, CustomView.version).where(CustomView.slug == slug)))).one_or_none()
+    if not row: raise HTTPException(404, "Vista non trovata")
+    cached = _definitions.get(slug)
+    if cached is not None and cached.version == row.version:
+        return cached
+    definition = await deadline.bound(_compile(db, slug))
+    _definitions.set(slug, definition)
+    return definition
+
+async def _compile(db: AsyncSession, slug: str) -> ViewDefinition:
+    result = await db.execute(select(CustomView).options(selectinload(CustomView.widgets)).where(CustomView.slug == slug))
+    view = result.scalar_one_or_none()
+    if not view: raise HTTPException(404, "Vista non trovata")
+    host_result = await db.execute(
+        select(HAHost).where(HAHost.active == True,
+                             HAHost.id.in_(select(RolePermission.host_id).where(RolePermission.role_id == view.role_id))))
+    hosts = tuple(HostRef(str(h.id), h.base_url, h.token, h.max_concurrency, h.max_queue) for h in host_result.scalars().all())
+    document = {"id": str(view.id), "title": view.title, "slug": view.slug, "version": view.version,
+                "widgets": [{"id": str(w.id), "entity_id": w.entity_id, "label": w.label,
+                             "icon": w.icon, "color": w.color, "bg_color": w.bg_color,
+                             "size": w.size, "order": w.order} for w in view.widgets]}
+    return ViewDefinition(id=str(view.id), slug=view.slug, version=view.version, role_id=str(view.role_id),
+                          hosts=hosts, document=document, etag=f'W/"view-{view.id}-{view.version}"')
+
+def invalidate_view_definitions() -> None:
+    """Da chiamare dopo modifiche a viste, widget, permessi dei ruoli o host."""
+    _definitions.clear()
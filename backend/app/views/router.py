@@ -1,15 +1,19 @@
-import re, uuid, json as _json
-import httpx
+import asyncio, re, uuid, json as _json
 from typing import Optional, List
-from fastapi import APIRouter, Depends, HTTPException
-from pydantic import BaseModel
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from pydantic import BaseModel, Field
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, tuple_, update, insert, delete
 from sqlalchemy.orm import selectinload
 from app.db import get_db
 from app.models import User, CustomView, ViewWidget, HAHost, RolePermission, UserRole
 from app.auth.router import get_current_user, require_admin
-from app.hosts.router import decrypt
+from app.hosts.upstream import request as upstream_request, call_service as upstream_call_service
+from app.hosts import snapshots, history
+from app.config import settings
+from app.idempotency import idempotent, fingerprint
+from app.views.definitions import get_view_definition, invalidate_view_definitions
+from app.pagination import DEFAULT_LIMIT, MAX_LIMIT, decode_cursor, paginate, search_pattern
 
 router = APIRouter()
 
@@ -48,19 +52,55 @@ class WidgetUpdate(BaseModel):
     size: Optional[str] = None
     order: Optional[int] = None
 
+class LayoutWidget(BaseModel):
+    id: Optional[uuid.UUID] = None       # assente = nuovo widget
+    entity_id: Optional[str] = None      # obbligatorio per i nuovi widget
+    label: Optional[str] = None
+    icon: Optional[str] = None
+    color: Optional[str] = None
+    bg_color: Optional[str] = None
+    size: Optional[str] = None
+
+class LayoutUpdate(BaseModel):
+    version: int
+    widgets: list[LayoutWidget] = Field(..., max_length=500)
+
+WIDGET_FIELDS = ("label", "icon", "color", "bg_color", "size")
+
+def widget_dict(w) -> dict:
+    return {"id": str(w.id), "entity_id": w.entity_id, "label": w.label,
+            "icon": w.icon, "color": w.color, "bg_color": w.bg_color, "size": w.size, "order": w.order}
+
+async def bump_view_version(db: AsyncSession, view_id) -> None:
+    await db.execute(update(CustomView).where(CustomView.id == view_id)
+                     .values(version=CustomView.version + 1)
+                     .execution_options(synchronize_session=False))
+
 @router.get("/admin/views")
-async def list_views(db: AsyncSession = Depends(get_db), admin: User = Depends(require_admin)):
-    result = await db.execute(select(CustomView).options(selectinload(CustomView.widgets)).order_by(CustomView.order))
-    views = result.scalars().all()
-    out = []
-    for v in views:
-        widgets = [{"id": str(w.id), "entity_id": w.entity_id, "label": w.label,
-                    "icon": w.icon, "color": w.color, "bg_color": w.bg_color, "size": w.size, "order": w.order}
-                   for w in sorted(v.widgets, key=lambda x: x.order)]
-        out.append({"id": str(v.id), "role_id": str(v.role_id),
-                    "title": v.title, "slug": v.slug, "order": v.order,
-                    "created_at": v.created_at, "widgets": widgets})
-    return out
+async def list_views(response: Response,
+                     q: Optional[str] = None,
+                     role_id: Optional[uuid.UUID] = None,
+                     host_id: Optional[uuid.UUID] = None,
+                     cursor: Optional[str] = None,
+                     limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+                     db: AsyncSession = Depends(get_db), admin: User = Depends(require_admin)):
+    """Viste con i widget (già ordinati dalla relazione). Filtri per titolo, ruolo e host del ruolo."""
+    query = select(CustomView).options(selectinload(CustomView.widgets))
+    if q:
+        query = query.where(CustomView.title.ilike(search_pattern(q), escape="\\"))
+    if role_id:
+        query = query.where(CustomView.role_id == role_id)
+    if host_id:
+        query = query.where(CustomView.role_id.in_(
+            select(RolePermission.role_id).where(RolePermission.host_id == host_id)))
+    if cursor:
+        last_order, last_id = decode_cursor(cursor, int, uuid.UUID)
+        query = query.where(tuple_(CustomView.order, CustomView.id) > (last_order, last_id))
+    result = await db.execute(query.order_by(CustomView.order, CustomView.id).limit(limit + 1))
+    views = paginate(result.scalars().all(), limit, lambda v: [v.order, str(v.id)], response)
+    return [{"id": str(v.id), "role_id": str(v.role_id),
+             "title": v.title, "slug": v.slug, "order": v.order, "version": v.version,
+             "created_at": v.created_at, "widgets": [widget_dict(w) for w in v.widgets]} for v in views]
 
 @router.post("/admin/views", status_code=201)
 async def create_view(data: ViewCreate, db: AsyncSession = Depends(get_db), admin: User = Depends(require_admin)):
@@ -78,7 +118,9 @@ async def update_view(view_id: str, data: ViewUpdate, db: AsyncSession = Depends
     view = await db.get(CustomView, view_id)
     if not view: raise HTTPException(404, "Vista non trovata")
     if data.title is not None: view.title = data.title
+    view.version += 1
     await db.commit()
+    invalidate_view_definitions()
     return {"message": "Vista aggiornata"}
 
 @router.delete("/admin/views/{view_id}")
@@ -87,6 +129,7 @@ async def delete_view(view_id: str, db: AsyncSession = Depends(get_db), admin: U
     if not view: raise HTTPException(404, "Vista non trovata")
     await db.delete(view)
     await db.commit()
+    invalidate_view_definitions()
     return {"message": "Vista eliminata"}
 
 @router.get("/admin/views/{view_id}/entities")
@@ -111,19 +154,17 @@ async def get_view_entities(view_id: str, db: AsyncSession = Depends(get_db), ad
         if domain in allowed_domains: return True
         return not allowed_domains and not allowed_entities
     all_entities = []
-    async with httpx.AsyncClient(verify=False, timeout=15) as client:
-        for hid in host_ids:
-            host = await db.get(HAHost, hid)
-            if not host or not host.active: continue
-            try:
-                resp = await client.get(f"{host.base_url}/api/states",
-                                        headers={"Authorization": f"Bearer {decrypt(host.token)}"})
-                if resp.status_code != 200: continue
-                states = resp.json()
-                all_entities += [{"entity_id": s["entity_id"],
-                                   "friendly_name": s.get("attributes", {}).get("friendly_name", s["entity_id"])}
-                                  for s in states if is_allowed(s)]
-            except: continue
+    for hid in host_ids:
+        host = await db.get(HAHost, hid)
+        if not host or not host.active: continue
+        try:
+            resp = await upstream_request(host, "GET", "/api/states", timeout=15)
+            if resp.status_code != 200: continue
+            states = resp.json()
+            all_entities += [{"entity_id": s["entity_id"],
+                               "friendly_name": s.get("attributes", {}).get("friendly_name", s["entity_id"])}
+                              for s in states if is_allowed(s)]
+        except: continue
     seen, unique = set(), []
     for e in sorted(all_entities, key=lambda x: x["entity_id"]):
         if e["entity_id"] not in seen:
@@ -141,7 +182,9 @@ async def add_widget(view_id: str, data: WidgetCreate, db: AsyncSession = Depend
     widget = ViewWidget(view_id=view.id, entity_id=data.entity_id, label=data.label,
                         icon=data.icon, color=data.color, bg_color=data.bg_color, size=data.size, order=next_order)
     db.add(widget)
+    view.version += 1
     await db.commit()
+    invalidate_view_definitions()
     return {"id": str(widget.id), "message": "Widget aggiunto"}
 
 @router.patch("/admin/views/{view_id}/widgets/{widget_id}")
@@ -155,7 +198,9 @@ async def update_widget(view_id: str, widget_id: str, data: WidgetUpdate,
     if data.bg_color is not None: widget.bg_color = data.bg_color
     if data.size is not None: widget.size = data.size
     if data.order is not None: widget.order = data.order
+    await bump_view_version(db, widget.view_id)
     await db.commit()
+    invalidate_view_definitions()
     return {"message": "Widget aggiornato"}
 
 @router.delete("/admin/views/{view_id}/widgets/{widget_id}")
@@ -163,9 +208,60 @@ async def delete_widget(view_id: str, widget_id: str, db: AsyncSession = Depends
     widget = await db.get(ViewWidget, widget_id)
     if not widget: raise HTTPException(404, "Widget non trovato")
     await db.delete(widget)
+    await bump_view_version(db, widget.view_id)
     await db.commit()
+    invalidate_view_definitions()
     return {"message": "Widget eliminato"}
 
+@router.put("/admin/views/{view_id}/widgets")
+async def save_layout(view_id: uuid.UUID, data: LayoutUpdate,
+                      db: AsyncSession = Depends(get_db), admin: User = Depends(require_admin)):
+    """Salva l'intero layout (ordine = posizione nella lista) in un'unica transazione.
+
+    Applica solo le differenze: UPDATE dei widget cambiati, INSERT dei nuovi,
+    DELETE di quelli assenti dalla lista. `version` deve coincidere con quella
+    corrente della vista, altrimenti 409."""
+    new_version = await db.scalar(
+        update(CustomView).where(CustomView.id == view_id, CustomView.version == data.version)
+        .values(version=CustomView.version + 1).returning(CustomView.version)
+        .execution_options(synchronize_session=False))
+    if new_version is None:
+        current = await db.scalar(select(CustomView.version).where(CustomView.id == view_id))
+        if current is None: raise HTTPException(404, "Vista non trovata")
+        raise HTTPException(409, f"La vista è stata modificata (versione attuale {current}), ricarica")
+    result = await db.execute(select(ViewWidget).where(ViewWidget.view_id == view_id))
+    existing = {w.id: w for w in result.scalars().all()}
+    changed, created, final = [], [], []
+    for order, item in enumerate(data.widgets):
+        if item.id is None:
+            if not item.entity_id:
+                raise HTTPException(400, "entity_id obbligatorio per i nuovi widget")
+            row = {"id": uuid.uuid4(), "view_id": view_id, "entity_id": item.entity_id,
+                   **{f: getattr(item, f) for f in WIDGET_FIELDS}, "order": order}
+            row["size"] = row["size"] or "medium"
+            created.append(row)
+            final.append(row)
+            continue
+        w = existing.pop(item.id, None)
+        if w is None:
+            raise HTTPException(400, f"Widget {item.id} non appartiene alla vista")
+        row = {"id": w.id, "entity_id": w.entity_id, "order": order,
+               **{f: getattr(item, f) if getattr(item, f) is not None else getattr(w, f) for f in WIDGET_FIELDS}}
+        if any(row[f] != getattr(w, f) for f in (*WIDGET_FIELDS, "order")):
+            changed.append({k: v for k, v in row.items() if k != "entity_id"})
+        final.append(row)
+    if changed:
+        await db.execute(update(ViewWidget), changed)
+    if created:
+        await db.execute(insert(ViewWidget), created)
+    if existing:
+        await db.execute(delete(ViewWidget).where(ViewWidget.id.in_(list(existing)))
+                         .execution_options(synchronize_session=False))
+    await db.commit()
+    invalidate_view_definitions()
+    return {"version": new_version, "updated": len(changed), "created": len(created), "deleted": len(existing),
+            "widgets": [{**{k: v for k, v in row.items() if k != "view_id"}, "id": str(row["id"])} for row in final]}
+
 @router.get("/views/my")
 async def get_my_views(current: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     role_ids = await get_user_role_ids(current, db)
@@ -177,61 +273,69 @@ async def get_my_views(current: User = Depends(get_current_user), db: AsyncSessi
     return [{"id": str(v.id), "title": v.title, "slug": v.slug, "order": v.order} for v in views]
 
 @router.get("/views/{slug}/states")
-async def get_view_states(slug: str, current: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(CustomView).options(selectinload(CustomView.widgets)).where(CustomView.slug == slug))
-    view = result.scalar_one_or_none()
-    if not view: raise HTTPException(404, "Vista non trovata")
-    perm_result = await db.execute(select(RolePermission).where(RolePermission.role_id == view.role_id))
-    perms = perm_result.scalars().all()
-    host_ids = list(set(str(p.host_id) for p in perms))
-    hosts = []
-    for hid in host_ids:
-        h = await db.get(HAHost, hid)
-        if h and h.active: hosts.append(h)
-    if not hosts: raise HTTPException(404, "Nessun host attivo per questo ruolo")
-    widgets = sorted(view.widgets, key=lambda x: x.order)
+async def get_view_states(slug: str, response: Response, view_etag: Optional[str] = None,
+                          with_history: Optional[int] = Query(None, ge=1, le=settings.HISTORY_POINTS),
+                          current: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """Stati dei widget della vista. Se `view_etag` coincide con quello corrente la
+    definizione non viene reinviata ("view": null) e il poll trasporta solo gli stati.
+    Gli stati arrivano dagli snapshot degli host (un refresh condiviso per host, non una
+    GET per widget); con `with_history=N` ogni entità numerica include gli ultimi N campioni."""
+    definition = await get_view_definition(db, slug)
+    if not definition.hosts: raise HTTPException(404, "Nessun host attivo per questo ruolo")
+    results = await asyncio.gather(*(snapshots.get_states(host) for host in definition.hosts),
+                                   return_exceptions=True)
+    by_entity, ages = {}, []
+    for host, result in zip(definition.hosts, results):
+        if isinstance(result, BaseException): continue
+        host_states, age = result
+        if age is not None: ages.append(age)
+        for e in host_states:
+            by_entity.setdefault(e.entity_id, (host.id, e))
     states = {}
-    async with httpx.AsyncClient(timeout=5) as client:
-        for w in widgets:
-            eid = w.entity_id
-            for host in hosts:
-                try:
-                    resp = await client.get(f"{host.base_url}/api/states/{eid}",
-                                            headers={"Authorization": f"Bearer {decrypt(host.token)}"})
-                    if resp.status_code == 200:
-                        d = resp.json()
-                        states[eid] = {"state": d.get("state"), "attributes": d.get("attributes", {})}
-                        break
-                except: continue
-    return {"view": {"id": str(view.id), "title": view.title, "slug": view.slug,
-                     "widgets": [{"id": str(w.id), "entity_id": w.entity_id, "label": w.label,
-                                  "icon": w.icon, "color": w.color, "bg_color": w.bg_color,
-                                  "size": w.size, "order": w.order} for w in widgets]},
+    for w in definition.document["widgets"]:
+        eid = w["entity_id"]
+        if eid not in by_entity: continue
+        host_id, e = by_entity[eid]
+        states[eid] = {"state": e.state, "attributes": e.attributes.unpack()}
+        if with_history:
+            states[eid]["history"] = history.get_history(host_id, eid, with_history)
+    snapshots.mark_stale(response, max(ages) if ages else None)
+    response.headers["X-View-ETag"] = definition.etag
+    return {"view": None if view_etag == definition.etag else definition.document,
+            "view_etag": definition.etag,
             "states": states}
 
 @router.post("/views/{slug}/control")
-async def control_entity(slug: str, payload: dict, current: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+async def control_entity(slug: str, payload: dict, request: Request, response: Response,
+                         current: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """Comando su un'entità della vista; supporta l'header Idempotency-Key come /services."""
     entity_id = payload.get("entity_id")
     service = payload.get("service")
     data = payload.get("data", {})
-    result = await db.execute(select(CustomView).where(CustomView.slug == slug))
-    view = result.scalar_one_or_none()
-    if not view: raise HTTPException(404, "Vista non trovata")
-    perm_result = await db.execute(select(RolePermission).where(RolePermission.role_id == view.role_id))
-    perms = perm_result.scalars().all()
-    host_ids = list(set(str(p.host_id) for p in perms))
+    definition = await get_view_definition(db, slug)
     domain = entity_id.split(".")[0]
-    async with httpx.AsyncClient(timeout=5) as client:
-        for hid in host_ids:
-            host = await db.get(HAHost, hid)
-            if not host or not host.active: continue
-            try:
-                check = await client.get(f"{host.base_url}/api/states/{entity_id}",
-                                         headers={"Authorization": f"Bearer {decrypt(host.token)}"})
-                if check.status_code != 200: continue
-                resp = await client.post(f"{host.base_url}/api/services/{domain}/{service}",
-                                         headers={"Authorization": f"Bearer {decrypt(host.token)}"},
-                                         json={"entity_id": entity_id, **data})
-                return {"ok": True, "status": resp.status_code}
-            except: continue
-    raise HTTPException(500, "Impossibile controllare l'entita")
+    host = await _host_with_entity(definition.hosts, entity_id)
+    if host is None:
+        raise HTTPException(500, "Impossibile controllare l'entita")
+
+    async def call():
+        changed = snapshots.apply_states(host.id, await upstream_call_service(
+            host, domain, service, {"entity_id": entity_id, **data}))
+        # Solo le entità dei widget della vista, nello stesso formato di /views/{slug}/states
+        visible = {w["entity_id"] for w in definition.document["widgets"]}
+        return {"ok": True, "status": 200,
+                "states": {e.entity_id: {"state": e.state, "attributes": e.attributes.unpack()}
+                           for e in changed if e.entity_id in visible}}
+    return await idempotent(request, response, current.id, fingerprint(payload), call)
+
+async def _host_with_entity(hosts, entity_id: str):
+    """Primo host della vista che espone l'entità, dagli snapshot (nessuna GET di verifica)."""
+    for host in hosts:
+        if snapshots.find_entity(host.id, entity_id) is not None:
+            return host
+    missing = [h for h in hosts if not snapshots.has_snapshot(h.id)]
+    results = await asyncio.gather(*(snapshots.get_states(h) for h in missing), return_exceptions=True)
+    for host, result in zip(missing, results):
+        if not isinstance(result, BaseException) and any(e.entity_id == entity_id for e in result[0]):
+            return host
+    return None
@@ -0,0 +1,97 @@
+"""Confronto di memoria: dict JSON "grezzi" contro lo store compatto degli stati.
+
+Genera stati sintetici simili a quelli di HA (sensori, luci, media player,
+meteo con previsioni) per N host e misura con tracemalloc la memoria trattenuta.
+
+    cd backend && python -m benchmarks.bench_state_store --hosts 30 --entities 2000
+"""
+import argparse
+import gc
+import json
+import random
+import string
+import time
+import tracemalloc
+from app.hosts.state_store import compact, memory_report, to_dicts
+
+def _ulid(rng: random.Random) -> str:
+    return "".join(rng.choices(string.ascii_uppercase + string.digits, k=26))
+
+def _timestamp(rng: random.Random) -> str:
+    return f"2026-10-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:" \
+           f"{rng.randint(0, 59):02d}.{rng.randint(0, 999999):06d}+00:00"
+
+def _entity(rng: random.Random, i: int) -> dict:
+    kind = rng.choices(["sensor", "binary_sensor", "light", "switch", "media_player", "weather"],
+                       weights=[50, 20, 12, 12, 4, 2])[0]
+    room = rng.choice(["Cucina", "Soggiorno", "Camera", "Bagno", "Studio", "Garage", "Giardino"])
+    attrs = {"friendly_name": f"{room} {kind} {i}"}
+    state = "on" if rng.random() < 0.5 else "off"
+    if kind == "sensor":
+        device_class, unit = rng.choice([("temperature", "°C"), ("humidity", "%"), ("power", "W"),
+                                         ("energy", "kWh"), ("illuminance", "lx")])
+        attrs.update({"state_class": "measurement", "unit_of_measurement": unit, "device_class": device_class})
+        state = f"{rng.uniform(0, 100):.1f}"
+    elif kind == "binary_sensor":
+        attrs["device_class"] = rng.choice(["motion", "door", "window", "occupancy"])
+    elif kind == "light":
+        attrs.update({"supported_color_modes": ["brightness", "color_temp"], "color_mode": "color_temp",
+                      "brightness": rng.randint(0, 255), "min_mireds": 153, "max_mireds": 500,
+                      "supported_features": 40})
+    elif kind == "media_player":
+        attrs.update({"volume_level": round(rng.random(), 2), "is_volume_muted": False,
+                      "media_content_type": "music", "media_title": f"Brano {rng.randint(1, 500)}",
+                      "media_artist": f"Artista {rng.randint(1, 50)}", "source_list": ["TV", "Radio", "Spotify", "AUX"],
+                      "supported_features": 152463,
+                      "entity_picture": f"/api/media_player_proxy/media_player.p{i}?token={_ulid(rng)}{_ulid(rng)}"})
+        state = "playing"
+    elif kind == "weather":
+        state = "sunny"
+        attrs.update({"temperature": 21.3, "humidity": 54, "pressure": 1013, "wind_speed": 7.2,
+                      "forecast": [{"datetime": _timestamp(rng), "condition": rng.choice(["sunny", "cloudy", "rainy"]),
+                                    "temperature": rng.randint(10, 30), "templow": rng.randint(0, 15),
+                                    "precipitation": round(rng.random() * 5, 1)} for _ in range(48)]})
+    changed = _timestamp(rng)
+    return {"entity_id": f"{kind}.{room.lower()}_{i}", "state": state, "attributes": attrs,
+            "last_changed": changed, "last_updated": changed if rng.random() < 0.7 else _timestamp(rng),
+            "context": {"id": _ulid(rng), "parent_id": None, "user_id": None}}
+
+def _payloads(hosts: int, entities: int) -> list[bytes]:
+    """Risposte /api/states serializzate, come arrivano da HA."""
+    rng = random.Random(42)
+    return [json.dumps([_entity(rng, i) for i in range(entities)]).encode() for _ in range(hosts)]
+
+def _measure(build) -> tuple[int, object]:
+    gc.collect()
+    tracemalloc.start()
+    kept = build()
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current, kept
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hosts", type=int, default=30)
+    parser.add_argument("--entities", type=int, default=2000)
+    args = parser.parse_args()
+    payloads = _payloads(args.hosts, args.entities)
+
+    naive_bytes, naive = _measure(lambda: [json.loads(p) for p in payloads])
+    del naive
+    compact_bytes, stores = _measure(lambda: [compact(json.loads(p)) for p in payloads])
+    # Secondo refresh: le entità invariate riusano i record del precedente
+    refreshed_bytes, refreshed = _measure(lambda: [compact(json.loads(p), prev) for p, prev in zip(payloads, stores)])
+
+    print(f"host: {args.hosts}  entità per host: {args.entities}")
+    print(f"dict JSON grezzi : {naive_bytes / 2**20:8.1f} MiB")
+    print(f"store compatto   : {compact_bytes / 2**20:8.1f} MiB  ({naive_bytes / compact_bytes:.1f}x)")
+    print(f"dopo un refresh  : {refreshed_bytes / 2**20:8.1f} MiB allocati in più (record invariati riusati)")
+    started = time.perf_counter()
+    to_dicts(stores[0])
+    print(f"to_dicts (1 host): {(time.perf_counter() - started) * 1000:8.1f} ms")
+    print(f"memory_report host 0: {memory_report(stores[0])}")
+    del refreshed
+
+if __name__ == "__main__":
+    main()
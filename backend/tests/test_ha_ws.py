@@ -0,0 +1,26 @@
+import asyncio
+import pytest
+from app.hosts import ha_ws
+
+def test_send_without_socket_after_connect_is_unavailable(monkeypatch):
+    conn = ha_ws.HAConnection("h1", "http://ha.local:8123", "token")
+
+    async def connect():  # connessione chiusa subito dopo l'handshake
+        conn._ws = None
+    monkeypatch.setattr(conn, "_connect", connect)
+    with pytest.raises(ha_ws.WSUnavailable):
+        asyncio.run(conn.send({"type": "ping"}))
+    assert not conn._pending
+
+def test_replaced_connection_close_is_tracked(monkeypatch):
+    class Host:
+        id, base_url, token = "h1", "http://ha.local:8123", "a"
+
+    async def run():
+        old = ha_ws.get_connection(Host)
+        Host.token = "b"
+        assert ha_ws.get_connection(Host) is not old
+        assert len(ha_ws._closing) == 1
+        await ha_ws.close_connections()
+        assert not ha_ws._closing
+    asyncio.run(run())
@@ -0,0 +1,79 @@
+import asyncio
+from types import SimpleNamespace
+import httpx
+import pytest
+from fastapi import HTTPException, Response
+from app import idempotency
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    async def delete(self, key):
+        self.data.pop(key, None)
+
+def make_request(key="k1"):
+    return SimpleNamespace(headers={idempotency.IDEMPOTENCY_HEADER: key},
+                           url=SimpleNamespace(path="/api/hosts/h1/services/light/toggle"))
+
+@pytest.fixture
+def redis(monkeypatch):
+    fake = FakeRedis()
+    monkeypatch.setattr(idempotency, "get_redis", lambda: fake)
+    return fake
+
+def run_failing(error):
+    async def call():
+        raise error
+    with pytest.raises(type(error)):
+        asyncio.run(idempotency.idempotent(make_request(), Response(), 1, "fp", call))
+
+def test_unknown_outcome_keeps_reservation(redis):
+    run_failing(httpx.ReadTimeout("timeout"))
+    assert len(redis.data) == 1
+
+def test_not_sent_releases_reservation(redis):
+    run_failing(httpx.ConnectError("refused"))
+    assert not redis.data
+
+def test_admission_rejection_releases_reservation(redis):
+    run_failing(HTTPException(429, "Troppe richieste"))
+    assert not redis.data
+
+def test_cancelled_call_completes_and_retry_replays(redis):
+    calls = []
+
+    async def run():
+        gate = asyncio.Event()
+
+        async def call():
+            calls.append(1)
+            await gate.wait()
+            return [{"entity_id": "light.x", "state": "on"}]
+
+        first = asyncio.create_task(idempotency.idempotent(make_request(), Response(), 1, "fp", call))
+        while not calls:
+            await asyncio.sleep(0)
+        first.cancel()  # client disconnesso a chiamata già partita
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        during = Response()
+        retry = asyncio.create_task(idempotency.idempotent(make_request(), during, 1, "fp", call))
+        await asyncio.sleep(0)
+        gate.set()
+        assert await retry == [{"entity_id": "light.x", "state": "on"}]
+        assert during.headers[idempotency.REPLAYED_HEADER] == "true"
+        after = Response()
+        assert await idempotency.idempotent(make_request(), after, 1, "fp", call) == await retry
+        assert after.headers[idempotency.REPLAYED_HEADER] == "true"
+    asyncio.run(run())
+    assert len(calls) == 1
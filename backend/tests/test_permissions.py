@@ -0,0 +1,32 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+from app.hosts import service
+
+def _entity_host(monkeypatch, allowed_domains, allowed_entities, entity_id):
+    host = object()
+
+    async def get_active_host(host_id, db):
+        return host
+
+    async def get_user_permissions(user, host_id, db):
+        return allowed_domains, allowed_entities
+
+    monkeypatch.setattr(service, "get_active_host", get_active_host)
+    monkeypatch.setattr(service, "get_user_permissions", get_user_permissions)
+    return asyncio.run(service.get_entity_host("h", entity_id, None, None)), host
+
+def test_domain_only_role_blocks_other_domains(monkeypatch):
+    with pytest.raises(HTTPException) as e:
+        _entity_host(monkeypatch, ["light"], None, "camera.front_door")
+    assert e.value.status_code == 403
+
+def test_domain_only_role_allows_its_domain(monkeypatch):
+    result, host = _entity_host(monkeypatch, ["light"], None, "light.kitchen")
+    assert result is host
+
+def test_entity_grant_and_full_access(monkeypatch):
+    assert _entity_host(monkeypatch, None, ["camera.front_door"], "camera.front_door")[0] is not None
+    assert _entity_host(monkeypatch, None, None, "camera.front_door")[0] is not None
+    with pytest.raises(HTTPException):
+        _entity_host(monkeypatch, None, ["camera.front_door"], "camera.garage")
@@ -0,0 +1,12 @@
+from app.hosts.registry import Registry
+
+def make_registry():
+    return Registry({"cucina": "Cucina", "bagno": "Bagno", "garage": "Garage"},
+                    {"d1": ("Lampada", "bagno")},
+                    {"light.x": ("cucina", "d1"), "light.y": (None, "d1"), "camera.z": ("garage", None)})
+
+def test_visible_areas_only_from_given_entities():
+    reg = make_registry()
+    assert reg.visible_areas(["light.y"]) == {"bagno": "Bagno"}
+    assert reg.visible_areas(["light.x"]) == {"cucina": "Cucina", "bagno": "Bagno"}
+    assert "garage" not in reg.visible_areas(["light.x", "light.y", "sensor.unknown"])
@@ -0,0 +1,12 @@
+from app import security_log
+from app.config import settings
+
+def test_pending_buffer_is_capped(monkeypatch):
+    monkeypatch.setattr(settings, "SECURITY_EVENTS_MAX_PENDING", 3)
+    monkeypatch.setattr(settings, "SECURITY_EVENTS_BATCH_SIZE", 100)
+    monkeypatch.setattr(security_log, "_pending", [])
+    monkeypatch.setattr(security_log, "_dropped", 0)
+    for i in range(5):
+        security_log._record("LOGIN_FAIL", email=f"u{i}@example.com")
+    assert [e["email"] for e in security_log._pending] == ["u2@example.com", "u3@example.com", "u4@example.com"]
+    assert security_log.security_events_stats() == {"pending": 3, "dropped": 2}
@@ -0,0 +1,24 @@
+import asyncio
+import gzip
+import json
+import uuid
+from app.config import settings
+from app.hosts import snapshots
+
+def _saved_state(tmp_path, key, entity_id):
+    with gzip.open(tmp_path / f"{key}.json.gz", "rt", encoding="utf-8") as f:
+        return next(s["state"] for s in json.load(f)["states"] if s["entity_id"] == entity_id)
+
+def test_point_updates_are_persisted(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "SNAPSHOT_DIR", str(tmp_path))
+    key = str(uuid.uuid4())
+    snapshots._store(key, snapshots.Snapshot(snapshots.compact([{"entity_id": "light.x", "state": "off"}]), 1.0))
+    try:
+        asyncio.run(snapshots.persist_snapshots())
+        assert _saved_state(tmp_path, key, "light.x") == "off"
+        snapshots.apply_states(key, [{"entity_id": "light.x", "state": "on"}])
+        assert snapshots._snapshots[key].fetched_at == 1.0
+        asyncio.run(snapshots.persist_snapshots())
+        assert _saved_state(tmp_path, key, "light.x") == "on"
+    finally:
+        snapshots.forget(key)
@@ -0,0 +1,27 @@
+from app.hosts.state_store import compact, to_dicts
+
+def _state(entity_id, state, attributes):
+    return {"entity_id": entity_id, "state": state, "attributes": attributes,
+            "last_changed": "2026-10-20T05:12:33.123456+00:00",
+            "last_updated": "2026-10-20T05:12:33.123456+00:00"}
+
+def test_round_trip_keeps_json_shape():
+    raw = [_state("sensor.t", "21.5", {"unit_of_measurement": "°C", "friendly_name": "T"}),
+           _state("sensor.next_alarm", "2026-10-20T05:12:33+00:00", {"device_class": "timestamp"}),
+           _state("weather.home", "sunny", {"forecast": [{"datetime": "2026-10-21T00:00:00+00:00",
+                                                          "temperature": 12, "flag": True}]})]
+    assert to_dicts(compact(raw)) == raw
+
+def test_bool_int_float_attributes_are_distinct():
+    raw = [_state("input.a", "on", {"v": 1.0}), _state("input.b", "on", {"v": True}),
+           _state("input.c", "on", {"v": 1}), _state("input.d", "on", {"v": [True, 1.0]})]
+    out = to_dicts(compact(raw))
+    assert [type(d["attributes"]["v"]) for d in out[:3]] == [float, bool, int]
+    assert [type(v) for v in out[3]["attributes"]["v"]] == [bool, float]
+
+def test_type_change_is_detected_on_refresh():
+    first = compact([_state("input.a", "on", {"v": 1})])
+    second = compact([_state("input.a", "on", {"v": True})], first)
+    assert second[0] is not first[0]
+    assert to_dicts(second)[0]["attributes"]["v"] is True
+    assert compact([_state("input.a", "on", {"v": True})], second)[0] is second[0]
@@ -5,11 +5,46 @@ const api = axios.create({
   withCredentials: true,  // necessario per il cookie refresh_token
 })
 
+// Chiave di idempotenza per i comandi: i retry della stessa azione la riusano,
+// così il backend non la esegue due volte su HA
+export const idempotencyKey = () =>
+  (crypto.randomUUID ? crypto.randomUUID() : `${Date.now()}-${Math.random().toString(36).slice(2)}`)
+
+// Una chiave per azione (es. entità+servizio) finché la chiamata è in corso e per un
+// breve margine dopo: un doppio tap riusa la stessa chiave e il comando parte una volta sola
+const ACTION_KEY_GRACE_MS = 1000
+const actionKeys = new Map()
+
+export const actionKey = action => {
+  const entry = actionKeys.get(action) || { key: idempotencyKey(), pending: 0 }
+  clearTimeout(entry.timer)
+  entry.pending++
+  actionKeys.set(action, entry)
+  return entry.key
+}
+
+export const releaseActionKey = action => {
+  const entry = actionKeys.get(action)
+  if (!entry || --entry.pending > 0) return
+  entry.timer = setTimeout(() => actionKeys.delete(action), ACTION_KEY_GRACE_MS)
+}
+
+const MAX_NETWORK_RETRIES = 2
+
+// I poll degli stati partono ogni 3 s: una risposta più lenta non serve più
+export const POLL_TIMEOUT = 3000
+
 // Interceptor: se access token scaduto, prova refresh automatico
 api.interceptors.response.use(
   res => res,
   async err => {
     const original = err.config
+    // Rete instabile: ritenta solo le richieste con Idempotency-Key (sicure da ripetere)
+    if (!err.response && original?.headers?.['Idempotency-Key'] && (original._netRetries || 0) < MAX_NETWORK_RETRIES) {
+      original._netRetries = (original._netRetries || 0) + 1
+      await new Promise(r => setTimeout(r, 300 * original._netRetries))
+      return api(original)
+    }
     if (err.response?.status === 401 && !original._retry) {
       original._retry = true
       try {
@@ -29,10 +64,12 @@ api.interceptors.response.use(
   }
 )
 
-// Inietta access token ad ogni richiesta
+// Inietta access token ad ogni richiesta; il timeout della richiesta diventa la scadenza
+// lato backend (X-Request-Timeout), che smette di lavorare quando il client rinuncia
 api.interceptors.request.use(config => {
   const token = localStorage.getItem('access_token')
   if (token) config.headers['Authorization'] = `Bearer ${token}`
+  if (config.timeout) config.headers['X-Request-Timeout'] = String(config.timeout / 1000)
   return config
 })
 
@@ -7,6 +7,16 @@ export function AuthProvider({ children }) {
   const [user, setUser] = useState(null)
   const [loading, setLoading] = useState(true)
 
+  // Profilo, host, viste e stato 2FA in un'unica richiesta (/api/bootstrap)
+  const loadUser = async (token) => {
+    const payload = JSON.parse(atob(token.split('.')[1]))
+    const boot = await axios.get('https://homematrix.iotzator.com/api/bootstrap',
+      { headers: { Authorization: `Bearer ${token}` } }).then(r => r.data).catch(() => null)
+    const totp = boot?.['2fa'] || { enabled: true, required: false }
+    return { id: payload.sub, is_admin: payload.is_admin, totp_required: totp.required, totp_enabled: totp.enabled,
+             views: boot?.views || [], hosts: boot?.hosts }
+  }
+
   // Auto-login: tenta refresh al caricamento
   useEffect(() => {
     const init = async () => {
@@ -14,13 +24,7 @@ export function AuthProvider({ children }) {
         const { data } = await axios.post('https://homematrix.iotzator.com/api/auth/refresh',
           {}, { withCredentials: true })
         localStorage.setItem('access_token', data.access_token)
-        const payload = JSON.parse(atob(data.access_token.split(".")[1]))
-        const token = data.access_token
-        const totp = await axios.get('https://homematrix.iotzator.com/api/auth/2fa/status',
-          { headers: { Authorization: `Bearer ${token}` } }).then(r => r.data).catch(() => ({ enabled: true, required: false }))
-        const views = await axios.get('https://homematrix.iotzator.com/api/views/my',
-          { headers: { Authorization: `Bearer ${token}` } }).then(r => r.data).catch(() => [])
-        setUser({ id: payload.sub, is_admin: payload.is_admin, totp_required: totp.required, totp_enabled: totp.enabled, views })
+        setUser(await loadUser(data.access_token))
       } catch {
         // Fallback: prova con access_token salvato nel localStorage
         const saved = localStorage.getItem('access_token')
@@ -29,11 +33,7 @@ export function AuthProvider({ children }) {
             const payload = JSON.parse(atob(saved.split(".")[1]))
             const exp = payload.exp * 1000
             if (exp > Date.now()) {
-              const totp = await axios.get('https://homematrix.iotzator.com/api/auth/2fa/status',
-                { headers: { Authorization: `Bearer ${saved}` } }).then(r => r.data).catch(() => ({ enabled: true, required: false }))
-              const views = await axios.get('https://homematrix.iotzator.com/api/views/my',
-                { headers: { Authorization: `Bearer ${saved}` } }).then(r => r.data).catch(() => [])
-              setUser({ id: payload.sub, is_admin: payload.is_admin, totp_required: totp.required, totp_enabled: totp.enabled, views })
+              setUser(await loadUser(saved))
             }
           } catch {}
         }
@@ -43,21 +43,9 @@ export function AuthProvider({ children }) {
     init()
   }, [])
 
-  const check2fa = async (token) => {
-    try {
-      const res = await axios.get('https://homematrix.iotzator.com/api/auth/2fa/status',
-        { headers: { Authorization: `Bearer ${token}` } })
-      return res.data
-    } catch { return { enabled: true, required: false } }
-  }
-
   const loginWithToken = async (token) => {
     localStorage.setItem('access_token', token)
-    const payload = JSON.parse(atob(token.split('.')[1]))
-    const totp = await check2fa(token)
-    const views = await axios.get('https://homematrix.iotzator.com/api/views/my',
-      { headers: { Authorization: `Bearer ${token}` } }).then(r => r.data).catch(() => [])
-    setUser({ id: payload.sub, is_admin: payload.is_admin, totp_required: totp.required, totp_enabled: totp.enabled, views })
+    setUser(await loadUser(token))
   }
 
   const login = async (email, password) => {
@@ -126,9 +126,19 @@ export default function Admin() {
     } catch(e) { console.error(e); return [] }
   }
 
+  // Le liste admin sono paginate: segue il cursore X-Next-Cursor fino all'ultima pagina
+  const fetchAll = async url => {
+    let items = [], cursor = null
+    do {
+      const r = await api.get(url, { params: { limit: 500, ...(cursor ? { cursor } : {}) } })
+      items = items.concat(r.data)
+      cursor = r.headers['x-next-cursor']
+    } while (cursor)
+    return items
+  }
+
   const loadViews = async () => {
-    const r = await api.get('/api/admin/views')
-    setViews(r.data)
+    setViews(await fetchAll('/api/admin/views'))
   }
 
   const createView = async e => {
@@ -176,9 +186,10 @@ export default function Admin() {
       const idx = sorted.findIndex(w => w.id === widgetId)
       const swapIdx = dir === 'up' ? idx - 1 : idx + 1
       if (swapIdx < 0 || swapIdx >= sorted.length) return
-      const a = sorted[idx], b = sorted[swapIdx]
-      await api.patch(`/api/admin/views/${viewId}/widgets/${a.id}`, {order: b.order})
-      await api.patch(`/api/admin/views/${viewId}/widgets/${b.id}`, {order: a.order})
+      ;[sorted[idx], sorted[swapIdx]] = [sorted[swapIdx], sorted[idx]]
+      // Layout completo in un'unica richiesta/transazione
+      const version = views.find(v => v.id === viewId)?.version
+      await api.put(`/api/admin/views/${viewId}/widgets`, {version, widgets: sorted.map(w => ({id: w.id}))})
       loadViews()
     } catch(e) { notify('Errore: ' + (e.response?.data?.detail || e.message)) }
   }
@@ -191,20 +202,15 @@ export default function Admin() {
   const load = async () => {
     const [p, u, h, r, v] = await Promise.all([
       api.get('/api/admin/users/pending'),
-      api.get('/api/admin/users'),
+      fetchAll('/api/admin/users'),
       api.get('/api/admin/hosts'),
-      api.get('/api/admin/roles'),
-      api.get('/api/admin/views'),
+      fetchAll('/api/admin/roles'),
+      fetchAll('/api/admin/views'),
     ])
-    setPending(p.data); setUsers(u.data); setHosts(h.data); setRoles(r.data)
-    setViews(v.data)
-    // Carica ruoli per ogni utente
-    const rolesMap = {}
-    await Promise.all(u.data.map(async user => {
-      const res = await api.get(`/api/admin/users/${user.id}/roles`)
-      rolesMap[user.id] = res.data
-    }))
-    setUserRoles(rolesMap)
+    setPending(p.data); setUsers(u); setHosts(h.data); setRoles(r)
+    setViews(v)
+    // I ruoli di ogni utente arrivano già nella lista utenti
+    setUserRoles(Object.fromEntries(u.map(user => [user.id, user.roles])))
   }
 
   useEffect(() => { load() }, [])
@@ -488,6 +494,10 @@ export default function Admin() {
                       </div>
                       <div className="field"><label>Nuovo Token (lascia vuoto per non modificare)</label><input placeholder="eyJhbGci..." onChange={e=>setEditHostData({...editHostData,token:e.target.value})} /></div>
                       <div className="field"><label>Descrizione</label><input defaultValue={h.description} onChange={e=>setEditHostData({...editHostData,description:e.target.value})} /></div>
+                      <div className="form-row">
+                        <div className="field"><label>Richieste parallele max</label><input type="number" min="1" defaultValue={h.max_concurrency ?? ''} placeholder="Default" onChange={e=>setEditHostData({...editHostData,max_concurrency:e.target.value === '' ? null : Number(e.target.value)})} /></div>
+                        <div className="field"><label>Coda max</label><input type="number" min="0" defaultValue={h.max_queue ?? ''} placeholder="Default" onChange={e=>setEditHostData({...editHostData,max_queue:e.target.value === '' ? null : Number(e.target.value)})} /></div>
+                      </div>
                       <div className="host-actions" style={{marginTop:'12px'}}>
                         <button className="btn-approve" onClick={() => updateHost(h.id)}>✓ Salva</button>
                         <button className="btn-toggle" onClick={() => { setEditHost(null); setEditHostData({}) }}>Annulla</button>
@@ -1,6 +1,7 @@
-import { useState, useEffect, useCallback } from 'react'
+import { useState, useEffect, useCallback, useRef } from 'react'
 import { useParams, useNavigate } from 'react-router-dom'
-import api from '../api/client'
+import { useAuth } from '../context/AuthContext'
+import api, { actionKey, releaseActionKey, POLL_TIMEOUT } from '../api/client'
 import './CustomView.css'
 
 const DOMAIN_MAP = {
@@ -10,6 +11,22 @@ const DOMAIN_MAP = {
   sensor: 'sensor', binary_sensor: 'binary_sensor',
 }
 
+const HISTORY_POINTS = 60
+
+function Sparkline({ points }) {
+  if (!points || points.length < 2) return null
+  const values = points.map(p => p[1])
+  const min = Math.min(...values), max = Math.max(...values)
+  const t0 = points[0][0], span = (points[points.length - 1][0] - t0) || 1
+  const d = points.map(([t, v]) =>
+    `${((t - t0) / span * 100).toFixed(1)},${(max === min ? 10 : 18 - (v - min) / (max - min) * 16).toFixed(1)}`).join(' ')
+  return (
+    <svg className="cv-sparkline" viewBox="0 0 100 20" preserveAspectRatio="none">
+      <polyline points={d} fill="none" stroke="var(--widget-accent, var(--accent))" strokeWidth="1.5" vectorEffect="non-scaling-stroke" />
+    </svg>
+  )
+}
+
 function Widget({ w, onAction }) {
   const domain = w.entity_id.split('.')[0]
   const isOn = w.state === 'on' || w.state === 'open'
@@ -32,6 +49,7 @@ function Widget({ w, onAction }) {
         {isBinary ? (isOn ? 'Aperto' : 'Chiuso') : w.state}
         {w.attributes?.unit_of_measurement && ` ${w.attributes.unit_of_measurement}`}
       </div>
+      {isSensor && <Sparkline points={w.history} />}
       {isButton && (
         <button className="cv-btn cv-btn--press" onClick={() => onAction(w.entity_id, domain, 'press')}>
           ▶ Premi
@@ -50,24 +68,27 @@ function Widget({ w, onAction }) {
 export default function CustomView() {
   const { slug } = useParams()
   const navigate = useNavigate()
+  const { user } = useAuth()
   const [view, setView] = useState(null)
-  const [myViews, setMyViews] = useState([])
+  const myViews = user?.views || []  // da /api/bootstrap al login
   const [loading, setLoading] = useState(true)
   const [error, setError] = useState('')
 
+  // ETag della definizione: se invariata il backend invia solo gli stati
+  const viewEtag = useRef({ slug: null, etag: null })
+
   const load = useCallback(async () => {
     try {
-      const r = await api.get(`/api/views/${slug}/states`)
-      setView({...r.data.view, states: r.data.states})
+      const known = viewEtag.current.slug === slug ? viewEtag.current.etag : null
+      const params = { with_history: HISTORY_POINTS, ...(known ? { view_etag: known } : {}) }
+      const r = await api.get(`/api/views/${slug}/states`, { params, timeout: POLL_TIMEOUT })
+      viewEtag.current = { slug, etag: r.data.view_etag }
+      setView(prev => ({...(r.data.view || prev), states: r.data.states}))
     } catch (e) {
       setError(e.response?.data?.detail || 'Errore caricamento vista')
     } finally { setLoading(false) }
   }, [slug])
 
-  useEffect(() => {
-    api.get('/api/views/my').then(r => setMyViews(r.data)).catch(()=>{})
-  }, [])
-
   useEffect(() => {
     load()
     const interval = setInterval(load, 3000)
@@ -75,10 +96,17 @@ export default function CustomView() {
   }, [load])
 
   const handleAction = async (entityId, domain, service) => {
+    const action = `${slug}/${entityId}/${domain}.${service}`
     try {
-      await api.post(`/api/views/${slug}/control`,
-        { entity_id: entityId, service, domain })
-    } catch {}
+      const r = await api.post(`/api/views/${slug}/control`,
+        { entity_id: entityId, service, domain },
+        { headers: { 'Idempotency-Key': actionKey(action) } })
+      const changed = r.data?.states || {}
+      setView(prev => prev && ({...prev, states: Object.fromEntries(Object.entries({...prev.states, ...changed})
+        .map(([id, s]) => [id, {...prev.states?.[id], ...s}]))}))
+    } catch {} finally {
+      releaseActionKey(action)
+    }
   }
 
   if (loading) return <div className="cv-shell"><div className="cv-loading">Caricamento...</div></div>
@@ -106,7 +134,7 @@ export default function CustomView() {
         </div>
       </div>
       <div className="cv-grid">
-        {view.widgets.sort((a,b) => a.order - b.order).map(w => { const s = view.states?.[w.entity_id] || {}; const ww = {...w, state: s.state, attributes: s.attributes}; return (
+        {view.widgets.sort((a,b) => a.order - b.order).map(w => { const s = view.states?.[w.entity_id] || {}; const ww = {...w, state: s.state, attributes: s.attributes, history: s.history}; return (
           <Widget key={ww.id} w={ww} onAction={handleAction} />
         )})}
       </div>
@@ -1,7 +1,7 @@
 import { useState, useEffect } from 'react'
 import { useAuth } from '../context/AuthContext'
 import { useNavigate } from 'react-router-dom'
-import api from '../api/client'
+import api, { actionKey, releaseActionKey, POLL_TIMEOUT } from '../api/client'
 import './Dashboard.css'
 
 export default function Dashboard() {
@@ -12,25 +12,38 @@ export default function Dashboard() {
   const [states, setStates] = useState([])
   const [loading, setLoading] = useState(false)
   const [filter, setFilter] = useState('all')
+  const [staleAge, setStaleAge] = useState(null)
+  // Solo i campi usati dalle card: niente blob di attributi (forecast, media player...);
+  // la stanza (area) arriva dai registri HA in cache nel backend
+  const statesUrl = host => `/api/hosts/${host.id}/states?fields=state,friendly_name,unit_of_measurement,area`
 
+  // Host già arrivati con /api/bootstrap al login; richiesta separata solo se il bootstrap è fallito
   useEffect(() => {
-    api.get('/api/hosts/').then(r => {
-      setHosts(r.data)
-      if (r.data.length > 0) setSelectedHost(r.data[0])
-    }).catch(() => {})
-  }, [])
+    const apply = list => {
+      setHosts(list)
+      if (list.length > 0) setSelectedHost(list[0])
+    }
+    if (user?.hosts) apply(user.hosts)
+    else api.get('/api/hosts/').then(r => apply(r.data)).catch(() => {})
+  }, [user])
+
+  // HA lento o irraggiungibile: il backend risponde con l'ultimo snapshot (X-Stale)
+  const applyStates = r => {
+    setStates([...r.data])
+    setStaleAge(r.headers['x-stale'] ? Number(r.headers['x-snapshot-age']) : null)
+  }
 
   useEffect(() => {
     if (!selectedHost) return
     setLoading(true)
-    api.get(`/api/hosts/${selectedHost.id}/states`)
-      .then(r => setStates([...r.data]))
+    api.get(statesUrl(selectedHost))
+      .then(applyStates)
       .catch(() => {})
       .finally(() => setLoading(false))
 
     const interval = setInterval(() => {
-      api.get(`/api/hosts/${selectedHost.id}/states`)
-        .then(r => setStates([...r.data]))
+      api.get(statesUrl(selectedHost), { timeout: POLL_TIMEOUT })
+        .then(applyStates)
         .catch(() => {})
     }, 3000)
 
@@ -43,7 +56,16 @@ export default function Dashboard() {
   }
 
   const callService = async (domain, service, entity_id) => {
-    await api.post(`/api/hosts/${selectedHost.id}/services/${domain}/${service}`, { entity_id })
+    const action = `${selectedHost.id}/${entity_id}/${domain}.${service}`
+    try {
+      const r = await api.post(`/api/hosts/${selectedHost.id}/services/${domain}/${service}`, { entity_id },
+        { headers: { 'Idempotency-Key': actionKey(action) } })
+      // Stati aggiornati restituiti dal backend: niente attesa del prossimo poll
+      const changed = Object.fromEntries((r.data || []).map(s => [s.entity_id, s]))
+      setStates(prev => prev.map(s => changed[s.entity_id] ? { ...changed[s.entity_id], area: s.area } : s))
+    } finally {
+      releaseActionKey(action)
+    }
   }
 
   const domains = ['all', ...new Set(states.map(s => s.entity_id.split('.')[0]))]
@@ -88,7 +110,7 @@ export default function Dashboard() {
         <div className="dash-header">
           <div>
             <h1 className="dash-title">{selectedHost?.name || 'Seleziona host'}</h1>
-            <div className="dash-sub">{states.length} entità · {devices.length} device · {sensors.length} sensori</div>
+            <div className="dash-sub">{states.length} entità · {devices.length} device · {sensors.length} sensori{staleAge !== null && ` · dati di ${staleAge}s fa (host non raggiungibile)`}</div>
           </div>
           <div className="dash-header-right">
             <div className="auto-banner">🔓 Sessione automatica attiva</div>
@@ -173,7 +195,7 @@ function DeviceCard({ state, onToggle }) {
         {isButton && <div className="btn-press">▶ Press</div>}
       </div>
       <div className="device-name">{name}</div>
-      <div className="device-room">{domain}</div>
+      <div className="device-room">{state.area?.name || domain}</div>
       <div className="device-value">{state.state}</div>
     </div>
   )